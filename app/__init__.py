@@ -2,6 +2,7 @@
 import os
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
+from app.database import RoutingSQLAlchemy
 from config import Config
 from elasticsearch import Elasticsearch
 from flask import Flask, request, current_app
@@ -11,11 +12,10 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 
 babel = Babel()
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
@@ -33,11 +33,43 @@ def create_app(config_class=Config):
     db.init_app(app)
     login.init_app(app)
     mail.init_app(app)
-    migrate.init_app(app)
+    migrate.init_app(app, db)
     moment.init_app(app)
 
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
 
+    from app.passwords import PasswordHasher
+    app.password_hasher = PasswordHasher(app)
+
+    from app.search import create_backend, create_result_cache
+    app.search = create_backend(app)
+    app.search_cache = create_result_cache(app)
+
+    from app.models import create_user_cache
+    app.user_cache = create_user_cache(app)
+
+    from app.activity import create_last_seen_buffer
+    app.last_seen_buffer = create_last_seen_buffer(app)
+
+    from app.translate import create_translation_cache
+    app.translation_cache = create_translation_cache(app)
+
+    from app.language import create_language_detector
+    app.language_detector = create_language_detector(app)
+
+    from app.main.caching import create_page_cache, create_fragment_cache
+    app.page_cache = create_page_cache(app)
+    app.fragment_cache = create_fragment_cache(app)
+
+    from app.pubsub import create_hub
+    app.pubsub = create_hub(app)
+
+    from app.email import MailQueue
+    app.mail_queue = MailQueue(app)
+
+    from app import instrumentation
+    instrumentation.init_app(app)
+
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
 
@@ -47,6 +79,9 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
     # error logging
     if not app.debug and not app.testing:  # don't send emails when in debug mode
         # use a virtual server instead: python -m smtpd -n -c DebuggingServer localhost:8025
@@ -0,0 +1,39 @@
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models import User, update_cached_user
+from app.worker import CoalescingWorker
+
+
+def create_last_seen_buffer(app):
+    # in buffered mode last_seen times are only collected in memory, then written out for everybody at once
+    if not app.config['LAST_SEEN_BUFFERED']:
+        return None
+
+    def write(batch):
+        with app.app_context():
+            try:
+                # one UPDATE statement, executed for the whole batch of users
+                db.session.execute(
+                    User.__table__.update().where(User.id == db.bindparam('uid')).values(
+                        last_seen=db.bindparam('ts')),
+                    [{'uid': id, 'ts': timestamp} for id, timestamp in batch])
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+    return CoalescingWorker('last-seen', write, interval=app.config['LAST_SEEN_FLUSH_INTERVAL'])
+
+
+def update_last_seen(user):
+    # at most one write per user every LAST_SEEN_INTERVAL seconds, rather than one per request
+    now = datetime.utcnow()
+    if user.last_seen and (now - user.last_seen).total_seconds() < current_app.config['LAST_SEEN_INTERVAL']:
+        return
+
+    if current_app.last_seen_buffer is not None:
+        current_app.last_seen_buffer.put(user.id, now)
+        update_cached_user(user.id, last_seen=now)  # or the cached copy would still have the old time
+    else:
+        user.last_seen = now
+        db.session.commit()
@@ -0,0 +1,21 @@
+from functools import wraps
+from flask import g, request
+from app.activity import update_last_seen
+from app.api.errors import error_response
+from app.models import User
+
+
+def token_required(f):
+    # api requests authenticate with 'Authorization: Bearer <token>', the token coming from POST /api/tokens
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = User.verify_api_token(token) if scheme.lower() == 'bearer' and token else None
+        if user is None:
+            response = error_response(401, 'A valid API token is required.')
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        g.current_user = user
+        update_last_seen(user)
+        return f(*args, **kwargs)
+    return decorated_function
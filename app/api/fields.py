@@ -0,0 +1,44 @@
+from flask import current_app, request
+from app import db
+from app.models import Post
+from app.pagination import paginate_keyset
+
+# what each kind of object can be asked for with ?fields=, and what it comes with when nobody asks
+POST_FIELDS = ('id', 'body', 'timestamp', 'language', 'user_id', 'author')
+POST_DEFAULT = ('id', 'body', 'timestamp', 'language', 'author')
+USER_FIELDS = ('id', 'username', 'about_me', 'last_seen', 'avatar', 'followers_count', 'followed_count',
+               'posts_count')
+USER_DEFAULT = ('id', 'username', 'about_me', 'last_seen', 'avatar', 'followers_count', 'followed_count',
+                'posts_count')
+
+
+class FieldError(ValueError):
+    pass
+
+
+def requested_fields(allowed, default):
+    # ?fields=id,body picks which fields come back, so clients only pay for the bytes they use
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise FieldError('Unknown fields: {}. Choose from: {}.'.format(', '.join(unknown), ', '.join(allowed)))
+    return fields
+
+
+def per_page():
+    return max(1, min(request.args.get('limit', current_app.config['API_POSTS_PER_PAGE'], type=int),
+                      current_app.config['API_MAX_POSTS_PER_PAGE']))
+
+
+def post_page(query, key=(Post.timestamp, Post.id)):
+    # a cursor-paginated page of posts: {'items': [...], 'next': cursor, 'prev': cursor}.  pass the cursor back
+    #   as ?cursor= for the next (older) or previous (newer) page.
+    fields = requested_fields(POST_FIELDS, POST_DEFAULT)
+    if 'author' in fields:
+        query = query.options(db.joinedload(Post.author))  # otherwise nobody needs the authors loaded at all
+    page = paginate_keyset(query, key, request.args.get('cursor'), per_page())
+    return {'items': [post.to_dict(fields) for post in page.items], 'next': page.next_cursor,
+            'prev': page.prev_cursor}
@@ -0,0 +1,66 @@
+from flask import g, jsonify, request, url_for
+from app import db
+from app.api import bp
+from app.api.auth import token_required
+from app.api.errors import bad_request
+from app.api.fields import POST_DEFAULT, POST_FIELDS, per_page, post_page, requested_fields
+from app.models import Post
+
+
+@bp.route('/timeline')
+@token_required
+def timeline():
+    query, key = g.current_user.home_timeline()
+    return jsonify(post_page(query, key))
+
+
+@bp.route('/explore')
+@token_required
+def explore():
+    return jsonify(post_page(Post.query))
+
+
+@bp.route('/search')
+@token_required
+def search():
+    # results come back ranked rather than by time, so the cursor here is just the next page number
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('Missing search query: ?q=')
+    fields = requested_fields(POST_FIELDS, POST_DEFAULT)
+    page = max(1, request.args.get('cursor', 1, type=int))
+    limit = per_page()
+    posts, total = Post.search(q, page, limit)
+    return jsonify({'items': [post.to_dict(fields) for post in posts], 'total': total,
+                    'next': str(page + 1) if total > page * limit else None,
+                    'prev': str(page - 1) if page > 1 else None})
+
+
+@bp.route('/posts', methods=['POST'])
+@token_required
+def create_post():
+    # everything is checked before the post is added, so a request that's refused hasn't posted anything (and a
+    #   client retrying it doesn't post twice)
+    fields = requested_fields(POST_FIELDS, POST_DEFAULT)
+    data = request.get_json(silent=True) or {}
+    body = data.get('body')
+    if not isinstance(body, str) or not body.strip():
+        return bad_request('A post needs a body.')
+    if len(body) > 140:
+        return bad_request('Posts are at most 140 characters.')
+
+    post = Post(body=body, author=g.current_user)
+    db.session.add(post)
+    post.fan_out()
+    db.session.commit()  # its language gets detected in the background, see app/language.py
+
+    response = jsonify(post.to_dict(fields))
+    response.status_code = 201
+    response.headers['Location'] = url_for('api.get_post', id=post.id)
+    return response
+
+
+@bp.route('/posts/<int:id>')
+@token_required
+def get_post(id):
+    return jsonify(Post.query.get_or_404(id).to_dict(requested_fields(POST_FIELDS, POST_DEFAULT)))
@@ -0,0 +1,22 @@
+from flask import current_app, jsonify, request
+from app import db
+from app.api import bp
+from app.api.errors import error_response
+from app.models import User
+
+
+@bp.route('/tokens', methods=['POST'])
+def get_token():
+    # trades a username and password (HTTP basic auth) for an api token
+    auth = request.authorization
+    user = User.query.filter_by(username=auth.username).first() if auth else None
+    if user is None or not user.check_password(auth.password):
+        response = error_response(401, 'Invalid username or password.')
+        response.headers['WWW-Authenticate'] = 'Basic realm="api"'
+        return response
+
+    if user.password_needs_rehash():
+        user.set_password(auth.password)
+        db.session.commit()
+
+    return jsonify({'token': user.get_api_token(), 'expires_in': current_app.config['API_TOKEN_EXPIRES']})
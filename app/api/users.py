@@ -0,0 +1,35 @@
+from flask import g, jsonify, request
+from app import db
+from app.api import bp
+from app.api.auth import token_required
+from app.api.errors import bad_request
+from app.api.fields import USER_DEFAULT, USER_FIELDS, post_page, requested_fields
+from app.models import User
+
+
+@bp.route('/users/<int:id>')
+@token_required
+def get_user(id):
+    return jsonify(User.query.get_or_404(id).to_dict(requested_fields(USER_FIELDS, USER_DEFAULT)))
+
+
+@bp.route('/users/<int:id>/posts')
+@token_required
+def get_user_posts(id):
+    return jsonify(post_page(User.query.get_or_404(id).posts))
+
+
+@bp.route('/users/<int:id>/follow', methods=['POST', 'DELETE'])
+@token_required
+def follow(id):
+    # POST follows the user, DELETE unfollows them; both answer with whether you're following them now
+    user = User.query.get_or_404(id)
+    if user == g.current_user:
+        return bad_request('You can\'t follow yourself.')
+
+    if request.method == 'POST':
+        g.current_user.follow(user)
+    else:
+        g.current_user.unfollow(user)
+    db.session.commit()
+    return jsonify({'id': user.id, 'following': g.current_user.is_following(user)})
@@ -0,0 +1,447 @@
+import asyncio
+import json
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from flask_babel import lazy_gettext as _l
+from flask_login.utils import decode_cookie
+from app.cache import LRUCache
+from app.translate import BATCH_SIZE, batch_by_language, cache_key, parse_response, request_payload
+
+# bodies bigger than this are refused before they're read in full
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class CircuitBreaker(object):
+    # stops calling an upstream that keeps failing.  after `threshold` failures in a row every call is refused for
+    #   reset_timeout seconds, then a single trial call decides whether things are back to normal.
+    # only used from the event loop thread, so there's no locking
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            # a failed trial call starts the wait all over again
+            self.opened_at = time.monotonic()
+
+    def cancelled(self):
+        # a call that never got an answer says nothing about the upstream, unless it was the trial: that counts as
+        #   failed, or the breaker would be left waiting on it for good
+        if self._trial:
+            self.failure()
+
+
+class AsyncTranslator(object):
+    # asyncio counterpart of app.translate.translate_many.  it shares the translation cache with the sync path, caps
+    #   how many upstream calls are open at once, and only asks once for a text that's already on its way.
+    # fetch(url, params, headers, json_body) is a coroutine returning (status, content); the default uses httpx
+    def __init__(self, app, fetch=None):
+        self.app = app
+        self.config = app.config
+        self.cache = app.translation_cache
+        self.breaker = CircuitBreaker(app.config['MS_TRANSLATOR_BREAKER_THRESHOLD'],
+                                      app.config['MS_TRANSLATOR_BREAKER_RESET'])
+        self.concurrency = app.config['ASYNC_TRANSLATOR_CONCURRENCY']
+        self._semaphore = None
+        self._inflight = {}
+        self._client = None
+
+        if fetch is None:
+            try:
+                import httpx
+            except ImportError:
+                raise RuntimeError('the httpx package is needed for async translations')
+            self._client = httpx.AsyncClient(timeout=app.config['MS_TRANSLATOR_TIMEOUT'],
+                                             limits=httpx.Limits(max_connections=self.concurrency,
+                                                                 max_keepalive_connections=self.concurrency))
+            fetch = self._fetch
+        self.fetch = fetch
+
+    async def _fetch(self, url, params, headers, body):
+        r = await self._client.post(url, params=params, headers=headers, json=body)
+        return r.status_code, r.content
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+    @property
+    def semaphore(self):
+        # created on first use so it belongs to the loop that's actually running
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def translate(self, text, source_language, dest_language, accept_language=None):
+        return (await self.translate_many([text], source_language, dest_language, accept_language))[0]
+
+    async def translate_many(self, texts, source_language, dest_language, accept_language=None):
+        # error messages come back in the language the caller's Accept-Language header asks for
+        if not self.config.get('MS_TRANSLATOR_KEY'):
+            return self.localize([TranslationError(_l('Error: Translation service is not configured.'))] * len(texts),
+                                 accept_language)
+
+        loop = asyncio.get_running_loop()
+        unique = list(dict.fromkeys(texts))
+        keys = [cache_key(text, source_language, dest_language) for text in unique]
+        cached = await self.cache_get_many(keys)
+
+        results = {}
+        waiting = {}
+        to_send = []
+        for text, key, result in zip(unique, keys, cached):
+            if result is not None:
+                results[text] = result
+            elif key in self._inflight:
+                waiting[text] = self._inflight[key]  # somebody else is already asking for this one
+            else:
+                waiting[text] = self._inflight[key] = loop.create_future()
+                to_send.append((text, key, waiting[text]))
+
+        if to_send:
+            await asyncio.gather(*(self._send(to_send[i:i + BATCH_SIZE], source_language, dest_language)
+                                   for i in range(0, len(to_send), BATCH_SIZE)))
+
+        for text, future in waiting.items():
+            # shielded, so a client that goes away doesn't cancel the answer for everybody else waiting on it
+            results[text] = await asyncio.shield(future)
+
+        return self.localize([results[text] for text in texts], accept_language)
+
+    def localize(self, results, accept_language):
+        # errors are passed around untranslated, since one upstream call can be answering callers who speak
+        #   different languages, and only put into words here, in a request context for this caller's locale
+        if not any(isinstance(result, TranslationError) for result in results):
+            return results
+        with self.app.test_request_context(headers={'Accept-Language': accept_language or ''}):
+            return [str(result) if isinstance(result, TranslationError) else result for result in results]
+
+    async def cache_get_many(self, keys):
+        # shared caches (sqlite, redis) are read from a thread, so a slow one doesn't hold up the event loop
+        if self.cache is None:
+            return [None] * len(keys)
+        if isinstance(self.cache, LRUCache):
+            return [self.cache.get(key) for key in keys]
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: [self.cache.get(key) for key in keys])
+
+    async def cache_set_many(self, items):
+        if self.cache is None:
+            return
+        if isinstance(self.cache, LRUCache):
+            for key, value in items:
+                self.cache.set(key, value)
+            return
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: [self.cache.set(key, value) for key, value in items])
+
+    async def _send(self, pending, source_language, dest_language):
+        texts = [text for text, key, future in pending]
+        results = [TranslationError(_l('Error: Translation service failed.'))] * len(texts)
+        try:
+            r = await self._request(texts, source_language, dest_language)
+            if isinstance(r, TranslationError):
+                # don't cache it
+                results = [r] * len(texts)
+            else:
+                results = r
+                await self.cache_set_many([(key, result) for (text, key, future), result in zip(pending, results)])
+        finally:
+            # runs on cancellation too, so nobody is left waiting on a future that will never finish
+            for (text, key, future), result in zip(pending, results):
+                self._inflight.pop(key, None)
+                if not future.done():
+                    future.set_result(result)
+
+    async def _request(self, texts, source_language, dest_language):
+        # returns a list of translations, or a TranslationError
+        with self.app.app_context():
+            url, params, headers, body = request_payload(texts, source_language, dest_language)
+
+        async with self.semaphore:
+            # checked once there's a free slot, since the breaker may have opened while this call was queued
+            if not self.breaker.allow():
+                return TranslationError(_l('Error: Translation service is unavailable, try again later.'))
+            answered = False
+            try:
+                status, content = await asyncio.wait_for(self.fetch(url, params, headers, body),
+                                                         self.config['MS_TRANSLATOR_TIMEOUT'])
+                answered = True
+            except Exception:
+                # timeouts and connection errors
+                self.breaker.failure()
+                return TranslationError(_l('Error: Translation service failed.'))
+            finally:
+                if not answered:
+                    # cancelled (the client went away): since python 3.8 that isn't an Exception
+                    self.breaker.cancelled()
+
+        if status == 429 or status >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()  # a 4xx means the request was bad, not the service
+
+        if status != 200:
+            return TranslationError(_l('Error: Translation service failed. '), content.decode('utf-8', 'replace'))
+        try:
+            translations = parse_response(content)
+        except (ValueError, LookupError, TypeError):
+            # a 200 with a body that isn't what the API documents
+            return TranslationError(_l('Error: Translation service failed.'))
+        if len(translations) != len(texts):
+            return TranslationError(_l('Error: Translation service failed.'))
+        return translations
+
+
+class TranslationError(object):
+    # an error message for a translation, put into words (and the caller's language) by str()
+    def __init__(self, message, detail=''):
+        self.message = message
+        self.detail = detail
+
+    def __str__(self):
+        return str(self.message) + self.detail
+
+
+class TranslationApp(object):
+    # ASGI app that answers /translate and /translate_batch on the event loop, so a slow translation API doesn't tie up
+    #   a worker per click.  everything else goes to `fallback`, normally the Flask app wrapped in asgiref's WsgiToAsgi
+    #   (see asgi.py at the top of the repo)
+    def __init__(self, app, fallback=None, translator=None):
+        self.app = app
+        self.fallback = fallback
+        self.translator = translator or AsyncTranslator(app)
+        self.routes = {'/translate': self.translate, '/translate_batch': self.translate_batch}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in self.routes:
+            await self.routes[scope['path']](scope, receive, send)
+        elif self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        else:
+            await self.respond(send, 404, {'error': 'not found'})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.translator.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def translate(self, scope, receive, send):
+        data = await self.read_request(scope, receive, send)
+        if data is None:
+            return
+        try:
+            text, source_language, dest_language = data['text'], data['source_language'], data['dest_language']
+        except KeyError:
+            await self.respond(send, 400, {'error': 'text, source_language and dest_language are required'})
+            return
+
+        result = await self.translator.translate(text, source_language, dest_language,
+                                                 request_headers(scope).get('accept-language'))
+        await self.respond(send, 200, {'text': result})
+
+    async def translate_batch(self, scope, receive, send):
+        # same contract as the Flask view in app/main/routes.py, but the languages are translated concurrently
+        data = await self.read_request(scope, receive, send)
+        if data is None:
+            return
+
+        dest_language = data.get('dest_language')
+        accept_language = request_headers(scope).get('accept-language')
+        groups = list(batch_by_language(data.get('items')).values()) if dest_language else []
+        results = await asyncio.gather(*(
+            self.translator.translate_many([item['text'] for item in group], group[0]['source_language'],
+                                           dest_language, accept_language)
+            for group in groups))
+
+        translations = {}
+        for group, translated in zip(groups, results):
+            translations.update((str(item['id']), text) for item, text in zip(group, translated))
+        await self.respond(send, 200, {'translations': translations})
+
+    async def read_request(self, scope, receive, send):
+        # checks the login and reads the form or json body; responds with an error and returns None if that fails
+        headers = request_headers(scope)
+        if self.user_id(headers.get('cookie')) is None:
+            await self.respond(send, 401, {'error': 'login required'})
+            return None
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(body) > MAX_BODY_SIZE:
+                await self.respond(send, 413, {'error': 'request too large'})
+                return None
+
+        try:
+            if headers.get('content-type', '').startswith('application/json'):
+                data = json.loads(body.decode('utf-8'))
+            else:
+                data = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await self.respond(send, 400, {'error': 'malformed request'})
+            return None
+        return data
+
+    def user_id(self, cookie_header):
+        return session_user_id(self.app, cookie_header)
+
+    async def respond(self, send, status, payload):
+        await send_json(send, status, payload)
+
+
+class StreamApp(object):
+    # ASGI app that serves the /stream server-sent events on the event loop.  under WSGI every open stream holds a
+    #   thread; here an idle one is just a queue and a timer, so a process can keep thousands of home pages
+    #   listening.  everything else goes to `fallback`
+    def __init__(self, app, fallback=None):
+        self.app = app
+        self.fallback = fallback
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/stream'
+                and self.app.config['SSE_ENABLED']):
+            await self.stream(scope, receive, send)
+        elif self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        elif scope['type'] == 'http':
+            await send_json(send, 404, {'error': 'not found'})
+
+    async def stream(self, scope, receive, send):
+        from app.main.stream import backlog, post_event, sse_event, stream_channels
+
+        headers = request_headers(scope)
+        user_id = session_user_id(self.app, headers.get('cookie'))
+        if user_id is None:
+            await send_json(send, 401, {'error': 'login required'})
+            return
+
+        def in_app_context(f, *args):
+            # the database work runs in a thread, like the WSGI view
+            with self.app.app_context():
+                return f(*args)
+
+        config = self.app.config
+        hub = self.app.pubsub
+        loop = asyncio.get_running_loop()
+        channels = await loop.run_in_executor(None, in_app_context, stream_channels, int(user_id))
+        # subscribed here on the loop's thread, where the subscription's asyncio queue has to be made (before
+        #   python 3.10 it binds to the current thread's loop), and before the backlog is read, so nothing
+        #   published in between gets lost
+        subscription = hub.subscribe(channels, loop=loop)
+        watcher = None
+        try:
+            missed = await loop.run_in_executor(None, in_app_context, backlog, int(user_id),
+                                                headers.get('last-event-id'))
+            watcher = loop.create_task(wait_for_disconnect(receive))
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                    (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+            await send_event(send, 'retry: {:d}\n\n'.format(config['SSE_RETRY']))
+            for id, author in missed:
+                await send_event(send, post_event({'id': id, 'author': author}))
+
+            deadline = loop.time() + config['SSE_MAX_AGE']
+            while not watcher.done() and loop.time() < deadline:
+                message = await subscription.aget(min(config['SSE_HEARTBEAT'], deadline - loop.time()))
+                if subscription.overflowed:
+                    await send_event(send, sse_event('reset', {}))
+                    break
+                await send_event(send, post_event(message) if message is not None else ': keepalive\n\n')
+            if not watcher.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            hub.unsubscribe(subscription)
+            if watcher is not None:
+                watcher.cancel()
+
+
+def request_headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_event(send, event):
+    await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def session_user_id(app, cookie_header):
+    # the logged-in user, read straight out of Flask's signed session cookie (or Flask-Login's remember cookie)
+    #   so that authentication doesn't need a trip through the WSGI app
+    if not cookie_header:
+        return None
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header)
+    except Exception:
+        return None
+
+    session_cookie = cookies.get(app.session_cookie_name)
+    if session_cookie is not None:
+        serializer = app.session_interface.get_signing_serializer(app)
+        try:
+            session = serializer.loads(session_cookie.value,
+                                       max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            session = {}
+        if session.get('user_id'):
+            return session['user_id']
+
+    remember_cookie = cookies.get(app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+    if remember_cookie is not None:
+        with app.app_context():
+            return decode_cookie(remember_cookie.value)
+    return None
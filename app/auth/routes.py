@@ -23,6 +23,11 @@ def login():
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
 
+        if user.password_needs_rehash():
+            # hashed with older settings; this is the only time the plain password is around to redo it
+            user.set_password(form.password.data)
+            db.session.commit()
+
         login_user(user, remember=form.remember_me.data)
         # grab the user's desired page from the querystring
         next_page = request.args.get('next')
@@ -68,6 +73,7 @@ def reset_password_request():
         user = User.query.filter_by(email=form.email.data).first()
         if user:
             send_password_reset_email(user)
+            db.session.commit()
         flash(_('Check your email to reset your password'))
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password_request.html', title=_('Reset Password'), form=form)
@@ -0,0 +1,152 @@
+import hashlib
+import hmac
+import pickle
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # small thread-safe in-process cache.  entries fall out when they're the least recently used once maxsize is
+    #   reached, or when they're older than ttl seconds (None keeps them until they're pushed out).
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, None if ttl is None else time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class Signer(object):
+    # pickles values for the shared backends, with an HMAC of the pickle in front.  anybody who can write to the
+    #   sqlite file or the redis server could otherwise have the app unpickle (run) whatever they put there;
+    #   anything that isn't signed with our key is treated as a miss instead
+    def __init__(self, secret):
+        if not secret:
+            raise ValueError('a secret is needed to sign values in a shared cache')
+        self.key = secret.encode('utf-8') if isinstance(secret, str) else secret
+
+    def dumps(self, value):
+        data = pickle.dumps(value)
+        return hmac.new(self.key, data, hashlib.sha256).digest() + data
+
+    def loads(self, signed, default=None):
+        signed = bytes(signed)
+        mac, data = signed[:32], signed[32:]
+        if not hmac.compare_digest(mac, hmac.new(self.key, data, hashlib.sha256).digest()):
+            return default
+        return pickle.loads(data)
+
+
+class SQLiteCache(object):
+    # cache kept in a sqlite file, so it survives restarts and is shared by every worker on the machine
+    def __init__(self, path, ttl=None, secret=None):
+        self.path = path
+        self.ttl = ttl
+        self.signer = Signer(secret)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads, so each thread gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self._connect().execute('SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                                      (repr(key), time.time())).fetchone()
+        return default if row is None else self.signer.loads(row[0], default)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                         (repr(key), self.signer.dumps(value), None if ttl is None else time.time() + ttl))
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))  # tidy up now and then
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (repr(key),))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache')
+
+
+class RedisCache(object):
+    # cache on a redis (or redis-compatible) server, shared by every process that points at it
+    def __init__(self, url, ttl=None, prefix='microblog:', secret=None):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('the redis package is needed for a redis:// cache URL')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.signer = Signer(secret)
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + repr(key))
+        return default if value is None else self.signer.loads(value, default)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + repr(key), self.signer.dumps(value), ex=None if ttl is None else int(ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + repr(key))
+
+    def clear(self):
+        for name in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(name)
+
+
+def create_cache(url, maxsize=1024, ttl=None, prefix='microblog:', secret=None):
+    # 'memory' for a per-process LRU, 'sqlite:///path/to/file.db', or 'redis://host:port/db'.  the shared ones
+    #   sign what they store with `secret` (the app's SECRET_KEY)
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):], ttl, secret)
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisCache(url, ttl, prefix, secret)
+    if url == 'memory':
+        return LRUCache(maxsize, ttl)
+    raise ValueError('unknown cache URL: {}'.format(url))
@@ -1,5 +1,11 @@
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import click
+from flask import current_app
+from app.language import detect_languages
+from app.models import Post, SearchableMixin, rebuild_timelines, recount_users
+from app.search import new_index_name
 
 
 def register(app):
@@ -34,3 +40,110 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def timeline():
+        """Precomputed home timeline commands."""
+        pass
+
+    @timeline.command()
+    def rebuild():
+        """Rebuild every user's precomputed home timeline."""
+        rebuild_timelines()
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.argument('index', default='post')
+    @click.option('--into', help='Physical index to write to; pass the one from an interrupted run to resume it.')
+    @click.option('--start-id', default=0, help='Only index rows with an id above this one.')
+    @click.option('--chunk-size', default=1000, help='Rows per database fetch and bulk request.')
+    @click.option('--threads', default=4, help='Bulk requests to run in parallel.')
+    @click.option('--keep-old', is_flag=True, help='Don\'t delete the previous index after the alias swap.')
+    def reindex(index, into, start_id, chunk_size, threads, keep_old):
+        """Rebuild a search index from the database without taking search offline."""
+
+        models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+        if index not in models:
+            raise click.BadParameter('not a searchable table: {}'.format(index))
+        model = models[index]
+        into = into or new_index_name(index)
+
+        total = model.query.filter(model.id > start_id).count()
+        with click.progressbar(length=total, label='Indexing {}'.format(index)) as bar:
+            last = {'id': start_id}
+
+            def progress(count, id):
+                last['id'] = id
+                bar.update(count)
+
+            try:
+                model.reindex(into=into, start_id=start_id, chunk_size=chunk_size, threads=threads,
+                              keep_old=keep_old, progress=progress)
+            except (Exception, KeyboardInterrupt):
+                click.echo('\nInterrupted; resume with: flask search reindex {} --into {} --start-id {}'.format(
+                    index, into, last['id']), err=True)
+                raise
+
+        click.echo('Reindexed {}'.format(index))
+
+    @app.cli.group()
+    def posts():
+        """Post maintenance commands."""
+        pass
+
+    @posts.command('detect-languages')
+    @click.option('--all', 'redo', is_flag=True, help='Detect every post again, not just the ones without a language.')
+    @click.option('--processes', default=os.cpu_count() or 1, help='Worker processes to detect languages in.')
+    @click.option('--chunk-size', default=1000, help='Posts per database fetch and UPDATE.')
+    def detect_languages_command(redo, processes, chunk_size):
+        """Fill in the language of existing posts."""
+        query = Post.query if redo else Post.query.filter(Post.language.is_(None))
+        with click.progressbar(length=query.count(), label='Detecting languages') as bar, \
+                ProcessPoolExecutor(processes) as executor:
+            total = detect_languages(executor, redo=redo, chunk_size=chunk_size,
+                                     progress=lambda count, id: bar.update(count))
+        click.echo('Detected the language of {} posts'.format(total))
+
+    @app.cli.group()
+    def users():
+        """User maintenance commands."""
+        pass
+
+    @users.command()
+    def recount():
+        """Recompute follower, following and post counts for every user."""
+        click.echo('Repaired counts for {} users'.format(recount_users()))
+
+    @app.cli.group()
+    def mail():
+        """Outgoing mail queue commands."""
+        pass
+
+    @mail.command()
+    @click.option('--drain', is_flag=True, help='Exit once nothing is due instead of waiting for more mail.')
+    def work(drain):
+        """Send queued emails from this process."""
+        queue = current_app.mail_queue
+        if drain:
+            total = 0
+            while True:
+                sent = queue.process()
+                if not sent:
+                    break
+                total += sent
+            click.echo('Handled {} queued emails'.format(total))
+            return
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=queue.run, args=(stop,), daemon=True) for _ in range(queue.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                stop.wait(1)
+        except KeyboardInterrupt:
+            stop.set()
@@ -0,0 +1,208 @@
+import random
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event as db_event, exc, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from app.metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # windows: the write lock only covers threads in this process
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long each checkout waited for a free connection, so a pool that's too small shows
+    #   up as wait time instead of as mysteriously slow requests
+    label = 'primary'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            metrics.increment('db.pool.timeouts', pool=self.label)
+            raise
+        finally:
+            metrics.observe('db.pool.checkout_wait_seconds', time.perf_counter() - start, pool=self.label)
+
+
+class RoutingSession(SignallingSession):
+    # sends the reads of views marked @read_replica to a randomly picked replica.  everything else stays on the
+    #   primary: writes, reads inside a transaction that has written, and every read for a user who committed a
+    #   write within the last DATABASE_READ_YOUR_WRITES seconds, so people always see their own changes despite lag
+    wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            # INSERT/UPDATE/DELETE run through session.execute()
+            self.wrote = True
+            self.lock_writes()
+        if self._flushing or self.wrote or not self.use_replica():
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        return self.app.extensions['sqlalchemy'].db.get_engine(self.app, random.choice(replica_binds(self.app)))
+
+    def use_replica(self):
+        if not has_request_context() or not g.get('read_replica') or not replica_binds(self.app):
+            return False
+        last_write = flask_session.get('_db_last_write')
+        return last_write is None or time.time() - last_write >= self.app.config['DATABASE_READ_YOUR_WRITES']
+
+    def flush(self, objects=None):
+        if self.new or self.dirty or self.deleted:
+            self.wrote = True
+            self.lock_writes()
+        super(RoutingSession, self).flush(objects)
+
+    def commit(self):
+        try:
+            super(RoutingSession, self).commit()
+        finally:
+            self.unlock_writes()
+        if self.wrote and has_request_context() and replica_binds(self.app) and \
+                request.cookies.get(self.app.session_cookie_name):
+            # from here on it's the timestamp in the user's session that keeps their reads on the primary.  only
+            #   for clients that send the session cookie back; anybody else would just get a useless Set-Cookie
+            flask_session['_db_last_write'] = time.time()
+        self.wrote = False
+
+    def rollback(self):
+        try:
+            super(RoutingSession, self).rollback()
+        finally:
+            self.unlock_writes()
+        self.wrote = False
+
+    def close(self):
+        try:
+            super(RoutingSession, self).close()
+        finally:
+            self.unlock_writes()
+
+    def lock_writes(self):
+        # in sqlite single-writer mode the first write of a transaction waits its turn, and the transaction keeps
+        #   the lock until it commits or rolls back, so two writers never meet inside sqlite
+        if getattr(self, '_write_lock', None) is None:
+            lock = getattr(self.app.extensions['sqlalchemy'].db.get_engine(self.app), 'write_lock', None)
+            if lock is not None:
+                lock.acquire()
+                self._write_lock = lock
+
+    def unlock_writes(self):
+        lock = getattr(self, '_write_lock', None)
+        if lock is not None:
+            self._write_lock = None
+            lock.release()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # sqlite gets the static or null pool Flask-SQLAlchemy picks for it, unless it's in SQLITE_OPTIMIZE mode;
+        #   real servers get a sized, timed pool
+        if sa_url.drivername == 'sqlite' and app.config['SQLITE_OPTIMIZE'] and sa_url.database not in (
+                None, '', ':memory:'):
+            # keep connections (and the pragmas set on them) around instead of reconnecting for every checkout
+            options.setdefault('poolclass', type('TimedQueuePool', (TimedQueuePool,), {'label': 'sqlite'}))
+            options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', app.config['DATABASE_POOL_TIMEOUT'])
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        elif sa_url.drivername != 'sqlite':
+            options.setdefault('poolclass', type('TimedQueuePool', (TimedQueuePool,), {
+                'label': '{}/{}'.format(sa_url.host, sa_url.database)}))
+            options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', app.config['DATABASE_POOL_TIMEOUT'])
+            options.setdefault('pool_recycle', app.config['DATABASE_POOL_RECYCLE'])
+            options.setdefault('pool_pre_ping', app.config['DATABASE_POOL_PRE_PING'])
+        return super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        app = self.get_app()
+        if sa_url.drivername == 'sqlite' and app.config['SQLITE_OPTIMIZE']:
+            db_event.listen(engine, 'connect', sqlite_pragmas(app.config))
+            if app.config['SQLITE_SINGLE_WRITER'] and sa_url.database not in (None, '', ':memory:'):
+                engine.write_lock = WriteLock(sa_url.database + '-writelock')
+        return engine
+
+    def pool_status(self, app=None):
+        # connections in use and overflowing per engine, for whatever reports on the app's health
+        app = self.get_app(app)
+        status = {}
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            pool = self.get_engine(app, bind).pool
+            if isinstance(pool, QueuePool):
+                status[bind or 'primary'] = {'size': pool.size(), 'checked_out': pool.checkedout(),
+                                             'overflow': pool.overflow()}
+        return status
+
+
+def sqlite_pragmas(config):
+    # WAL lets readers carry on while somebody writes; NORMAL sync is still safe under WAL (a power cut can lose the
+    #   last commits, not corrupt the file); busy_timeout makes a blocked writer wait instead of failing straight
+    #   away with 'database is locked'
+    pragmas = ['PRAGMA journal_mode=WAL',
+               'PRAGMA synchronous=NORMAL',
+               'PRAGMA busy_timeout={:d}'.format(config['SQLITE_BUSY_TIMEOUT']),
+               'PRAGMA cache_size={:d}'.format(-config['SQLITE_CACHE_SIZE']),  # negative means KiB, not pages
+               'PRAGMA mmap_size={:d}'.format(config['SQLITE_MMAP_SIZE'])]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return set_pragmas
+
+
+class WriteLock(object):
+    # one writer at a time: a thread lock for this process, plus an flock on a file next to the database for
+    #   every other process using it
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        try:
+            if fcntl is not None:
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+        metrics.observe('db.sqlite.write_lock_wait_seconds', time.perf_counter() - start)
+
+    def release(self):
+        try:
+            if self._file is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+
+def replica_binds(app):
+    return [bind for bind in app.config.get('SQLALCHEMY_BINDS') or {} if bind.startswith('replica')]
+
+
+def read_replica(f):
+    # marks a view whose GET requests only read, so they may be answered from a replica.  read-your-writes rides
+    #   on the session cookie, so this is for views browsers use; the api's token clients stay on the primary
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'GET':
+            g.read_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
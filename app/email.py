@@ -1,19 +1,171 @@
-from threading import Thread
+import json
+import logging
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
 from flask import current_app
 from flask_mail import Message
-from app import mail
+from app import db, mail
+from app.metrics import metrics
+from app.models import OutboundEmail
 
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+logger = logging.getLogger(__name__)
 
 
 # to use a virtual server instead: python -m smtpd -n -c DebuggingServer localhost:8025
 def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
+    # messages are written to the outbound_email table and sent by the mail queue workers, so they survive a restart
+    #   and a burst of them doesn't turn into a burst of threads and smtp connections.  the row is only added to the
+    #   session: it's saved by the caller's commit, along with whatever it goes with, and the queue is woken then
+    db.session.add(OutboundEmail(subject=subject, sender=sender, recipients=json.dumps(list(recipients)),
+                                 text_body=text_body, html_body=html_body))
+
+
+def collect_new_emails(session, flush_context):
+    queued = sum(1 for obj in session.new if isinstance(obj, OutboundEmail))
+    if queued:
+        session._queued_emails = (getattr(session, '_queued_emails', None) or 0) + queued
+
+
+def wake_mail_queue(session):
+    queued = getattr(session, '_queued_emails', None)
+    session._queued_emails = None
+    if queued:
+        metrics.increment('mail.queued', queued)
+        current_app.mail_queue.wake()
+
+
+def forget_new_emails(session):
+    session._queued_emails = None
+
+
+db.event.listen(db.session, 'after_flush', collect_new_emails)
+db.event.listen(db.session, 'after_commit', wake_mail_queue)
+db.event.listen(db.session, 'after_rollback', forget_new_emails)
+
+
+class MailQueue(object):
+    # a fixed pool of worker threads that claim due rows from outbound_email and send them in batches, each batch
+    #   over a single smtp connection.  failures are retried with exponential backoff until max_attempts.
+    # delivery is at-least-once: a worker that dies mid-batch leaves its rows claimed, and they're picked up again
+    #   once claim_timeout has passed
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['MAIL_QUEUE_WORKERS']
+        self.batch_size = app.config['MAIL_QUEUE_BATCH_SIZE']
+        self.poll_interval = app.config['MAIL_QUEUE_POLL_INTERVAL']
+        self.max_attempts = app.config['MAIL_QUEUE_MAX_ATTEMPTS']
+        self.backoff = app.config['MAIL_QUEUE_BACKOFF']
+        self.claim_timeout = app.config['MAIL_QUEUE_CLAIM_TIMEOUT']
+
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def wake(self):
+        # the threads are only started once there's something to send
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self.run, name='mail-queue-{}'.format(len(self._threads)),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def run(self, stop=None):
+        # keeps sending until stop (a threading.Event) is set; also polls, for retries and rows queued elsewhere
+        while stop is None or not stop.is_set():
+            try:
+                sent = self.process()
+            except Exception:
+                logger.exception('mail queue pass failed')
+                sent = 0
+            if not sent:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+
+    def process(self):
+        # claims and sends one batch; returns how many rows it handled
+        with self.app.app_context():
+            try:
+                rows = self.claim()
+                if rows:
+                    self.deliver(rows)
+                return len(rows)
+            finally:
+                db.session.remove()
+
+    def due(self, now):
+        t = OutboundEmail.__table__
+        return db.or_(db.and_(t.c.status == OutboundEmail.QUEUED, t.c.next_attempt_at <= now),
+                      db.and_(t.c.status == OutboundEmail.SENDING,
+                              t.c.claimed_at < now - timedelta(seconds=self.claim_timeout)))
+
+    def claim(self):
+        # the conditional UPDATE is what makes a claim stick: if another worker (or process) got to a row first it
+        #   no longer matches, so every row goes to exactly one claimant without needing SELECT ... FOR UPDATE
+        t = OutboundEmail.__table__
+        now = datetime.utcnow()
+        ids = [row.id for row in db.session.execute(
+            db.select([t.c.id]).where(self.due(now)).order_by(t.c.next_attempt_at).limit(self.batch_size))]
+        if not ids:
+            return []
+
+        token = uuid.uuid4().hex
+        db.session.execute(t.update().where(t.c.id.in_(ids)).where(self.due(now)).values(
+            status=OutboundEmail.SENDING, claimed_by=token, claimed_at=now))
+        db.session.commit()
+        return OutboundEmail.query.filter_by(claimed_by=token, status=OutboundEmail.SENDING).all()
+
+    def deliver(self, rows):
+        remaining = list(rows)
+        try:
+            with mail.connect() as connection:
+                metrics.increment('mail.connections')
+                while remaining:
+                    row = remaining[0]
+                    start = time.time()
+                    try:
+                        connection.send(self.message(row))
+                    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                        # the server turned down this one message; the connection is still good
+                        self.retry(row, e)
+                    else:
+                        row.status = OutboundEmail.SENT
+                        row.sent_at = datetime.utcnow()
+                        row.attempts += 1
+                        metrics.increment('mail.sent')
+                        metrics.observe('mail.send_seconds', time.time() - start)
+                        metrics.observe('mail.queue_seconds', (row.sent_at - row.created_at).total_seconds())
+                    remaining.pop(0)
+        except Exception as e:
+            # couldn't connect, or the connection dropped; everything not yet sent tries again later
+            logger.warning('mail queue: smtp connection failed: %s', e)
+            for row in remaining:
+                self.retry(row, e)
+        finally:
+            db.session.commit()
+
+    def retry(self, row, error):
+        row.attempts += 1
+        row.last_error = '{}: {}'.format(type(error).__name__, error)
+        row.claimed_by = None
+        if row.attempts >= self.max_attempts:
+            row.status = OutboundEmail.FAILED
+            metrics.increment('mail.failed')
+            logger.error('mail queue: giving up on email %s after %d attempts', row.id, row.attempts)
+        else:
+            row.status = OutboundEmail.QUEUED
+            row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff * 2 ** (row.attempts - 1))
+            metrics.increment('mail.retried')
 
-    # mail.send(msg)
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    @staticmethod
+    def message(row):
+        msg = Message(row.subject, sender=row.sender, recipients=json.loads(row.recipients))
+        msg.body = row.text_body
+        msg.html = row.html_body
+        return msg
@@ -1,15 +1,36 @@
-from flask import render_template
+from flask import render_template, request
+from werkzeug.exceptions import HTTPException
 from app import db
+from app.api.errors import error_response as api_error_response
 from app.errors import bp
 
 
+def wants_json_response():
+    # api clients get their errors as json too.  only under /api: an Accept header alone would hand json to
+    #   browsers and crawlers hitting the regular pages, and vary cached error pages on it
+    return request.blueprint == 'api' or request.path.startswith('/api/')
+
+
 @bp.app_errorhandler(404)
 def not_found_error(error):
+    if wants_json_response():
+        return api_error_response(404)
     return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(HTTPException)
+def http_error(error):
+    # everything else (405, 413, abort(400), ...) without a page of its own: json for the api, werkzeug's
+    #   default page for everybody else
+    if wants_json_response() and error.code:
+        return api_error_response(error.code, error.description)
+    return error
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     # roll back any un-committed db changes
     db.session.rollback()
+    if wants_json_response():
+        return api_error_response(500)
     return render_template('errors/500.html'), 500
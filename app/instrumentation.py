@@ -0,0 +1,210 @@
+import cProfile
+import hmac
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from flask import Response, abort, before_render_template, current_app, g, has_app_context, has_request_context, \
+    request, template_rendered
+from sqlalchemy.engine import Engine
+from app import db
+from app.metrics import metrics
+
+# Server-Timing names for the parts of a request that get timed
+SERVER_TIMING = [('sql', 'SQL'), ('tpl', 'Templates'), ('es', 'Elasticsearch'), ('translate', 'Translator')]
+
+
+def init_app(app):
+    # opt-in: with INSTRUMENTATION on, every request records its wall time, SQL statements, template rendering and
+    #   calls out to elasticsearch and the translator; it all comes back as a Server-Timing header, and is summed
+    #   up for Prometheus at /metrics.  that's only there with a METRICS_TOKEN to protect it: it gives away every
+    #   endpoint's traffic and timings
+    if not app.config['INSTRUMENTATION']:
+        return
+
+    listen()
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if app.config['METRICS_TOKEN']:
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+_listening = False
+
+
+def listen():
+    # the listeners are global (every engine, every app) and check per app whether they're wanted
+    global _listening
+    if _listening:
+        return
+    _listening = True
+
+    db.event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    db.event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    before_render_template.connect(before_render)
+    template_rendered.connect(after_render)
+
+
+def enabled():
+    return has_app_context() and current_app.config['INSTRUMENTATION']
+
+
+def record(name, seconds, count=1):
+    # adds to the current request's Server-Timing totals, if there's a request being timed
+    if has_request_context() and 'timings' in g:
+        timing = g.timings.setdefault(name, [0, 0.0])
+        timing[0] += count
+        timing[1] += seconds
+
+
+@contextmanager
+def timed(name):
+    # times a call to something outside the app, e.g. `with timed('es'): ...`
+    if not enabled():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record(name, elapsed)
+        metrics.observe('{}.call_seconds'.format(name), elapsed)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if enabled():
+        record('sql', elapsed)
+        metrics.observe('db.query_seconds', elapsed)
+
+
+def before_render(sender, template, context, **extra):
+    if enabled() and has_request_context() and 'timings' in g:
+        # only the outermost template is timed, since it includes the time of everything rendered inside it
+        g.template_depth = g.get('template_depth', 0) + 1
+        if g.template_depth == 1:
+            g.template_start = time.perf_counter()
+
+
+def after_render(sender, template, context, **extra):
+    if enabled() and has_request_context() and g.get('template_depth'):
+        g.template_depth -= 1
+        if g.template_depth == 0:
+            elapsed = time.perf_counter() - g.template_start
+            record('tpl', elapsed)
+            metrics.observe('template.render_seconds', elapsed, template=template.name)
+
+
+def start_request():
+    g.timings = {}
+    g.request_start = time.perf_counter()
+
+    # a sample of requests run under the profiler; the profile is only kept if the request turns out to be slow
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if current_app.config['PROFILE_SLOW_REQUESTS'] and rate and random.random() < rate:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed >= current_app.config['PROFILE_SLOW_REQUESTS']:
+            save_profile(profiler, endpoint, elapsed)
+
+    metrics.increment('http.requests', endpoint=endpoint, method=request.method, status=str(response.status_code))
+    metrics.observe('http.request_seconds', elapsed, endpoint=endpoint)
+    sql = g.timings.get('sql', [0, 0.0])
+    metrics.observe('http.request_queries', sql[0], endpoint=endpoint)
+
+    timings = ['app;dur={:.1f}'.format(elapsed * 1000)]
+    for name, description in SERVER_TIMING:
+        if name in g.timings:
+            count, seconds = g.timings[name]
+            timings.append('{};desc="{} ({})";dur={:.1f}'.format(name, description, count, seconds * 1000))
+    response.headers.add('Server-Timing', ', '.join(timings))
+    return response
+
+
+def save_profile(profiler, endpoint, elapsed):
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    name = '{}-{}-{:.0f}ms.prof'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), endpoint, elapsed * 1000)
+    path = os.path.join(directory, name)
+    profiler.dump_stats(path)
+    current_app.logger.warning('slow request to %s took %.0fms; profile saved to %s', endpoint, elapsed * 1000, path)
+
+
+def metrics_view():
+    expected = 'Bearer ' + current_app.config['METRICS_TOKEN']
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected.encode('utf-8')):
+        abort(401)
+    return Response(prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
+def prometheus_name(name):
+    return 'microblog_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def prometheus_text():
+    # the metrics registry in the Prometheus text exposition format: counters as <name>_total, timings as
+    #   summaries (<name>_count and <name>_sum) plus a <name>_max gauge, and the connection pools as gauges
+    counters, timings = metrics.snapshot()
+    lines = []
+
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        metric = prometheus_name(name) + '_total'
+        lines.append('# TYPE {} counter'.format(metric))
+        for labels, value in sorted(by_name[name]):
+            lines.append('{}{} {}'.format(metric, prometheus_labels(labels), repr(float(value))))
+
+    by_name = {}
+    for (name, labels), value in timings.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        metric = prometheus_name(name)
+        lines.append('# TYPE {} summary'.format(metric))
+        for labels, (count, total, maximum) in sorted(by_name[name]):
+            lines.append('{}_count{} {}'.format(metric, prometheus_labels(labels), count))
+            lines.append('{}_sum{} {}'.format(metric, prometheus_labels(labels), repr(float(total))))
+        lines.append('# TYPE {}_max gauge'.format(metric))
+        for labels, (count, total, maximum) in sorted(by_name[name]):
+            lines.append('{}_max{} {}'.format(metric, prometheus_labels(labels), repr(float(maximum))))
+
+    pools = db.pool_status()
+    if pools:
+        for field in ['size', 'checked_out', 'overflow']:
+            metric = prometheus_name('db.pool.' + field)
+            lines.append('# TYPE {} gauge'.format(metric))
+            for pool in sorted(pools):
+                lines.append('{}{} {}'.format(metric, prometheus_labels([('pool', pool)]), pools[pool][field]))
+
+    return '\n'.join(lines) + '\n'
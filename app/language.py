@@ -0,0 +1,102 @@
+from contextlib import nullcontext
+from functools import lru_cache
+from flask import current_app, has_app_context
+import guess_language as guesser
+from app import db
+from app.models import Post
+from app.worker import CoalescingWorker
+
+
+def detect_language(text):
+    # the post's language code, or '' when it can't be told.  cheap cases first:
+    #   - plain ASCII can only be one of the latin languages, so the unicode block scan is skipped, and the
+    #     answer is memoized since short ASCII posts ('good morning everyone!') repeat a lot
+    #   - guess_language can't tell latin languages apart under MIN_LENGTH characters, so those aren't looked
+    #     at at all (other scripts give themselves away however short the text is)
+    text = ' '.join(text.split())
+    if text.isascii():
+        return latin_language(text) if len(text) >= guesser.MIN_LENGTH else ''
+    return language_code(guesser.guess_language(text))
+
+
+@lru_cache(maxsize=4096)
+def latin_language(text):
+    words = guesser.WORD_RE.findall(text[:guesser.MAX_LENGTH])
+    return language_code(guesser.check(words, guesser.ALL_LATIN))
+
+
+def language_code(language):
+    return '' if language == guesser.UNKNOWN or len(language) > 5 else language
+
+
+def create_language_detector(app):
+    # new posts are saved with language NULL and get it filled in from a background thread after they're
+    #   committed, so writing a post doesn't wait on detection.  anything left NULL by a restart is picked up by
+    #   `flask posts detect-languages`.
+    def detect(batch):
+        # in synchronous mode this runs inside the request's app context, which mustn't be popped (that would
+        #   remove the session that's in the middle of committing)
+        with nullcontext() if has_app_context() else app.app_context():
+            save_languages([(id, detect_language(body)) for id, (body, user_id) in batch])
+            if app.page_cache is not None:
+                # the translate links on cached pages depend on the language
+                app.page_cache.invalidate('explore', *{'user:{}'.format(user_id) for _, (_, user_id) in batch})
+
+    return CoalescingWorker('language-detector', detect, batch_size=app.config['LANGUAGE_DETECTION_BATCH_SIZE'],
+                            interval=app.config['LANGUAGE_DETECTION_INTERVAL'],
+                            synchronous=not app.config['LANGUAGE_DETECTION_ASYNC'])
+
+
+def collect_new_posts(session, flush_context):
+    # posts written without a language are queued for detection once their transaction commits
+    posts = getattr(session, '_detect_languages', None) or []
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.language is None:
+            posts.append((obj.id, obj.body or '', obj.user_id))
+    session._detect_languages = posts
+
+
+def queue_new_posts(session):
+    posts = getattr(session, '_detect_languages', None)
+    session._detect_languages = None
+    if posts:
+        for id, body, user_id in posts:
+            current_app.language_detector.put(id, (body, user_id))
+
+
+def forget_new_posts(session):
+    session._detect_languages = None
+
+
+db.event.listen(db.session, 'after_flush', collect_new_posts)
+db.event.listen(db.session, 'after_commit', queue_new_posts)
+db.event.listen(db.session, 'after_rollback', forget_new_posts)
+
+
+def save_languages(languages):
+    # one UPDATE statement, executed for the whole batch of (post id, language) pairs.  it runs on a connection of
+    #   its own, since in synchronous mode this happens inside the after_commit of the session that wrote the posts
+    if languages:
+        with db.engine.begin() as connection:
+            connection.execute(Post.__table__.update().where(Post.id == db.bindparam('pid')).values(
+                language=db.bindparam('lang')), [{'pid': id, 'lang': language} for id, language in languages])
+
+
+def detect_languages(executor, redo=False, chunk_size=1000, progress=None):
+    # backfills Post.language for every post that doesn't have one yet (or all of them with redo), detecting each
+    #   chunk across the executor's processes; returns how many posts were updated
+    query = Post.query.with_entities(Post.id, Post.body).order_by(Post.id)
+    if not redo:
+        query = query.filter(Post.language.is_(None))
+
+    done = last_id = 0
+    while True:
+        rows = query.filter(Post.id > last_id).limit(chunk_size).all()
+        if not rows:
+            return done
+        languages = executor.map(detect_language, [body or '' for _, body in rows], chunksize=64)
+        save_languages(list(zip([id for id, _ in rows], languages)))
+        done += len(rows)
+        last_id = rows[-1][0]
+        if progress:
+            progress(len(rows), last_id)
@@ -0,0 +1,199 @@
+import hashlib
+import uuid
+from datetime import datetime
+from flask import current_app, g, make_response, render_template, request, session
+from flask_login import current_user
+from jinja2 import Markup
+from app import db
+from app.cache import create_cache
+from app.main import bp
+from app.models import Post, page_generation
+
+
+class PageCache(object):
+    # rendered pages, filed under the current generation of the scope they depend on ('explore', 'user:<id>').
+    #   writes don't hunt down the pages they affect; they just start a new generation for the scope, and pages
+    #   cached under the old one are never looked up again.
+    # a generation is (random token, when it started).  tokens rather than counters, so a generation that's been
+    #   evicted or expired comes back as a brand new one instead of reviving old pages.
+    def __init__(self, cache, generations):
+        self.cache = cache
+        self.generations = generations
+
+    def generation(self, scope, newest=None):
+        # newest() gives the time a new generation should claim as its start, i.e. the newest post in the scope
+        generation = self.generations.get(scope)
+        if generation is None:
+            generation = self.generations.setdefault(
+                scope, (uuid.uuid4().hex, (newest() if newest else None) or datetime.utcnow()))
+        return generation
+
+    def invalidate(self, *scopes):
+        # the scope is part of every page's key, so the scopes a write touches can all share one new token
+        self.generations.update(scopes, (uuid.uuid4().hex, datetime.utcnow()))
+
+    def get(self, key):
+        return self.cache.get(('page',) + key)
+
+    def set(self, key, value):
+        self.cache.set(('page',) + key, value)
+
+
+class CacheGenerations(object):
+    # generations kept in a cache; only right for pages in a per-process cache if there's a single process
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, scope):
+        return self.cache.get(('generation', scope))
+
+    def setdefault(self, scope, generation):
+        self.cache.set(('generation', scope), generation)
+        return generation
+
+    def update(self, scopes, generation):
+        for scope in scopes:
+            self.cache.set(('generation', scope), generation)
+
+
+class DatabaseGenerations(object):
+    # generations kept in the page_generation table, for pages cached per process: a write has to start a new
+    #   generation for every worker straight away, or the others would go on serving the old pages (and 304s for
+    #   them) until they expired.  always read from the primary, since a replica may not have the write yet
+    def get(self, scope):
+        row = db.session.execute(db.select([page_generation.c.token, page_generation.c.started_at]).where(
+            page_generation.c.scope == scope), bind=db.get_engine()).first()
+        return None if row is None else (row.token, row.started_at)
+
+    def setdefault(self, scope, generation):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(page_generation.insert().values(
+                    scope=scope, token=generation[0], started_at=generation[1]))
+        except db.exc.IntegrityError:
+            return self.get(scope) or generation  # another process started one first
+        return generation
+
+    def update(self, scopes, generation):
+        # on a connection of its own, since this runs from after_commit hooks.  a scope without a row yet has no
+        #   cached pages to make stale, so there's nothing to insert
+        if scopes:
+            with db.engine.begin() as connection:
+                connection.execute(page_generation.update().where(page_generation.c.scope.in_(scopes)).values(
+                    token=generation[0], started_at=generation[1]))
+
+
+def create_page_cache(app):
+    if not app.config['PAGE_CACHE']:
+        return None
+
+    cache = create_cache(app.config['PAGE_CACHE'], maxsize=app.config['PAGE_CACHE_SIZE'],
+                         ttl=app.config['PAGE_CACHE_TTL'], prefix='microblog:page:', secret=app.config['SECRET_KEY'])
+    generations = app.config['PAGE_CACHE_GENERATIONS'] or (
+        'database' if app.config['PAGE_CACHE'] == 'memory' else 'cache')
+    if generations == 'database':
+        return PageCache(cache, DatabaseGenerations())
+    if generations == 'cache':
+        return PageCache(cache, CacheGenerations(cache))
+    raise ValueError('PAGE_CACHE_GENERATIONS should be database or cache, not {}'.format(generations))
+
+
+class CachedPage(object):
+    # what a view gets back from cached_page(): either a finished response (a cache hit or a 304), or a
+    #   store() to wrap its freshly rendered page with
+    def __init__(self, key=None, etag=None, last_modified=None, response=None):
+        self.key = key
+        self.etag = etag
+        self.last_modified = last_modified
+        self.response = response
+
+    def store(self, body):
+        if self.key is None:
+            return body
+        current_app.page_cache.set(self.key, (self.etag, self.last_modified, body))
+        return conditional_response(body, self.etag, self.last_modified)
+
+
+def cached_page(scope, posts):
+    # serves a read-mostly page from the page cache, or just its headers when the browser already has it.
+    #   `posts` is the query behind the page, used for Last-Modified when the scope has no generation yet.
+    # the key covers everything the page varies by: route, arguments, locale and who's looking at it (follow
+    #   buttons, the navbar).  pages with flashed messages waiting to be shown are never cached.
+    cache = current_app.page_cache
+    if cache is None or request.method != 'GET' or session.get('_flashes'):
+        return CachedPage()
+
+    token, last_modified = cache.generation(
+        scope, lambda: posts.order_by(None).with_entities(db.func.max(Post.timestamp)).scalar())
+    last_modified = last_modified.replace(microsecond=0)  # http dates only go down to the second
+    key = (request.endpoint, tuple(sorted(request.view_args.items())), tuple(sorted(request.args.items(multi=True))),
+           g.locale, current_user.get_id(), scope, token)
+    etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and request.if_modified_since and
+            request.if_modified_since.replace(tzinfo=None) >= last_modified):
+        return CachedPage(response=conditional_response(None, etag, last_modified, status=304))
+
+    cached = cache.get(key)
+    if cached is not None:
+        etag, last_modified, body = cached
+        return CachedPage(response=conditional_response(body, etag, last_modified))
+
+    return CachedPage(key, etag, last_modified)
+
+
+def conditional_response(body, etag, last_modified, status=200):
+    response = make_response(body or '', status)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # pages are per-user, so only the browser may keep them, and it has to check back before reusing one
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def create_fragment_cache(app):
+    if not app.config['FRAGMENT_CACHE']:
+        return None
+
+    return create_cache(app.config['FRAGMENT_CACHE'], maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                        ttl=app.config['FRAGMENT_CACHE_TTL'], prefix='microblog:fragment:',
+                        secret=app.config['SECRET_KEY'])
+
+
+def post_fingerprint(post):
+    # everything _post.html shows; a cached fragment whose fingerprint no longer matches is re-rendered, which
+    #   also catches an author renaming themselves or changing the email behind their avatar
+    author = post.author
+    return post.body, post.language, post.timestamp, author.username, author.email_digest
+
+
+@bp.app_template_global()
+def render_post(post):
+    # _post.html for one post, rendered once per locale and reused on every timeline the post shows up on.  nothing
+    #   in the fragment depends on who's looking at it, so viewers share the same copy.
+    cache = current_app.fragment_cache
+    if cache is None:
+        return Markup(render_template('_post.html', post=post))
+
+    key = ('post', post.id, g.locale)
+    fingerprint = post_fingerprint(post)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        return Markup(cached[1])
+
+    html = render_template('_post.html', post=post)
+    cache.set(key, (fingerprint, html))
+    return Markup(html)
+
+
+def forget_post(mapper, connection, post):
+    # edited and deleted posts drop their fragments straight away rather than waiting to be noticed
+    cache = current_app.fragment_cache
+    if cache is not None:
+        for locale in current_app.config['LANGUAGES']:
+            cache.delete(('post', post.id, locale))
+
+
+db.event.listen(Post, 'after_update', forget_post)
+db.event.listen(Post, 'after_delete', forget_post)
@@ -1,81 +1,102 @@
 # determines which page(s) to show for each browser request
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+import os
+import re
+import requests
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
 
 from app import db
+from app.database import read_replica
+from app.activity import update_last_seen
 from app.main import bp
+from app.main.caching import cached_page
 from app.main.forms import EditProfileForm, PostForm, SearchForm
-from app.models import User, Post
-from app.translate import translate
+from app.models import AVATAR_SIZES, User, Post, avatar_url
+from app.pagination import paginate_keyset
+from app.translate import translate, translate_many, batch_by_language
+
+
+def paginate_posts(query, endpoint, key=(Post.timestamp, Post.id), **kwargs):
+    # returns (posts, next_url, prev_url) for a timeline, using keyset cursors unless configured for page numbers
+    ppp = current_app.config['POSTS_PER_PAGE']
+
+    # every post on the page shows its author, so load them in the same query rather than one at a time
+    query = query.options(db.joinedload(Post.author))
+
+    if current_app.config['POSTS_PAGINATION'] == 'offset':
+        page = request.args.get('page', 1, type=int)
+        posts = query.order_by(None).order_by(key[0].desc(), key[1].desc()).paginate(page, ppp, False)
+        next_url = url_for(endpoint, page=posts.next_num, **kwargs) if posts.has_next else None
+        prev_url = url_for(endpoint, page=posts.prev_num, **kwargs) if posts.has_prev else None
+        return posts.items, next_url, prev_url
+
+    posts = paginate_keyset(query, key, request.args.get('cursor'), ppp)
+    next_url = url_for(endpoint, cursor=posts.next_cursor, **kwargs) if posts.has_next else None
+    prev_url = url_for(endpoint, cursor=posts.prev_cursor, **kwargs) if posts.has_prev else None
+    return posts.items, next_url, prev_url
 
 
 @bp.before_app_request
 def before_request():
+    if request.endpoint == 'static':
+        return
+
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        update_last_seen(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
-    # index all existing posts, if necessary
-    if current_app.elasticsearch:  # is elasticsearch running/enabled?
-        if len(current_app.elasticsearch.indices.get_alias().keys()) < 1:
-            Post.reindex()
-
 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])  # also map the /index URL to this same function
 @login_required  # require login to view the pages routed to this function
+@read_replica
 def index():
     form = PostForm()
 
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
-        db.session.commit()
+        post.fan_out()
+        db.session.commit()  # its language gets detected in the background, see app/language.py
         flash(_('Post created!'))
         return redirect(url_for('main.index'))
 
-    current_page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(current_page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    query, key = current_user.home_timeline()
+    posts, next_url, prev_url = paginate_posts(query, 'main.index', key=key)
 
-    return render_template('index.html', title=_('Home'), form=form, posts=posts.items,
+    return render_template('index.html', title=_('Home'), form=form, posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/explore')
 @login_required
+@read_replica
 def explore():
-    current_page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        current_page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    page = cached_page('explore', Post.query)
+    if page.response is not None:
+        return page.response
 
-    return render_template('index.html', title=_('Explore'), posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    posts, next_url, prev_url = paginate_posts(Post.query, 'main.explore')
+
+    return page.store(render_template('index.html', title=_('Explore'), posts=posts,
+                                      next_url=next_url, prev_url=prev_url))
 
 
 @bp.route('/user/<username>')
 @login_required
+@read_replica
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()  # if user isn't found, return a 404 error
 
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    page = cached_page('user:{}'.format(user.id), user.posts)
+    if page.response is not None:
+        return page.response
 
-    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url)
+    posts, next_url, prev_url = paginate_posts(user.posts, 'main.user', username=user.username)
+
+    return page.store(render_template('user.html', user=user, posts=posts, next_url=next_url, prev_url=prev_url))
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -141,8 +162,25 @@ def translate_text():
     return jsonify({'text': result})
 
 
+@bp.route('/translate_batch', methods=['POST'])
+@login_required
+def translate_batch():
+    # translates every post on a page at once: {'dest_language': 'en', 'items': [{'id', 'text', 'source_language'}]}
+    #   comes back as {'translations': {id: text}}, with one API call per source language
+    data = request.get_json(silent=True) or {}
+    dest_language = data.get('dest_language')
+    translations = {}
+    if dest_language:
+        for source_language, group in batch_by_language(data.get('items')).items():
+            results = translate_many([item['text'] for item in group], source_language, dest_language)
+            translations.update((str(item['id']), result) for item, result in zip(group, results))
+
+    return jsonify({'translations': translations})
+
+
 @bp.route('/search')
 @login_required
+@read_replica
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
@@ -156,3 +194,56 @@ def search():
     prev_url = url_for('main.search', q=q, page=page-1) if total > 1 else None
 
     return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url, q=q)
+
+
+@bp.route('/avatar/<digest>/<int:size>')
+@login_required
+def avatar(digest, size):
+    # local copy of a gravatar image, so rendering a page never waits on gravatar itself.  only for logged-in
+    #   users and the sizes the pages use, so nobody else can have us fetch (and store) whatever they like
+    if not re.match(r'^[0-9a-f]{32}$', digest) or size not in AVATAR_SIZES:
+        abort(404)
+
+    cache_dir = current_app.config['AVATAR_CACHE_DIR']
+    path = os.path.join(cache_dir, '{}-{}'.format(digest, size))
+    if not os.path.exists(path):
+        try:
+            r = requests.get(avatar_url(digest, size), timeout=5)
+        except requests.RequestException:
+            return redirect(avatar_url(digest, size))
+        if r.status_code != 200:
+            return redirect(avatar_url(digest, size))
+
+        # write to a temp file first so another worker never serves half an image
+        os.makedirs(cache_dir, exist_ok=True)
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(r.content)
+        os.replace(temp, path)
+        prune_avatars(cache_dir, current_app.config['AVATAR_CACHE_MAX_FILES'])
+
+    return send_file(path, mimetype=image_type(path), cache_timeout=current_app.config['AVATAR_MAX_AGE'])
+
+
+def prune_avatars(cache_dir, max_files):
+    # once the cache holds more than max_files avatars, the ones fetched longest ago go (they're fetched again if
+    #   anybody still needs them)
+    files = [entry for entry in os.scandir(cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+    if len(files) <= max_files:
+        return
+    files.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in files[:len(files) - max_files]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass  # another worker got there first
+
+
+def image_type(path):
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/png'
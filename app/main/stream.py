@@ -0,0 +1,102 @@
+import json
+import time
+from flask import Response, current_app, jsonify, request
+from flask_login import current_user, login_required
+from app import db
+from app.main import bp
+from app.main.caching import render_post
+from app.models import Post, followers
+from app.pubsub import author_channel
+
+# posts sent straight away to a client that reconnects after missing some
+BACKLOG_SIZE = 50
+
+
+def stream_channels(user_id):
+    # the channels a user's home timeline listens to: everybody they follow, plus themselves.  follows made while
+    #   the stream is open are picked up when it reconnects (every SSE_MAX_AGE seconds, or on the next page load)
+    followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id)
+    return [author_channel(user_id)] + [author_channel(id) for id, in followed]
+
+
+def backlog(user_id, last_event_id):
+    # [(post id, author id)] of posts the client missed since last_event_id, oldest first
+    try:
+        last_id = int(last_event_id)
+    except (TypeError, ValueError):
+        return []
+    followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id)
+    rows = Post.query.with_entities(Post.id, Post.user_id).filter(
+        Post.id > last_id, db.or_(Post.user_id == user_id, Post.user_id.in_(followed))).order_by(
+        Post.id).limit(BACKLOG_SIZE).all()
+    return [(id, author) for id, author in rows]
+
+
+def sse_event(event, data, id=None):
+    lines = ['event: {}'.format(event)]
+    if id is not None:
+        lines.append('id: {}'.format(id))
+    lines.append('data: {}'.format(json.dumps(data, separators=(',', ':'))))
+    return '\n'.join(lines) + '\n\n'
+
+
+def post_event(message):
+    return sse_event('post', message, id=message['id'])
+
+
+@bp.record
+def register_stream(state):
+    # opt-in with SSE_ENABLED: every home page keeps a stream open, which under sync workers means a whole worker
+    #   per reader
+    if state.app.config['SSE_ENABLED']:
+        state.add_url_rule('/stream', 'stream', stream)
+
+
+@login_required
+def stream():
+    # server-sent events for the home timeline: a 'post' event with {id, author} for every new post from somebody
+    #   the user follows, which the page fetches from /fragments.  each connection holds a thread (or, run under
+    #   gevent, a greenlet) for as long as it's open; asgi.py serves the same stream on the event loop instead.
+    config = current_app.config
+    hub = current_app.pubsub
+    user_id = current_user.id
+    # subscribed before looking for missed posts, so nothing falls in between (the page ignores duplicates)
+    subscription = hub.subscribe(stream_channels(user_id))
+    try:
+        missed = backlog(user_id, request.headers.get('Last-Event-ID'))
+    except Exception:
+        hub.unsubscribe(subscription)
+        raise
+    db.session.remove()  # don't hold on to a connection for the whole stream
+
+    def events():
+        yield 'retry: {:d}\n\n'.format(config['SSE_RETRY'])
+        for id, author in missed:
+            yield post_event({'id': id, 'author': author})
+
+        deadline = time.monotonic() + config['SSE_MAX_AGE']
+        while time.monotonic() < deadline:
+            message = subscription.get(timeout=min(config['SSE_HEARTBEAT'], deadline - time.monotonic()))
+            if subscription.overflowed:
+                yield sse_event('reset', {})  # too far behind to catch up; the page should just reload
+                return
+            # a comment line keeps proxies from closing an idle connection, and finds out if the client left
+            yield post_event(message) if message is not None else ': keepalive\n\n'
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: hub.unsubscribe(subscription))
+    return response
+
+
+@bp.route('/fragments')
+@login_required
+def fragments():
+    # the rendered _post.html of the posts in ?ids=1,2,3, for adding new posts to a page without reloading it
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',') if id][:BACKLOG_SIZE]
+    except ValueError:
+        ids = []
+    posts = Post.query.options(db.joinedload(Post.author)).filter(Post.id.in_(ids)).order_by(
+        Post.timestamp.desc(), Post.id.desc()).all() if ids else []
+    return jsonify({'posts': [{'id': post.id, 'html': str(render_post(post))} for post in posts]})
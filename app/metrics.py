@@ -0,0 +1,45 @@
+import threading
+from collections import defaultdict
+
+
+class Metrics(object):
+    # in-process counters and timings, keyed by name plus optional labels, e.g.
+    #   metrics.increment('mail.sent')
+    #   metrics.observe('mail.send_seconds', 0.02)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.timings = {}  # (name, labels) -> [count, total, max]
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def count(self, name, **labels):
+        with self._lock:
+            return self.counters.get(self.key(name, labels), 0)
+
+    def snapshot(self):
+        # copies of (counters, timings), for reporting without holding the lock
+        with self._lock:
+            return dict(self.counters), {key: list(value) for key, value in self.timings.items()}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+metrics = Metrics()
@@ -1,75 +1,158 @@
+import hmac
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.cache import create_cache
+from app.passwords import MAX_HASH_LENGTH
+from app.search import add_to_index, remove_from_index, query_index, rebuild_index, fulltext_ddl, invalidate_results
 from datetime import datetime
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
-from hashlib import md5
+from functools import lru_cache
+from hashlib import md5, sha256
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import ClauseElement
 from time import time
-from werkzeug.security import generate_password_hash, check_password_hash
 
 
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+        if not ids:
+            return [], total
 
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
+        # fetch the whole page in one query, then put it back into the search engine's ranking order
+        query = cls.query.filter(cls.id.in_(ids))
+        for relationship in getattr(cls, '__search_eager__', []):
+            query = query.options(db.joinedload(relationship))
+        by_id = {obj.id: obj for obj in query}
 
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=Post.id)), total
+        return [by_id[id] for id in ids if id in by_id], total
 
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': [obj for obj in session.new if isinstance(obj, cls)],
-            'update': [obj for obj in session.dirty if isinstance(obj, cls)],
-            'delete': [obj for obj in session.deleted if isinstance(obj, cls)],
-            }
+    def search_payload(self):
+        return {field: getattr(self, field) for field in self.__searchable__}
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+    def after_flush(cls, session, flush_context):
+        # note what needs (re)indexing while the flushed objects still have their ids and change history.  the
+        #   payload is captured now so that after_commit doesn't have to reload every expired object.
+        changes = getattr(session, '_changes', None) or {}
+        for obj in session.new:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                changes[(obj.__tablename__, obj.id)] = obj.search_payload()
+        for obj in session.dirty:
+            # skip updates that didn't touch any of the indexed fields
+            if isinstance(obj, SearchableMixin) and any(
+                    db.inspect(obj).attrs[field].history.has_changes() for field in obj.__searchable__):
+                changes[(obj.__tablename__, obj.id)] = obj.search_payload()
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                changes[(obj.__tablename__, obj.id)] = None
+
+        if current_app.search.transactional:
+            # database-backed indexes are written right away, so they commit or roll back along with the rows.
+            #   their cached search results go stale with the commit
+            cls.send_changes(changes)
+            written = getattr(session, '_written_indexes', None) or set()
+            session._written_indexes = written | set(index for index, id in changes)
+            changes = {}
+        session._changes = changes
+
+        # cached pages showing any of these objects go stale once the commit lands
+        pages = getattr(session, '_pages', None) or set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if hasattr(obj, 'page_scopes'):
+                pages.update(obj.page_scopes())
+        session._pages = pages
+
+    @classmethod
+    def after_commit(cls, session):
+        changes = getattr(session, '_changes', None) or {}
 
         # clear session data after commit
         session._changes = None
 
+        # for elasticsearch these only queue the writes, so the commit doesn't wait on the search cluster
+        cls.send_changes(changes)
+
+        written = getattr(session, '_written_indexes', None)
+        session._written_indexes = None
+        if written:
+            invalidate_results(current_app, written)
+
+        pages = getattr(session, '_pages', None)
+        session._pages = None
+        if pages and current_app.page_cache is not None:
+            current_app.page_cache.invalidate(*pages)
+
+    @staticmethod
+    def send_changes(changes):
+        for (index, id), payload in changes.items():
+            if payload is None:
+                remove_from_index(index, id)
+            else:
+                add_to_index(index, id, payload)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session._changes = None
+        session._written_indexes = None
+        session._pages = None
+
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, **kwargs):
+        return rebuild_index(cls, **kwargs)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
+# the primary key covers "who does X follow" and is_following(); the reverse index covers "who follows X"
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_follower', 'followed_id', 'follower_id'))
+
+# precomputed home timelines: one row per (reader, post), pushed out when the post is written so that loading
+#   the home page is a range scan over ix_timeline_user_timestamp instead of a join + union + sort
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp', 'post_id'))
+
+# the current generation of each page cache scope ('explore', 'user:<id>'), where every process can see it; see
+#   app/main/caching.py
+page_generation = db.Table(
+    'page_generation',
+    db.Column('scope', db.String(64), primary_key=True),
+    db.Column('token', db.String(32), nullable=False),
+    db.Column('started_at', db.DateTime, nullable=False))
 
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(32), index=True, unique=True)
     email = db.Column(db.String(128), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    email_digest = db.Column(db.String(32))  # md5 of the lowercased email, which is what gravatar is keyed on
+    password_hash = db.Column(db.String(MAX_HASH_LENGTH))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     #   setting the 'lazy' attribute as dynamic allows the 'posts' object to return customized, filterable data sets
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # authors with too many followers to push to are read from at load time instead (hybrid fan-out)
+    fan_out_on_read = db.Column(db.Boolean, default=False)
+
+    # denormalized counts, kept in step by follow(), unfollow() and post inserts/deletes, so that profile pages
+    #   don't have to COUNT(*) anything.  `flask users recount` repairs any drift.
+    followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     followed = db.relationship(
         'User', secondary=followers,
@@ -81,11 +164,22 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    def page_scopes(self):
+        # their profile page, plus every timeline their name and avatar show up on if those changed
+        scopes = ['user:{}'.format(self.id)]
+        state = db.inspect(self)
+        if state.attrs.username.history.has_changes() or state.attrs.email_digest.history.has_changes():
+            scopes.append('explore')
+        return scopes
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return current_app.password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return current_app.password_hasher.needs_rehash(self.password_hash)
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode({'reset_password': self.id, 'exp': time() + expires_in},
@@ -100,18 +194,74 @@ class User(UserMixin, db.Model):
             return
         return User.query.get(id)
 
+    def get_api_token(self, expires_in=None):
+        # api tokens carry a fingerprint of the password hash, so changing the password revokes them all
+        expires_in = expires_in or current_app.config['API_TOKEN_EXPIRES']
+        return jwt.encode({'api': self.id, 'pwd': password_fingerprint(self.password_hash), 'exp': time() + expires_in},
+                          current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+
+    @staticmethod
+    def verify_api_token(token):
+        try:
+            claims = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+            user = load_user(claims['api'])
+        except Exception:
+            return
+        if user is None:
+            return
+        # the hash comes from the database rather than the (possibly cached, possibly stale) user, so a password
+        #   change revokes tokens everywhere at once
+        password_hash = db.session.query(User.password_hash).filter(User.id == user.id).scalar()
+        if not hmac.compare_digest(str(claims.get('pwd')), password_fingerprint(password_hash)):
+            return
+        return user
+
+    def to_dict(self, fields):
+        # the api representation, limited to `fields`
+        data = {}
+        for field in fields:
+            if field == 'avatar':
+                # straight from gravatar: api clients don't have the session cookie the avatar proxy asks for
+                data['avatar'] = avatar_url(self.email_digest or email_digest(self.email), 128)
+            elif field == 'last_seen':
+                data['last_seen'] = api_timestamp(self.last_seen)
+            else:
+                data[field] = getattr(self, field)
+        return data
+
+    @db.validates('email')
+    def validate_email(self, key, email):
+        # keep the digest in step with the email so avatars never have to hash anything
+        self.email_digest = email_digest(email) if email else None
+        return email
+
     # method returns a new avatar for each user
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()  # returns a string hex code
-        return 'https://www.gravatar.com/avatar/{}?s={}&d=identicon'.format(digest, size)
+        digest = self.email_digest or email_digest(self.email)
+        if current_app.config['AVATAR_PROXY'] and size in AVATAR_SIZES:
+            return url_for('main.avatar', digest=digest, size=size)
+        return avatar_url(digest, size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            increment(self, 'followed_count', 1)
+            increment(user, 'followers_count', 1)
+            if current_app.config['TIMELINE_FANOUT'] and not user.fan_out_on_read:
+                # backfill the new follower's timeline with everything the user has already posted
+                db.session.execute(timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    db.select([db.literal(self.id), Post.id, Post.timestamp]).where(Post.user_id == user.id)))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            increment(self, 'followed_count', -1)
+            increment(user, 'followers_count', -1)
+            if current_app.config['TIMELINE_FANOUT']:
+                # prune the unfollowed user's posts back out of this timeline
+                db.session.execute(timeline.delete().where(timeline.c.user_id == self.id).where(
+                    timeline.c.post_id.in_(db.select([Post.id]).where(Post.user_id == user.id))))
 
     def is_following(self, user):
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
@@ -124,19 +274,260 @@ class User(UserMixin, db.Model):
         # include the user's own posts in this method
         return followed.union(self.posts).order_by(Post.timestamp.desc())
 
+    def home_timeline(self):
+        # returns (query, sort key) for this user's home page; the key is what keyset pagination should seek on
+        if not current_app.config['TIMELINE_FANOUT']:
+            return self.followed_posts(), (Post.timestamp, Post.id)
+
+        materialized = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(timeline.c.user_id == self.id)
+        if self.followed.filter(User.fan_out_on_read.is_(True)).first() is None:
+            return materialized.order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc()), \
+                (timeline.c.timestamp, timeline.c.post_id)
+
+        # merge in posts from followed authors that were too popular to push to every follower
+        pulled = Post.query.join(followers, (followers.c.followed_id == Post.user_id)).join(
+            User, (User.id == Post.user_id)).filter(followers.c.follower_id == self.id, User.fan_out_on_read.is_(True))
+        return materialized.union(pulled).order_by(Post.timestamp.desc()), (Post.timestamp, Post.id)
+
+
+def increment(obj, attr, delta):
+    # written as "SET x = x + delta" so that concurrent follows can't overwrite each other's counts
+    current = obj.__dict__.get(attr)
+    if isinstance(current, ClauseElement):
+        setattr(obj, attr, current + delta)  # already bumped once in this flush
+    elif db.inspect(obj).persistent:
+        setattr(obj, attr, getattr(type(obj), attr) + delta)
+    else:
+        setattr(obj, attr, (current or 0) + delta)
+
+
+def api_timestamp(timestamp):
+    return timestamp.isoformat() + 'Z' if timestamp else None
+
+
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()  # returns a string hex code
+
+
+# the sizes the pages show avatars at, and so the only ones the avatar proxy fetches
+AVATAR_SIZES = (70, 200)
+
+
+def password_fingerprint(password_hash):
+    # keyed, so a token reveals nothing about the hash it was made from
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'), (password_hash or '').encode('utf-8'),
+                    sha256).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def avatar_url(digest, size):
+    # the same few (digest, size) pairs get rendered over and over, so each URL is only ever built once
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+
+
+def create_user_cache(app):
+    # column values of recently seen users, so that authenticated requests don't have to look up who they're for.
+    #   'memory' is per process; a shared cache (sqlite/redis) also gets every other process's invalidations
+    #   straight away, where per-process copies can be stale for up to USER_CACHE_TTL seconds.
+    if not app.config['USER_CACHE']:
+        return None
+
+    return create_cache(app.config['USER_CACHE'], maxsize=app.config['USER_CACHE_SIZE'],
+                        ttl=app.config['USER_CACHE_TTL'], prefix='microblog:user:',
+                        secret=app.config['SECRET_KEY'])
+
+
+# secrets that have no business in a cache other processes (or anyone with access to redis) can read
+UNCACHED_USER_COLUMNS = frozenset(['password_hash'])
+
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    cache = current_app.user_cache
+    if cache is None:
+        return User.query.get(int(id))
+
+    values = cache.get(('user', int(id)))
+    if values is None:
+        user = User.query.get(int(id))
+        if user is not None:
+            cache.set(('user', user.id), {attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs
+                                          if attr.key not in UNCACHED_USER_COLUMNS})
+        return user
+
+    # rebuild the user as if it had been loaded, and attach it to the session without going to the database.  the
+    #   columns left out of the cache stay unloaded, so the first access to one fetches it from the database
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def collect_changed_users(session, flush_context):
+    # profile edits, username changes, password resets, follows: any flushed change to a user drops them from the
+    #   user cache once it commits.  so do new and deleted posts, for the author's posts_count.
+    users = getattr(session, '_forget_users', None) or set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj not in session.new:
+            users.add(obj.id)
+        elif isinstance(obj, Post) and obj not in session.dirty:
+            users.add(obj.user_id)
+    session._forget_users = users
+
+
+def forget_changed_users(session):
+    users = getattr(session, '_forget_users', None)
+    session._forget_users = None
+    for id in users or ():
+        forget_user(id)
+
+
+def forget_user(id):
+    if current_app.user_cache is not None:
+        current_app.user_cache.delete(('user', id))
+
+
+def update_cached_user(id, **values):
+    # for writes that go around the session, and so around collect_changed_users()
+    cache = current_app.user_cache
+    cached = cache.get(('user', id)) if cache is not None else None
+    if cached is not None:
+        cache.set(('user', id), dict(cached, **values))
+
+
+def forget_rolled_back_users(session):
+    session._forget_users = None
+
+
+db.event.listen(db.session, 'after_flush', collect_changed_users)
+db.event.listen(db.session, 'after_commit', forget_changed_users)
+db.event.listen(db.session, 'after_rollback', forget_rolled_back_users)
 
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __search_eager__ = ['author']  # search results always show who wrote them
+    # timelines are paginated by seeking on (timestamp, id), so both columns share one index; profiles and
+    #   followed_posts() look posts up by author, newest first
+    __table_args__ = (db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+                      db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'))
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+    def page_scopes(self):
+        return ['explore', 'user:{}'.format(self.user_id)]
+
+    def to_dict(self, fields, author_fields=('id', 'username', 'avatar')):
+        data = {}
+        for field in fields:
+            if field == 'author':
+                data['author'] = self.author.to_dict(author_fields)
+            elif field == 'timestamp':
+                data['timestamp'] = api_timestamp(self.timestamp)
+            else:
+                data[field] = getattr(self, field)
+        return data
+
+    def fan_out(self):
+        # pushes a new post into the precomputed timelines of its author and their followers
+        if not current_app.config['TIMELINE_FANOUT']:
+            return
+
+        db.session.flush()  # the post needs its id and timestamp
+        author = self.author
+        db.session.execute(timeline.insert().values(user_id=author.id, post_id=self.id, timestamp=self.timestamp))
+
+        if not author.fan_out_on_read and author.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            # too many followers to write to on every post; their followers will read these posts at load time
+            author.fan_out_on_read = True
+        if not author.fan_out_on_read:
+            db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'],
+                db.select([followers.c.follower_id, db.literal(self.id), db.literal(self.timestamp)]).where(
+                    followers.c.followed_id == author.id)))
+
+
+class OutboundEmail(db.Model):
+    # the outgoing mail queue; rows are claimed and sent by the workers in app/email.py
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    __table_args__ = (db.Index('ix_outbound_email_status_next_attempt_at', 'status', 'next_attempt_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(255))
+    recipients = db.Column(db.Text)  # json list
+    text_body = db.Column(db.Text)
+    html_body = db.Column(db.Text)
+    status = db.Column(db.String(10), default=QUEUED, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), index=True)
+    claimed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    def __repr__(self):
+        return '<OutboundEmail {} {}>'.format(self.id, self.status)
+
+
+def count_new_post(mapper, connection, post):
+    connection.execute(User.__table__.update().where(User.id == post.user_id).values(
+        posts_count=User.posts_count + 1))
+
+
+def count_deleted_post(mapper, connection, post):
+    connection.execute(User.__table__.update().where(User.id == post.user_id).values(
+        posts_count=User.posts_count - 1))
+
+
+db.event.listen(Post, 'after_insert', count_new_post)
+db.event.listen(Post, 'after_delete', count_deleted_post)
+fulltext_ddl(Post)
+
+
+def recount_users():
+    # recomputes every user's denormalized counters from scratch; returns how many users had drifted
+    followers_count = db.select([db.func.count()]).where(followers.c.followed_id == User.id).as_scalar()
+    followed_count = db.select([db.func.count()]).where(followers.c.follower_id == User.id).as_scalar()
+    posts_count = db.select([db.func.count()]).where(Post.user_id == User.id).as_scalar()
+
+    drifted = db.session.query(db.func.count(User.id)).filter(db.or_(
+        User.followers_count != followers_count, User.followed_count != followed_count,
+        User.posts_count != posts_count)).scalar()
+    if drifted:
+        db.session.execute(User.__table__.update().values(
+            followers_count=followers_count, followed_count=followed_count, posts_count=posts_count))
+    db.session.commit()
+    return drifted
+
+
+def rebuild_timelines():
+    # recomputes every precomputed timeline from the follow graph, e.g. after switching TIMELINE_FANOUT on
+    db.session.execute(User.__table__.update().values(fan_out_on_read=(
+        db.select([db.func.count()]).where(followers.c.followed_id == User.id).as_scalar() >
+        current_app.config['TIMELINE_FANOUT_LIMIT'])))
+    db.session.execute(timeline.delete())
+
+    # every user sees their own posts...
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'], db.select([Post.user_id, Post.id, Post.timestamp])))
+
+    # ...plus everything from the people they follow, unless those posts get pulled in at read time
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([followers.c.follower_id, Post.id, Post.timestamp]).select_from(
+            followers.join(Post.__table__, followers.c.followed_id == Post.user_id).join(
+                User.__table__, User.id == Post.user_id)).where(
+            db.or_(User.fan_out_on_read.is_(None), User.fan_out_on_read.is_(False)))))
+    db.session.commit()
@@ -0,0 +1,95 @@
+import base64
+import json
+from datetime import datetime
+from app import db
+
+# cursors point either at older posts ('next') or back towards newer posts ('prev')
+NEXT = 'n'
+PREV = 'p'
+
+
+def encode_cursor(direction, timestamp, id):
+    # opaque to clients: just a url-safe blob holding the sort key of the boundary row
+    raw = json.dumps([direction, timestamp.isoformat(), id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    # returns (direction, timestamp, id), or None if the cursor is missing or has been tampered with
+    if not cursor:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, timestamp, id = json.loads(raw.decode('utf-8'))
+        if direction not in (NEXT, PREV):
+            return None
+        return direction, datetime.strptime(timestamp, _timestamp_format(timestamp)), int(id)
+    except (ValueError, TypeError):
+        return None
+
+
+def _timestamp_format(timestamp):
+    # isoformat() drops the microseconds when they're zero
+    return '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp else '%Y-%m-%dT%H:%M:%S'
+
+
+class KeysetPage(object):
+    # a single page of keyset-paginated results, ordered newest first
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def paginate_keyset(query, key, cursor, per_page):
+    # seeks to the cursor position using the (timestamp, id) key instead of OFFSET, so that page N costs the same
+    #   as page 1 and newly-added rows don't shift the pages a user is scrolling through
+    timestamp_col, id_col = key
+    decoded = decode_cursor(cursor)
+    query = query.order_by(None)
+
+    if decoded is None:
+        direction = NEXT
+        rows = query.order_by(timestamp_col.desc(), id_col.desc()).limit(per_page + 1).all()
+    else:
+        direction, timestamp, id = decoded
+        if direction == NEXT:
+            # rows older than the cursor
+            seek = query.filter(db.or_(timestamp_col < timestamp,
+                                       db.and_(timestamp_col == timestamp, id_col < id)))
+            rows = seek.order_by(timestamp_col.desc(), id_col.desc()).limit(per_page + 1).all()
+        else:
+            # rows newer than the cursor, fetched in ascending order then flipped back around
+            seek = query.filter(db.or_(timestamp_col > timestamp,
+                                       db.and_(timestamp_col == timestamp, id_col > id)))
+            rows = seek.order_by(timestamp_col.asc(), id_col.asc()).limit(per_page + 1).all()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if direction == PREV:
+        rows.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = decoded is not None, has_more
+
+    if not rows:
+        if direction == PREV:
+            # everything newer than the cursor has gone away, so just start over from the top (of the query
+            #   as it came in, not the one filtered down to rows past the cursor)
+            return paginate_keyset(query, key, None, per_page)
+        return KeysetPage([], None, None)
+
+    next_cursor = encode_cursor(NEXT, rows[-1].timestamp, rows[-1].id) if has_older else None
+    prev_cursor = encode_cursor(PREV, rows[0].timestamp, rows[0].id) if has_newer else None
+
+    return KeysetPage(rows, next_cursor, prev_cursor)
@@ -0,0 +1,97 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+# the width of User.password_hash
+MAX_HASH_LENGTH = 256
+
+
+class PasswordHasher(object):
+    # hashes and checks passwords with the configured PASSWORD_HASH_METHOD, in a pool of PASSWORD_HASH_WORKERS
+    #   processes.  the pool caps how much CPU a burst of logins can take: past that, logins wait their turn
+    #   (without holding the GIL) instead of every request thread grinding through key stretching at once and
+    #   starving the rest of the site.  with 0 workers everything runs inline.
+    def __init__(self, app):
+        self.method = normalize_method(app.config['PASSWORD_HASH_METHOD'])
+        self.salt_length = app.config['PASSWORD_SALT_LENGTH']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        # a method werkzeug can't use, or whose hashes wouldn't fit the column, should stop the app from starting
+        #   rather than turn up as failed (or silently truncated) registrations
+        length = hash_length(self.method, self.salt_length)
+        if length > MAX_HASH_LENGTH:
+            raise ValueError('{} hashes are {} characters, but password_hash only holds {}'.format(
+                self.method, length, MAX_HASH_LENGTH))
+        # callers queued up beyond this wait before submitting, so a flood of logins can't pile up in memory
+        self._slots = threading.BoundedSemaphore(max(1, self.workers) * 4)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # hashes made with an older method, cost or salt length get upgraded the next time their password is seen
+        if not pwhash or pwhash.count('$') != 2:
+            return True
+        method, salt, _ = pwhash.split('$')
+        return normalize_method(method) != self.method or len(salt) != self.salt_length
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        with self._slots:
+            return self.pool().submit(fn, *args).result()
+
+    def pool(self):
+        # started on first use, and again in any process forked after that (gunicorn workers, --preload)
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # fresh interpreters rather than forks of this one: the workers only need werkzeug, not a copy
+                #   of the app with all of its threads and connections
+                context = multiprocessing.get_context(
+                    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+def normalize_method(method):
+    # 'pbkdf2:sha256' and 'pbkdf2:sha256:150000' are the same thing; hashes always record the full form
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        if len(parts) == 1:
+            parts.append('sha256')
+        if len(parts) == 2:
+            parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ':'.join(parts)
+
+
+def hash_length(method, salt_length):
+    # how long the hashes `method` makes are: 'method$salt$hex digest'
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2' and len(parts) == 3 and parts[2].isdigit():
+        name = parts[1]
+    elif len(parts) == 1 and parts[0] != 'plain':
+        name = parts[0]  # salted hmac, werkzeug's older scheme
+    else:
+        raise ValueError('unsupported password hash method: {}'.format(method))
+    try:
+        digest_size = hashlib.new(name).digest_size
+    except (ValueError, TypeError):
+        raise ValueError('unknown hash function in password hash method: {}'.format(method))
+    return len(method) + 1 + salt_length + 1 + digest_size * 2
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+from flask import current_app
+from app import db
+from app.models import Post
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    # one listener's mailbox.  blocking consumers (a WSGI thread or greenlet) use get(); consumers on an asyncio
+    #   loop pass it in and use aget().  delivery never blocks the publisher: a listener that falls more than
+    #   maxsize messages behind gets `overflowed` set instead, and should start over.
+    def __init__(self, channels, maxsize=100, loop=None):
+        self.channels = set(channels)
+        self.overflowed = False
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize) if loop is not None else queue.Queue(maxsize)
+
+    def deliver(self, message):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._put, message)
+        else:
+            self._put(message)
+
+    def _put(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except (queue.Full, asyncio.QueueFull):
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        # the next message, or None after `timeout` seconds without one
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def aget(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Hub(object):
+    # in-process pub/sub: messages published on a channel go to every subscription listening to it.  publishing
+    #   goes through the broker, so that with a shared broker every process's hub sees every message, and each
+    #   hands it to its own listeners.
+    def __init__(self, broker_url='memory', queue_size=100):
+        self.queue_size = queue_size
+        self._channels = {}
+        self._lock = threading.Lock()
+        self.broker = create_broker(broker_url, self)
+
+    def subscribe(self, channels, loop=None):
+        subscription = Subscription(channels, self.queue_size, loop)
+        with self._lock:
+            for channel in subscription.channels:
+                self._channels.setdefault(channel, set()).add(subscription)
+        self.broker.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                listeners = self._channels.get(channel)
+                if listeners is not None:
+                    listeners.discard(subscription)
+                    if not listeners:
+                        del self._channels[channel]
+
+    def publish(self, channel, message):
+        self.broker.publish(channel, message)
+
+    def deliver(self, channel, message):
+        with self._lock:
+            listeners = list(self._channels.get(channel, ()))
+        for subscription in listeners:
+            subscription.deliver(message)
+
+    def __len__(self):
+        # how many subscriptions are open
+        with self._lock:
+            return len(set().union(*self._channels.values())) if self._channels else 0
+
+
+class MemoryBroker(object):
+    # a single process: messages go straight to the local hub
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def publish(self, channel, message):
+        self.hub.deliver(channel, message)
+
+
+class RedisBroker(object):
+    # several processes or machines: messages go through redis pub/sub, and a listener thread in every process
+    #   passes whatever comes back (its own messages included) on to the local hub
+    def __init__(self, hub, url, prefix='microblog:pubsub:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('the redis package is needed for a redis:// pub/sub broker')
+        self.hub = hub
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='pubsub-listener', daemon=True)
+                self._thread.start()
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, json.dumps(message))
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.prefix + '*')
+        for item in pubsub.listen():
+            try:
+                channel = item['channel'].decode('utf-8')[len(self.prefix):]
+                self.hub.deliver(channel, json.loads(item['data'].decode('utf-8')))
+            except Exception:
+                logger.exception('pubsub: bad message %r', item)
+
+
+def create_broker(url, hub):
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisBroker(hub, url)
+    if url == 'memory':
+        return MemoryBroker(hub)
+    raise ValueError('unknown pub/sub broker URL: {}'.format(url))
+
+
+def create_hub(app):
+    return Hub(app.config['PUBSUB_BROKER'], app.config['SSE_QUEUE_SIZE'])
+
+
+def author_channel(user_id):
+    return 'posts:{}'.format(user_id)
+
+
+def collect_new_posts(session, flush_context):
+    # new posts are announced on their author's channel once they're committed
+    posts = getattr(session, '_announce_posts', None) or []
+    posts.extend((obj.id, obj.user_id) for obj in session.new if isinstance(obj, Post))
+    session._announce_posts = posts
+
+
+def announce_new_posts(session):
+    posts = getattr(session, '_announce_posts', None)
+    session._announce_posts = None
+    for id, user_id in posts or ():
+        current_app.pubsub.publish(author_channel(user_id), {'id': id, 'author': user_id})
+
+
+def forget_new_posts(session):
+    session._announce_posts = None
+
+
+db.event.listen(db.session, 'after_flush', collect_new_posts)
+db.event.listen(db.session, 'after_commit', announce_new_posts)
+db.event.listen(db.session, 'after_rollback', forget_new_posts)
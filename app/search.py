@@ -1,36 +1,390 @@
+import threading
+import time
+from datetime import datetime
+from elasticsearch import helpers
 from flask import current_app
+from werkzeug.utils import import_string
+from app import db
+from app.cache import LRUCache
+from app.instrumentation import timed
+from app.worker import CoalescingWorker
 
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return  # abort if elasticsearch isn't configured
+# the module-level functions below are what the models use; they hand off to whichever backend the app was
+#   configured with (SEARCH_BACKEND), so a model never needs to know where its index actually lives
 
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
+def add_to_index(index, id, payload):
+    current_app.search.add_to_index(index, id, payload)
 
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id, body=payload)
 
+def remove_from_index(index, id):
+    current_app.search.remove_from_index(index, id)
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
 
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+def query_index(index, query, page, per_page):
+    # popular searches (and paging back and forth through them) are answered from the result cache.  entries are
+    #   keyed on the index's generation, which is bumped once a write has landed (see invalidate_results), so
+    #   the write orphans everything cached before it.
+    cache = current_app.search_cache
+    if cache is None:
+        return current_app.search.query_index(index, query, page, per_page)
 
+    key = (index, cache.generations.get(index, 0), query, page, per_page)
+    result = cache.get(key)
+    if result is None:
+        result = current_app.search.query_index(index, query, page, per_page)
+        cache.set(key, result)
+    return result
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+
+def invalidate_results(app, indexes):
+    # only once the write can be seen by a search: after the database backend's transaction commits, or after
+    #   elasticsearch has taken the bulk request.  bumping any earlier would let a search made in between cache
+    #   the old results under the new generation.
+    # generations are per process: other processes keep serving what they cached for up to SEARCH_CACHE_TTL
+    cache = app.search_cache
+    if cache is not None:
+        with cache.lock:
+            for index in indexes:
+                cache.generations[index] = cache.generations.get(index, 0) + 1
+
+
+class ResultCache(LRUCache):
+    # the generations live outside the LRU, since evicting one could bring old results back to life
+    def __init__(self, maxsize, ttl):
+        super(ResultCache, self).__init__(maxsize, ttl)
+        self.generations = {}
+        self.lock = threading.Lock()
+
+
+def rebuild_index(model, **kwargs):
+    return current_app.search.rebuild_index(model, **kwargs)
+
+
+def flush_index(timeout=None):
+    # waits for queued index writes to land; mostly useful in tests
+    return current_app.search.flush(timeout)
+
+
+def create_result_cache(app):
+    if not app.config['SEARCH_CACHE_SIZE']:
+        return None
+
+    return ResultCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])
+
+
+def create_backend(app):
+    name = app.config['SEARCH_BACKEND']
+    backend = BACKENDS[name] if name in BACKENDS else import_string(name)  # or a 'package.module:Class' path
+    return backend(app)
+
+
+# how often index writers look for a rebuild in progress, and so how long a rebuild waits before it starts copying
+REBUILD_CHECK_INTERVAL = 5
+
+
+class SearchBackend(object):
+    # interface for search backends.  `index` is the searchable model's table name and `payload` is a dict of
+    #   its __searchable__ fields.
+    # transactional backends are written to during the flush, inside the same transaction as the rows being
+    #   indexed; the others are only told about changes after the commit succeeds.
+    transactional = False
+
+    def __init__(self, app):
+        self.app = app
+
+    def add_to_index(self, index, id, payload):
+        pass
+
+    def remove_from_index(self, index, id):
+        pass
+
+    def query_index(self, index, query, page, per_page):
+        # returns (ids in ranked order, total number of hits)
         return [], 0
 
-    body = {
-        'query':    {'multi_match': {'query': query, 'fields': ['*']}},
-        'from':     (page - 1) * per_page,
-        'size':     per_page
-        }
+    def rebuild_index(self, model, **kwargs):
+        pass
+
+    def flush(self, timeout=None):
+        return True
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, app):
+        super(ElasticsearchBackend, self).__init__(app)
+
+        # index writes are queued up and sent to elasticsearch in bulk from a background thread, so committing a
+        #   post never waits on (or fails because of) the search cluster
+        self.indexer = CoalescingWorker('search-indexer', self.send_bulk,
+                                        batch_size=app.config['SEARCH_INDEX_BATCH_SIZE'],
+                                        interval=app.config['SEARCH_INDEX_INTERVAL'],
+                                        max_retries=app.config['SEARCH_INDEX_MAX_RETRIES'],
+                                        synchronous=not app.config['SEARCH_INDEX_ASYNC'])
+        self._rebuilds = {}  # alias -> (when it was last checked, index being rebuilt into)
+
+    @property
+    def es(self):
+        return self.app.elasticsearch
+
+    def rebuild_target(self, alias):
+        # the physical index a rebuild is filling for `alias`, from whichever process is running it, or None.  the
+        #   rebuild announces itself with a marker alias; this looks it up at most every REBUILD_CHECK_INTERVAL
+        checked, target = self._rebuilds.get(alias, (0, None))
+        if time.monotonic() - checked >= REBUILD_CHECK_INTERVAL:
+            marker = rebuild_marker(alias)
+            target = None
+            if self.es.indices.exists_alias(name=marker):
+                target = next(iter(self.es.indices.get_alias(name=marker)), None)
+            self._rebuilds[alias] = (time.monotonic(), target)
+        return target
+
+    def add_to_index(self, index, id, payload):
+        if not self.es:
+            return  # abort if elasticsearch isn't configured
+
+        self.indexer.put((index, id), payload)
+
+    def remove_from_index(self, index, id):
+        if not self.es:
+            return
+
+        self.indexer.put((index, id), None)
+
+    def flush(self, timeout=None):
+        return self.indexer.flush(timeout)
+
+    def send_bulk(self, batch):
+        # batch is a list of ((index, id), payload) pairs; a payload of None means the document was deleted
+        actions = []
+        for (index, id), payload in batch:
+            # while an index is being rebuilt, writes go to the new one as well, so edits and deletes of rows the
+            #   rebuild has already copied aren't lost when it takes over
+            for target in filter(None, [index, self.rebuild_target(index)]):
+                if payload is None:
+                    actions.append({'_op_type': 'delete', '_index': target, '_type': index, '_id': id})
+                else:
+                    actions.append({'_op_type': 'index', '_index': target, '_type': index, '_id': id,
+                                    '_source': payload})
+
+        _, errors = helpers.bulk(self.es, actions, raise_on_error=False)
+        invalidate_results(self.app, set(index for (index, id), payload in batch))
+
+        # hand back anything worth retrying: throttling and server-side errors.  deleting a missing doc is fine.
+        retry = set()
+        for error in errors:
+            op, result = next(iter(error.items()))
+            if result.get('status') == 429 or result.get('status', 0) >= 500:
+                retry.add((result['_type'], str(result['_id'])))  # _index would be the aliased physical index
+            elif not (op == 'delete' and result.get('status') == 404):
+                self.app.logger.error('Search indexing failed: {}'.format(result))
+
+        return [(key, payload) for key, payload in batch if (key[0], str(key[1])) in retry]
+
+    def query_index(self, index, query, page, per_page):
+        if not self.es:
+            return [], 0
+
+        body = {
+            'query':    {'multi_match': {'query': query, 'fields': ['*']}},
+            'from':     (page - 1) * per_page,
+            'size':     per_page
+            }
+
+        with timed('es'):
+            search = self.es.search(index=index, doc_type=index, body=body)
+
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+
+        return ids, search['hits']['total']
+
+    def rebuild_index(self, model, into=None, start_id=0, chunk_size=1000, threads=4, keep_old=False,
+                      progress=None):
+        # streams every row of `model` into a brand new physical index, then atomically points the alias (the
+        #   model's table name, which is what everything else reads and writes) at it.  search keeps serving from
+        #   the old index the whole time.  to resume an interrupted rebuild, pass the same `into` along with the
+        #   last id that was reported as done.
+        es = self.es
+        alias = model.__tablename__
+        into = into or new_index_name(alias)
+        if not es.indices.exists(index=into):
+            es.indices.create(index=into)
+
+        # from here on every process's indexer writes to both indices (see send_bulk); give them all time to
+        #   notice before copying anything
+        marker = rebuild_marker(alias)
+        es.indices.update_aliases(body={'actions': [{'add': {'index': into, 'alias': marker}}]})
+        time.sleep(REBUILD_CHECK_INTERVAL)
+
+        done = {'id': start_id}
+        failed = []
+
+        def actions(after_id):
+            # walk the table in primary key order so a checkpoint id is enough to pick things back up.  parallel_bulk
+            #   pulls on this from a thread of its own, which needs its own app context (and session)
+            with self.app.app_context():
+                try:
+                    query = model.query.filter(model.id > after_id).order_by(model.id).yield_per(chunk_size)
+                    for obj in query:
+                        yield {'_op_type': 'index', '_index': into, '_type': alias, '_id': obj.id,
+                               '_source': obj.search_payload()}
+                finally:
+                    db.session.remove()
+
+        def stream(after_id):
+            # parallel_bulk hands results back in order, so the checkpoint is safe to resume from as long as it
+            #   never moves past a document that didn't make it in
+            del failed[:]
+            for ok, result in helpers.parallel_bulk(es, actions(after_id), thread_count=threads,
+                                                    chunk_size=chunk_size, raise_on_error=False):
+                item = next(iter(result.values()))
+                if not ok:
+                    self.app.logger.error('Search reindex failed: {}'.format(item))
+                    failed.append(int(item['_id']))
+                elif not failed:
+                    done['id'] = int(item['_id'])
+                if progress:
+                    progress(1, done['id'])
+
+        stream(start_id)
+
+        # anything posted while the rebuild was running, and another try at anything that failed
+        stream(done['id'])
+        if failed:
+            raise RuntimeError('{} documents could not be indexed into {}; {} still points at the old index'.format(
+                len(failed), into, alias))
+
+        # one atomic update: the alias moves over (replacing a plain index from before aliases were used, if
+        #   that's what has its name) and the marker goes away, so search never sees a missing or empty index
+        swap = [{'remove': {'index': into, 'alias': marker}}, {'add': {'index': into, 'alias': alias}}]
+        old = []
+        if es.indices.exists_alias(name=alias):
+            old = [name for name in es.indices.get_alias(name=alias).keys() if name != into]
+            swap = [{'remove': {'index': name, 'alias': alias}} for name in old] + swap
+        elif es.indices.exists(index=alias):
+            swap = [{'remove_index': {'index': alias}}] + swap
+        es.indices.update_aliases(body={'actions': swap})
+        invalidate_results(self.app, [alias])
+
+        if not keep_old:
+            for name in old:
+                es.indices.delete(index=name)
+
+        return into, done['id']
+
+
+def rebuild_marker(alias):
+    return '{}-rebuilding'.format(alias)
+
+
+def new_index_name(alias):
+    return '{}-{}'.format(alias, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+
+class DatabaseBackend(SearchBackend):
+    # full-text search inside the app's own database, for deployments that don't want to run elasticsearch:
+    #   - sqlite keeps an FTS5 virtual table per index (<index>_fts) that's written in the same transaction as
+    #     the rows, and ranks with bm25
+    #   - postgres searches an expression GIN index over to_tsvector() of the searchable fields, which the
+    #     database keeps up to date by itself, and ranks with ts_rank
+    #   - anything else falls back to an unranked LIKE scan
+    # the tables/indexes are created alongside the model's table; see fulltext_ddl()
+    transactional = True
+
+    @property
+    def dialect(self):
+        return db.session.get_bind().dialect.name
+
+    def add_to_index(self, index, id, payload):
+        if self.dialect == 'sqlite':
+            fields = sorted(payload)
+            db.session.execute('DELETE FROM {}_fts WHERE rowid = :id'.format(index), {'id': id})
+            db.session.execute('INSERT INTO {}_fts (rowid, {}) VALUES (:id, {})'.format(
+                index, ', '.join(fields), ', '.join(':' + field for field in fields)), dict(payload, id=id))
+
+    def remove_from_index(self, index, id):
+        if self.dialect == 'sqlite':
+            db.session.execute('DELETE FROM {}_fts WHERE rowid = :id'.format(index), {'id': id})
+
+    def query_index(self, index, query, page, per_page):
+        terms = query.split()
+        if not terms:
+            return [], 0
+
+        params = {'limit': per_page, 'offset': (page - 1) * per_page}
+        if self.dialect == 'sqlite':
+            # quote every term so user input can't be read as FTS5 query syntax
+            params['q'] = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+            match = 'FROM {0}_fts WHERE {0}_fts MATCH :q'.format(index)
+            ranked = 'SELECT rowid {} ORDER BY rank LIMIT :limit OFFSET :offset'.format(match)
+        elif self.dialect == 'postgresql':
+            # this has to be the exact expression the GIN index was built on, or postgres won't use it
+            params['q'] = query
+            vector = tsvector(searchable_fields(index))
+            tsquery = "plainto_tsquery('{}', :q)".format(TEXT_SEARCH_CONFIG)
+            match = 'FROM {} WHERE {} @@ {}'.format(index, vector, tsquery)
+            ranked = 'SELECT id {} ORDER BY ts_rank({}, {}) DESC, id DESC LIMIT :limit OFFSET :offset'.format(
+                match, vector, tsquery)
+        else:
+            clauses = []
+            for i, term in enumerate(terms):
+                params['t{}'.format(i)] = '%{}%'.format(term)
+                clauses.append('(' + ' OR '.join('{} LIKE :t{}'.format(field, i)
+                                                 for field in searchable_fields(index)) + ')')
+            match = 'FROM {} WHERE {}'.format(index, ' AND '.join(clauses))
+            ranked = 'SELECT id {} ORDER BY id DESC LIMIT :limit OFFSET :offset'.format(match)
+
+        total = db.session.execute('SELECT count(*) ' + match, params).scalar()
+        if not total:
+            return [], 0
+
+        return [row[0] for row in db.session.execute(ranked, params)], total
+
+    def rebuild_index(self, model, progress=None, **kwargs):
+        # postgres (and the LIKE fallback) read straight from the table, so there's nothing to rebuild
+        if self.dialect == 'sqlite':
+            index, fields = model.__tablename__, ', '.join(model.__searchable__)
+            db.session.execute('DELETE FROM {}_fts'.format(index))
+            db.session.execute('INSERT INTO {0}_fts (rowid, {1}) SELECT id, {1} FROM {0}'.format(index, fields))
+            db.session.commit()
+            invalidate_results(self.app, [index])
+
+        total, last = db.session.query(db.func.count(model.id), db.func.max(model.id)).one()
+        if progress:
+            progress(total, last)
+        return model.__tablename__, last or 0
+
+
+BACKENDS = {
+    'none': SearchBackend,
+    'elasticsearch': ElasticsearchBackend,
+    'database': DatabaseBackend,
+}
+
+
+# postgres text search configuration; 'simple' doesn't stem, so it behaves the same for every post language
+TEXT_SEARCH_CONFIG = 'simple'
+
+
+def searchable_fields(index):
+    return db.metadata.tables[index].info['searchable']
+
+
+def tsvector(fields):
+    return "to_tsvector('{}', {})".format(TEXT_SEARCH_CONFIG, " || ' ' || ".join("coalesce({}, '')".format(field)
+                                                                                for field in fields))
+
 
-    search = current_app.elasticsearch.search(index=index, doc_type=index, body=body)
+def fulltext_ddl(model):
+    # creates (and drops) the database backend's full-text structures along with the model's table
+    table = model.__table__
+    table.info['searchable'] = list(model.__searchable__)
+    fts = '{}_fts'.format(table.name)
 
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
+    db.event.listen(table, 'after_create', db.DDL(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({})'.format(
+            fts, ', '.join(model.__searchable__))).execute_if(dialect='sqlite'))
+    db.event.listen(table, 'after_drop', db.DDL('DROP TABLE IF EXISTS {}'.format(fts)).execute_if(dialect='sqlite'))
 
-    return ids, search['hits']['total']
+    db.event.listen(table, 'after_create', db.DDL('CREATE INDEX IF NOT EXISTS ix_{} ON {} USING gin ({})'.format(
+        fts, table.name, tsvector(model.__searchable__))).execute_if(dialect='postgresql'))
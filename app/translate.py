@@ -1,30 +1,120 @@
+import hashlib
 import json
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app
 from flask_babel import _
+from app.cache import create_cache
+from app.instrumentation import timed
+
+# the API takes up to 100 texts per request
+BATCH_SIZE = 100
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_translation_cache(app):
+    if not app.config['TRANSLATION_CACHE']:
+        return None
+
+    return create_cache(app.config['TRANSLATION_CACHE'], maxsize=app.config['TRANSLATION_CACHE_SIZE'],
+                        ttl=app.config['TRANSLATION_CACHE_TTL'], prefix='microblog:translation:',
+                        secret=app.config['SECRET_KEY'])
+
+
+def http_session():
+    # one pooled session per process, so repeat translations reuse a warm keep-alive connection
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=current_app.config['MS_TRANSLATOR_POOL_SIZE'])
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def cache_key(text, source_language, dest_language):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest(), source_language, dest_language
 
 
 def translate(text, source_language, dest_language):
     # uses the Azure Text Translation API to translate text
-    # returns a byte string in utf-8 _with a signature prefix_
-    # Ex: b'\xef\xbb\xbf"Hi, how are you?"'
+    return translate_many([text], source_language, dest_language)[0]
+
 
+def translate_many(texts, source_language, dest_language):
+    # translates a list of texts from one language, asking the API only for the ones that aren't cached yet
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: Translation service is not configured.')
+        return [_('Error: Translation service is not configured.')] * len(texts)
 
-    endpoint = 'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0'
-    args = '&from={}&to={}'.format(source_language, dest_language)
-    full_url = endpoint + args
+    cache = current_app.translation_cache
+    results = [cache.get(cache_key(text, source_language, dest_language)) if cache is not None else None
+               for text in texts]
 
+    # identical texts on the same page only get sent once
+    missing = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+    translated = {}
+    for i in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[i:i + BATCH_SIZE]
+        r = request_translations(chunk, source_language, dest_language)
+        if isinstance(r, str):
+            # an error message; don't cache it
+            translated.update((text, r) for text in chunk)
+            continue
+        for text, result in zip(chunk, r):
+            translated[text] = result
+            if cache is not None:
+                cache.set(cache_key(text, source_language, dest_language), result)
+
+    return [result if result is not None else translated[text] for text, result in zip(texts, results)]
+
+
+def batch_by_language(items):
+    # groups the items of a batch request by source language, dropping anything malformed
+    by_language = {}
+    for item in items or []:
+        if isinstance(item, dict) and item.get('text') and item.get('source_language'):
+            by_language.setdefault(item['source_language'], []).append(item)
+    return by_language
+
+
+def request_payload(texts, source_language, dest_language):
+    # (url, params, headers, json body) for one call to the translation API
+    url = current_app.config['MS_TRANSLATOR_URL'] + '/translate'
+    params = {'api-version': '3.0', 'from': source_language, 'to': dest_language}
     headers = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
-    data = [{'Text': text}]
+    return url, params, headers, [{'Text': text} for text in texts]
+
+
+def parse_response(content):
+    # the API returns a byte string in utf-8 _with a signature prefix_
+    # Ex: b'\xef\xbb\xbf"Hi, how are you?"'
+    decoded = content.decode('utf-8-sig')
+    return [item['translations'][0]['text'] for item in json.loads(decoded)]
+
+
+def request_translations(texts, source_language, dest_language):
+    # returns a list of translations, or an error message
+    url, params, headers, data = request_payload(texts, source_language, dest_language)
 
-    r = requests.post(full_url, headers=headers, json=data)
+    try:
+        with timed('translate'):
+            r = http_session().post(url, params=params, headers=headers, json=data,
+                                    timeout=current_app.config['MS_TRANSLATOR_TIMEOUT'])
+    except requests.RequestException:
+        return _('Error: Translation service failed.')
 
     if r.status_code != 200:
         return _('Error: Translation service failed. ' + r.text)
-    else:
-        # print('Success!')
-        decoded = r.content.decode('utf-8-sig')
-        result = json.loads(decoded)[0]['translations'][0]['text']
-        return result
+    try:
+        translations = parse_response(r.content)
+    except (ValueError, LookupError, TypeError):
+        # a 200 with a body that isn't what the API documents
+        return _('Error: Translation service failed.')
+    if len(translations) != len(texts):
+        return _('Error: Translation service failed.')
+    return translations
@@ -0,0 +1,113 @@
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingWorker(object):
+    # background thread that collects keyed items and hands them to `handler` in batches.  only the latest value
+    #   is kept for each key, so a burst of changes to the same thing turns into a single write.
+    # handler(batch) gets a list of (key, value) pairs and may return the pairs that should be retried; raising
+    #   retries the whole batch.  retries back off exponentially and give up after max_retries.
+    def __init__(self, name, handler, batch_size=500, interval=1.0, max_retries=5, backoff=0.5,
+                 synchronous=False):
+        self.name = name
+        self.handler = handler
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.synchronous = synchronous  # handle everything inline, for tests and one-off scripts
+
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._flushing = 0
+        self._thread = None
+
+    def put(self, key, value):
+        if self.synchronous:
+            self._handle([(key, value)])
+            return
+
+        with self._cond:
+            self._pending.pop(key, None)  # the newest value goes to the back of the line
+            self._pending[key] = value
+            self._start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        # blocks until everything queued so far has been handled; returns False if it timed out first
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending or self._busy:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _start(self):
+        # called with the lock held; the thread is only started once there's actually something to do
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            atexit.register(self.flush, 5)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                # give changes a moment to pile up into a bigger batch, unless somebody is waiting on a flush
+                if len(self._pending) < self.batch_size and not self._flushing:
+                    self._cond.wait(self.interval)
+
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popitem(last=False))
+                self._busy = True
+
+            try:
+                self._handle(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _handle(self, batch):
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                failed = self.handler(batch)
+            except Exception:
+                logger.exception('%s: batch of %d failed (attempt %d)', self.name, len(batch), attempt + 1)
+                failed = batch
+
+            batch = list(failed or [])
+            if not self.synchronous:
+                # anything that's been changed again since can be skipped; the newer value is already queued
+                with self._cond:
+                    batch = [(key, value) for key, value in batch if key not in self._pending]
+            if not batch:
+                return
+
+            if attempt < self.max_retries:
+                time.sleep(delay)
+                delay *= 2
+
+        logger.error('%s: giving up on %d items after %d retries', self.name, len(batch), self.max_retries)
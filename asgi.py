@@ -0,0 +1,10 @@
+# script for ASGI servers, e.g. `uvicorn asgi:application`.  translations and the /stream server-sent events are
+#   handled on the event loop; every other request runs through the regular Flask app in a thread pool.  this is
+#   the place to set SSE_ENABLED, which switches on the home page's live updates.
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+from app.asgi import StreamApp, TranslationApp
+
+app = create_app()
+
+application = TranslationApp(app, fallback=StreamApp(app, fallback=WsgiToAsgi(app)))
@@ -0,0 +1,143 @@
+# builds a synthetic microblog database for the benchmarks: N users on a power-law follow graph (a few accounts
+#   followed by almost everybody, most by a handful), M posts in several languages written by a similarly skewed
+#   set of authors.  every user's password is 'password'.
+#   python benchmarks/dataset.py --users 10000 --posts 200000 --out bench.db
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+from app import create_app, db
+from app.models import Post, email_digest, rebuild_timelines, recount_users
+from config import Config
+
+PASSWORD = 'password'
+
+# a small vocabulary per language, so searches for any of these words have plenty of hits
+WORDS = {
+    'en': 'the quick brown fox jumps over lazy dog coffee morning rain city music weekend friends book garden '
+          'travel train night summer project code release bug deploy database'.split(),
+    'es': 'el la rapido zorro perro cafe manana lluvia ciudad musica fin semana amigos libro jardin viaje tren '
+          'noche verano proyecto codigo'.split(),
+    'fr': 'le la rapide renard chien cafe matin pluie ville musique semaine amis livre jardin voyage train nuit '
+          'ete projet code'.split(),
+    'de': 'der die schnell fuchs hund kaffee morgen regen stadt musik wochenende freunde buch garten reise zug '
+          'nacht sommer projekt code'.split(),
+}
+LANGUAGE_WEIGHTS = [('en', 0.6), ('es', 0.2), ('fr', 0.1), ('de', 0.1)]
+
+
+def bench_config(path, **settings):
+    # the app configuration the benchmarks run with: no log files or error emails, in-process search
+    attrs = {'TESTING': True, 'WTF_CSRF_ENABLED': False, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+             'SEARCH_BACKEND': 'database'}
+    attrs.update(settings)
+    return type('BenchConfig', (Config,), attrs)
+
+
+def zipf_weights(n, exponent):
+    # cumulative weights for picking 1..n, where the k-th most popular is picked ~1/k^exponent as often
+    total = 0.0
+    cumulative = []
+    for k in range(1, n + 1):
+        total += 1.0 / k ** exponent
+        cumulative.append(total)
+    return cumulative
+
+
+def follow_graph(rng, users, mean_follows, exponent):
+    # how many people each user follows is skewed too: most follow a few, some follow hundreds
+    ids = range(1, users + 1)
+    popularity = zipf_weights(users, exponent)
+    edges = set()
+    for follower in ids:
+        wanted = min(users - 1, int(rng.paretovariate(1.5) * mean_follows / 3))
+        for followed in rng.choices(ids, cum_weights=popularity, k=wanted):
+            if followed != follower:
+                edges.add((follower, followed))
+    return sorted(edges)
+
+
+def post_rows(rng, users, posts, exponent, days):
+    authors = zipf_weights(users, exponent)
+    languages, weights = zip(*LANGUAGE_WEIGHTS)
+    start = datetime.utcnow() - timedelta(days=days)
+    step = days * 86400.0 / max(posts, 1)
+    for i in range(posts):
+        language = rng.choices(languages, weights)[0]
+        body = ' '.join(rng.choices(WORDS[language], k=rng.randint(4, 16)))[:140]
+        author = rng.choices(range(1, users + 1), cum_weights=authors)[0]
+        yield body, (start + timedelta(seconds=i * step)).isoformat(' '), author, language
+
+
+def build(path, users=2000, posts=20000, mean_follows=30, exponent=1.1, days=30, seed=42, **settings):
+    # creates the database at `path` (which shouldn't exist yet) and returns (app, follow edges)
+    app = create_app(bench_config(path, **settings))
+    with app.app_context():
+        db.create_all()
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(PASSWORD)  # hashing it per user would take minutes
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        'INSERT INTO user (id, username, email, email_digest, password_hash, about_me, last_seen, fan_out_on_read, '
+        'followers_count, followed_count, posts_count) VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0, 0, 0)',
+        ((i, 'user{}'.format(i), 'user{}@example.com'.format(i), email_digest('user{}@example.com'.format(i)),
+          password_hash, 'benchmark user {}'.format(i), datetime.utcnow().isoformat(' '))
+         for i in range(1, users + 1)))
+
+    edges = follow_graph(rng, users, mean_follows, exponent)
+    conn.executemany('INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)', edges)
+
+    rows = post_rows(rng, users, posts, exponent, days)
+    while True:
+        chunk = list(itertools.islice(rows, 10000))
+        if not chunk:
+            break
+        conn.executemany('INSERT INTO post (body, timestamp, user_id, language) VALUES (?, ?, ?, ?)', chunk)
+    conn.commit()
+    conn.close()
+
+    with app.app_context():
+        # the bulk inserts went around the ORM, so bring the counters, search index and timelines up to date
+        recount_users()
+        Post.reindex()
+        if app.config['TIMELINE_FANOUT']:
+            rebuild_timelines()
+        db.session.execute('ANALYZE')
+        db.session.commit()
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+    return app, edges
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic microblog database.')
+    parser.add_argument('--out', required=True, help='sqlite file to create')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--mean-follows', type=int, default=30, help='roughly how many accounts a user follows')
+    parser.add_argument('--exponent', type=float, default=1.1, help='zipf exponent for popularity and activity')
+    parser.add_argument('--days', type=int, default=30, help='how far back the posts go')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        parser.error('{} already exists'.format(args.out))
+    _, edges = build(os.path.abspath(args.out), args.users, args.posts, args.mean_follows, args.exponent, args.days,
+                     args.seed)
+    print('{}: {} users, {} follows, {} posts; every password is {!r}'.format(
+        args.out, args.users, len(edges), args.posts, PASSWORD))
+
+
+if __name__ == '__main__':
+    main()
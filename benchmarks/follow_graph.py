@@ -0,0 +1,122 @@
+# times the follow-graph queries against a large synthetic graph, with and without the followers primary key,
+#   its reverse index and the post (user_id, timestamp) index
+#   python benchmarks/follow_graph.py --edges 1000000
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+def build(path, users, edges, posts, indexed, seed):
+    class BenchConfig(Config):
+        TESTING = True  # no log files or error emails
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        SEARCH_BACKEND = 'none'
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+    conn = sqlite3.connect(path)
+
+    if not indexed:
+        # the schema as it was before: no primary key and no indexes on followers, no (user_id, timestamp) index
+        conn.executescript('''
+            DROP TABLE followers;
+            CREATE TABLE followers (follower_id INTEGER REFERENCES user (id), followed_id INTEGER REFERENCES user (id));
+            DROP INDEX ix_post_user_id_timestamp;
+        ''')
+
+    rng = random.Random(seed)
+    conn.executemany('INSERT INTO user (id, username, email) VALUES (?, ?, ?)',
+                     ((i, 'user{}'.format(i), 'user{}@example.com'.format(i)) for i in range(1, users + 1)))
+
+    # a few accounts get followed by nearly everybody, most by hardly anyone
+    graph = set()
+    while len(graph) < edges:
+        follower = rng.randint(1, users)
+        followed = min(users, 1 + int(users * rng.random() ** 3))
+        if follower != followed:
+            graph.add((follower, followed))
+    conn.executemany('INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)', sorted(graph))
+
+    start = datetime(2026, 1, 1)
+    conn.executemany('INSERT INTO post (body, timestamp, user_id) VALUES (?, ?, ?)',
+                     (('post {}'.format(i), (start + timedelta(seconds=i)).isoformat(' '), rng.randint(1, users))
+                      for i in range(posts)))
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+    return app, sorted(graph)
+
+
+def measure(app, graph, repeat, seed):
+    rng = random.Random(seed)
+    samples = rng.sample(graph, repeat)
+    results = {}
+
+    def timed(name, fn):
+        times = []
+        for follower_id, followed_id in samples:
+            db.session.remove()
+            follower, followed = User.query.get(follower_id), User.query.get(followed_id)
+            begin = time.perf_counter()
+            fn(follower, followed)
+            times.append(time.perf_counter() - begin)
+            db.session.rollback()
+        results[name] = statistics.median(times) * 1000
+
+    with app.app_context():
+        timed('is_following', lambda u, v: u.is_following(v))
+        timed('followers.count (popular user)', lambda u, v: v.followers.count())
+        timed('followed.count', lambda u, v: u.followed.count())
+        timed('followed_posts page 1', lambda u, v: u.followed_posts().limit(10).all())
+        timed('unfollow + flush', lambda u, v: (u.unfollow(v), db.session.flush()))
+        db.session.remove()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time follow-graph queries before and after the followers indexes.')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=50, help='follow edges to sample for each query')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='keep the generated databases around')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='follow-graph-')
+    results = {}
+    for label, indexed in [('before', False), ('after', True)]:
+        path = os.path.join(workdir, '{}.db'.format(label))
+        print('building {} database: {} users, {} edges, {} posts...'.format(label, args.users, args.edges, args.posts))
+        app, graph = build(path, args.users, args.edges, args.posts, indexed, args.seed)
+        results[label] = measure(app, graph, args.repeat, args.seed)
+
+    print('\nmedian ms per call over {} sampled edges'.format(args.repeat))
+    print('{:<34}{:>12}{:>12}{:>10}'.format('query', 'before', 'after', 'speedup'))
+    for name in results['before']:
+        before, after = results['before'][name], results['after'][name]
+        print('{:<34}{:>12.3f}{:>12.3f}{:>9.0f}x'.format(name, before, after, before / after))
+    if args.keep:
+        print('\ndatabases left in {}'.format(workdir))
+    else:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# drives the main user journeys (home timeline, explore, profiles, search, following and posting) and reports
+#   throughput, p50/p95/p99 latency and SQL queries per request for each one.
+#   in-process, through the flask test client, on a freshly generated database:
+#     python benchmarks/journeys.py client --requests 2000
+#     python benchmarks/journeys.py client --set PAGE_CACHE= --set FRAGMENT_CACHE=
+#   against a running server (start it with INSTRUMENTATION set to get query counts), from several processes:
+#     python benchmarks/dataset.py --out bench.db
+#     DATABASE_URL=sqlite:///$PWD/bench.db INSTRUMENTATION=1 gunicorn -w 4 microblog:app
+#     python benchmarks/journeys.py http --url http://localhost:8000 --processes 8 --seconds 30
+#   --save NAME stores the results as benchmarks/baselines/NAME.json; --compare NAME checks them against a stored
+#   baseline and exits non-zero on a regression, so a change that adds queries or slows a page down shows up in review
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset import PASSWORD, WORDS, build, zipf_weights
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# journey -> share of the traffic
+MIX = [('index', 30), ('explore', 20), ('user', 20), ('search', 10), ('follow', 10), ('post', 10)]
+SEARCH_TERMS = [word for words in WORDS.values() for word in words]
+SQL_TIMING = re.compile(r'sql;desc="SQL \((\d+)\)"')
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class FlaskClient(object):
+    # the flask test client, with the same interface as HTTPClient
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        r = self.client.get(path)
+        return r.status_code, r.headers.get('Server-Timing', '')
+
+    def post(self, path, data):
+        r = self.client.post(path, data=data)
+        return r.status_code, r.headers.get('Server-Timing', '')
+
+    def login(self, username):
+        self.client.post('/auth/login', data={'username': username, 'password': PASSWORD})
+
+
+class HTTPClient(object):
+    # a keep-alive session against a running server, which has CSRF protection switched on
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.csrf_token = None
+
+    def get(self, path):
+        r = self.session.get(self.url + path, allow_redirects=False)
+        return r.status_code, r.headers.get('Server-Timing', '')
+
+    def post(self, path, data):
+        r = self.session.post(self.url + path, data=dict(data, csrf_token=self.csrf_token), allow_redirects=False)
+        return r.status_code, r.headers.get('Server-Timing', '')
+
+    def login(self, username):
+        token = CSRF_TOKEN.search(self.session.get(self.url + '/auth/login').text)
+        self.csrf_token = token.group(1) if token else None
+        self.session.post(self.url + '/auth/login', allow_redirects=False, data={
+            'username': username, 'password': PASSWORD, 'csrf_token': self.csrf_token})
+        # the token is tied to the session, which login just replaced; the home page has a fresh one
+        token = CSRF_TOKEN.search(self.session.get(self.url + '/index').text)
+        self.csrf_token = token.group(1) if token else None
+
+
+def journey(name, client, rng, popularity, users):
+    # one step of a journey; popular users get looked at (and followed) more, like on the real site
+    def someone():
+        return 'user{}'.format(rng.choices(range(1, users + 1), cum_weights=popularity)[0])
+
+    if name == 'index':
+        return client.get('/index')
+    elif name == 'explore':
+        return client.get('/explore')
+    elif name == 'user':
+        return client.get('/user/' + someone())
+    elif name == 'search':
+        return client.get('/search?q=' + rng.choice(SEARCH_TERMS))
+    elif name == 'follow':
+        return client.get('/follow/' + someone())
+    elif name == 'post':
+        language = rng.choice(list(WORDS))
+        return client.post('/index', {'post': ' '.join(rng.choices(WORDS[language], k=8))})
+
+
+def drive(client, users, requests, seconds, seed):
+    # runs a weighted mix of journeys as one logged-in user; returns [(journey, seconds, status, queries)]
+    rng = random.Random(seed)
+    popularity = zipf_weights(users, 1.1)
+    names, weights = zip(*MIX)
+    client.login('user{}'.format(rng.randint(1, users)))
+
+    samples = []
+    deadline = time.time() + seconds if seconds else None
+    while len(samples) < requests and (deadline is None or time.time() < deadline):
+        name = rng.choices(names, weights)[0]
+        begin = time.perf_counter()
+        status, timing = journey(name, client, rng, popularity, users)
+        elapsed = time.perf_counter() - begin
+        queries = SQL_TIMING.search(timing)
+        samples.append((name, elapsed, status, int(queries.group(1)) if queries else None))
+    return samples
+
+
+def http_worker(args):
+    url, users, requests, seconds, seed = args
+    return drive(HTTPClient(url), users, requests, seconds, seed)
+
+
+def percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def summarize(samples, wall_time):
+    results = {}
+    for name in [name for name, _ in MIX] + ['all']:
+        chosen = [s for s in samples if name in ('all', s[0])]
+        if not chosen:
+            continue
+        latencies = sorted(s[1] for s in chosen)
+        queries = [s[3] for s in chosen if s[3] is not None]
+        results[name] = {
+            'requests': len(chosen),
+            'errors': sum(1 for s in chosen if s[2] >= 400),
+            'throughput': round(len(chosen) / wall_time, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'queries': round(sum(queries) / len(queries), 2) if queries else None,
+        }
+    return results
+
+
+def report(results):
+    print('{:<10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'journey', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for name, r in results.items():
+        print('{:<10}{:>10}{:>8}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10}'.format(
+            name, r['requests'], r['errors'], r['throughput'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            '-' if r['queries'] is None else '{:.2f}'.format(r['queries'])))
+
+
+def compare(results, baseline, tolerance):
+    # a regression is any journey that now runs more queries per request, or whose p95 got slower by more than
+    #   `tolerance`.  latency is noisy across machines; query counts aren't, so those are held to the exact number.
+    regressions = []
+    print('\ncompared with the baseline ({:.0%} latency tolerance):'.format(tolerance))
+    for name, before in baseline['results'].items():
+        after = results.get(name)
+        if after is None:
+            continue
+        notes = []
+        if before['queries'] is not None and after['queries'] is not None and after['queries'] > before['queries']:
+            notes.append('queries {} -> {}'.format(before['queries'], after['queries']))
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            notes.append('p95 {}ms -> {}ms'.format(before['p95_ms'], after['p95_ms']))
+        print('{:<10}{:>+9.0%} p95{:>+10.2f} queries  {}'.format(
+            name, after['p95_ms'] / before['p95_ms'] - 1,
+            (after['queries'] or 0) - (before['queries'] or 0), 'REGRESSION: ' + ', '.join(notes) if notes else 'ok'))
+        if notes:
+            regressions.append(name)
+    return regressions
+
+
+def setting(value):
+    # --set KEY=VALUE, with the value read as json where it can be (numbers, true/false) and as a string otherwise
+    key, _, value = value.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the main user journeys.')
+    parser.add_argument('mode', choices=['client', 'http'], help='flask test client in-process, or http to --url')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--processes', type=int, default=4, help='http load generator processes')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per process')
+    parser.add_argument('--seconds', type=float, default=0, help='stop each process after this long')
+    parser.add_argument('--users', type=int, default=2000, help='users in the generated (or served) database')
+    parser.add_argument('--posts', type=int, default=20000, help='posts in the generated database')
+    parser.add_argument('--set', type=setting, action='append', default=[], metavar='KEY=VALUE',
+                        help='app config for client mode, e.g. --set PAGE_CACHE=')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', metavar='NAME', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='NAME', help='compare the results with a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='p95 slowdown allowed by --compare')
+    args = parser.parse_args()
+
+    settings = dict(args.set)
+    if args.mode == 'client':
+        workdir = tempfile.mkdtemp(prefix='journeys-')
+        try:
+            print('building database: {} users, {} posts...'.format(args.users, args.posts))
+            app, _ = build(os.path.join(workdir, 'bench.db'), args.users, args.posts, seed=args.seed,
+                           INSTRUMENTATION=True, **settings)
+            start = time.perf_counter()
+            samples = drive(FlaskClient(app), args.users, args.requests, args.seconds, args.seed)
+            wall_time = time.perf_counter() - start
+            app.language_detector.flush(10)  # before the database goes away
+        finally:
+            shutil.rmtree(workdir)
+    else:
+        with multiprocessing.Pool(args.processes) as pool:
+            start = time.perf_counter()
+            batches = pool.map(http_worker, [(args.url, args.users, args.requests, args.seconds, args.seed + i)
+                                             for i in range(args.processes)])
+            wall_time = time.perf_counter() - start
+        samples = [sample for batch in batches for sample in batch]
+
+    results = summarize(samples, wall_time)
+    print('\n{} mode, {} requests in {:.1f}s'.format(args.mode, len(samples), wall_time))
+    report(results)
+
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, args.save + '.json'), 'w') as f:
+            json.dump({'mode': args.mode, 'users': args.users, 'posts': args.posts, 'requests': args.requests,
+                       'processes': args.processes if args.mode == 'http' else 1, 'settings': settings,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(os.path.join(BASELINES, args.compare + '.json')) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
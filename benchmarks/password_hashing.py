@@ -0,0 +1,103 @@
+# logins per second per core for a few password hash costs, checked inline and through the PASSWORD_HASH_WORKERS
+#   process pool, plus how long a cheap request takes while a burst of logins is going on
+#   python benchmarks/password_hashing.py --workers 2 --threads 16 --seconds 5
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+from app.passwords import PasswordHasher
+
+METHODS = ['pbkdf2:sha256:50000', 'pbkdf2:sha256:150000', 'pbkdf2:sha256:260000']
+
+
+class FakeApp(object):
+    def __init__(self, method, workers):
+        self.config = {'PASSWORD_HASH_METHOD': method, 'PASSWORD_SALT_LENGTH': 8, 'PASSWORD_HASH_WORKERS': workers}
+
+
+def cheap_request():
+    # stands in for a page that's served from cache: a bit of pure python work
+    return sum(i * i for i in range(2000))
+
+
+def _time(fn):
+    begin = time.perf_counter()
+    fn()
+    return time.perf_counter() - begin
+
+
+def burst(hasher, pwhash, threads, seconds):
+    # `threads` request threads log people in as fast as they can while one more serves cheap pages; returns
+    #   (logins per second, median ms per cheap page)
+    stop = time.time() + seconds
+    logins = []
+    latencies = []
+
+    def login():
+        count = 0
+        while time.time() < stop:
+            hasher.verify(pwhash, 'password')
+            count += 1
+        logins.append(count)
+
+    def browse():
+        while time.time() < stop:
+            begin = time.perf_counter()
+            cheap_request()
+            latencies.append(time.perf_counter() - begin)
+            time.sleep(0.001)
+
+    workers = [threading.Thread(target=login) for _ in range(threads)] + [threading.Thread(target=browse)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(logins) / seconds, statistics.median(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark password checking inline and in a process pool.')
+    parser.add_argument('--workers', type=int, default=2, help='PASSWORD_HASH_WORKERS for the pooled runs')
+    parser.add_argument('--threads', type=int, default=16, help='request threads logging in at once')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    idle = statistics.median(_time(cheap_request) for _ in range(200)) * 1000
+    print('{} cores; a cheap page takes {:.2f}ms when nothing else is going on'.format(cores, idle))
+    print('{:<24}{:>14}{:>16}{:>16}{:>16}{:>16}'.format(
+        'method', 'single core/s', 'inline burst/s', 'inline page ms', 'pooled burst/s', 'pooled page ms'))
+
+    for method in METHODS:
+        pwhash = generate_password_hash('password', method)
+
+        inline = PasswordHasher(FakeApp(method, 0))
+        start = time.perf_counter()
+        count = 0
+        while time.perf_counter() - start < args.seconds / 2:
+            inline.verify(pwhash, 'password')
+            count += 1
+        single = count / (time.perf_counter() - start)
+        inline_rate, inline_page = burst(inline, pwhash, args.threads, args.seconds)
+
+        pooled = PasswordHasher(FakeApp(method, args.workers))
+        with ThreadPoolExecutor(args.workers) as warmup:
+            list(warmup.map(lambda _: pooled.verify(pwhash, 'password'), range(args.workers)))  # start the pool
+        pooled_rate, pooled_page = burst(pooled, pwhash, args.threads, args.seconds)
+        pooled.shutdown()
+
+        print('{:<24}{:>14.1f}{:>16.1f}{:>16.2f}{:>16.1f}{:>16.2f}'.format(
+            method, single, inline_rate, inline_page, pooled_rate, pooled_page))
+
+    print('\nsingle core/s is logins per second per core; the pool is capped at {} cores'.format(args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# times rendering a 50-post timeline page with and without the _post.html fragment cache
+#   python benchmarks/post_fragments.py --posts 50 --repeat 200
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template
+from flask_login import login_user
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+
+def measure(fragment_cache, posts_per_page, authors, repeat):
+    class BenchConfig(Config):
+        TESTING = True  # no log files or error emails
+        SQLALCHEMY_DATABASE_URI = 'sqlite://'
+        SEARCH_BACKEND = 'none'
+        FRAGMENT_CACHE = fragment_cache
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(authors)]
+        start = datetime(2026, 1, 1)
+        # every other post is in spanish, so half the page carries a translate link too
+        db.session.add_all(users + [
+            Post(body='post number {} with a little bit of text in it'.format(i), author=users[i % authors],
+                 language='es' if i % 2 else 'en', timestamp=start + timedelta(seconds=i))
+            for i in range(posts_per_page)])
+        db.session.commit()
+
+        with app.test_request_context('/explore', headers={'Accept-Language': 'en'}):
+            login_user(users[0])
+            app.preprocess_request()  # sets g.locale and the search form, like a real request
+            posts = Post.query.options(db.joinedload(Post.author)).order_by(Post.timestamp.desc()).all()
+
+            def render():
+                return render_template('index.html', title='Explore', posts=posts, next_url=None, prev_url=None)
+
+            first = render()  # fills the cache, when there is one
+            times = []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                page = render()
+                times.append(time.perf_counter() - begin)
+            assert page == first
+
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time timeline rendering with and without post fragment caching.')
+    parser.add_argument('--posts', type=int, default=50, help='posts on the page')
+    parser.add_argument('--authors', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    before = measure('', args.posts, args.authors, args.repeat)
+    after = measure('memory', args.posts, args.authors, args.repeat)
+
+    print('median ms to render a {}-post page over {} renders'.format(args.posts, args.repeat))
+    print('{:<24}{:>12.3f}'.format('no fragment cache', before))
+    print('{:<24}{:>12.3f}'.format('warm fragment cache', after))
+    print('{:<24}{:>11.1f}x'.format('speedup', before / after))
+
+
+if __name__ == '__main__':
+    main()
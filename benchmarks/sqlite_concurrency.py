@@ -0,0 +1,144 @@
+# runs N worker processes doing a mix of timeline reads and last_seen/post writes against one sqlite file, with the
+#   default settings, with SQLITE_OPTIMIZE, and with SQLITE_OPTIMIZE plus SQLITE_SINGLE_WRITER
+#   python benchmarks/sqlite_concurrency.py --workers 8 --seconds 10
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+MODES = [('default', False, False), ('optimized', True, False), ('single writer', True, True)]
+
+
+def make_app(path, optimize, single_writer):
+    class BenchConfig(Config):
+        TESTING = True  # no log files or error emails
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        SEARCH_BACKEND = 'none'
+        SQLITE_OPTIMIZE = optimize
+        SQLITE_SINGLE_WRITER = single_writer
+        PAGE_CACHE = ''
+
+    return create_app(BenchConfig)
+
+
+def build(path, users, posts):
+    app = make_app(path, True, False)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                            for i in range(users)])
+        db.session.commit()
+        db.session.execute(Post.__table__.insert(), [
+            {'body': 'post {}'.format(i), 'user_id': 1 + i % users, 'timestamp': datetime.utcnow()}
+            for i in range(posts)])
+        db.session.commit()
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+
+def worker(path, optimize, single_writer, users, write_ratio, seconds, seed, results):
+    app = make_app(path, optimize, single_writer)
+    rng = random.Random(seed)
+    reads = writes = locked = 0
+    latencies = []
+    deadline = time.time() + seconds
+
+    with app.app_context():
+        while time.time() < deadline:
+            user_id = rng.randint(1, users)
+            begin = time.perf_counter()
+            try:
+                if rng.random() < write_ratio:
+                    # what a request does: bump last_seen, sometimes post something
+                    user = User.query.get(user_id)
+                    user.last_seen = datetime.utcnow()
+                    if rng.random() < 0.2:
+                        db.session.add(Post(body='hello', author=user, timestamp=datetime.utcnow()))
+                    db.session.commit()
+                    writes += 1
+                else:
+                    user = User.query.get(user_id)
+                    user.followed_posts().limit(10).all()
+                    Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(10).all()
+                    db.session.rollback()
+                    reads += 1
+                latencies.append(time.perf_counter() - begin)
+            except OperationalError as e:
+                db.session.rollback()
+                if 'locked' not in str(e):
+                    raise
+                locked += 1
+            finally:
+                db.session.remove()
+
+    latencies.sort()
+    results.put((reads, writes, locked, latencies[len(latencies) // 2] if latencies else 0,
+                 latencies[int(len(latencies) * 0.99)] if latencies else 0))
+
+
+def run(path, optimize, single_writer, args):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(
+        path, optimize, single_writer, args.users, args.write_ratio, args.seconds, args.seed + i, results))
+        for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    reads = sum(o[0] for o in outcomes)
+    writes = sum(o[1] for o in outcomes)
+    locked = sum(o[2] for o in outcomes)
+    p50 = max(o[3] for o in outcomes) * 1000
+    p99 = max(o[4] for o in outcomes) * 1000
+    return (reads + writes) / args.seconds, writes / args.seconds, locked, p50, p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mixed read/write load from several processes on one sqlite file.')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--write-ratio', type=float, default=0.3, help='share of operations that write')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sqlite-concurrency-')
+    template = os.path.join(workdir, 'template.db')
+    print('building database: {} users, {} posts...'.format(args.users, args.posts))
+    build(template, args.users, args.posts)
+
+    print('\n{} workers, {:.0%} writes, {}s per mode'.format(args.workers, args.write_ratio, args.seconds))
+    print('{:<16}{:>10}{:>10}{:>10}{:>12}{:>12}'.format('mode', 'ops/s', 'writes/s', 'locked', 'p50 ms', 'p99 ms'))
+    try:
+        for label, optimize, single_writer in MODES:
+            path = os.path.join(workdir, '{}.db'.format(label.replace(' ', '-')))
+            shutil.copy(template, path)
+            if not optimize:
+                # the template was built in WAL mode; put this copy back in the default rollback journal
+                conn = sqlite3.connect(path)
+                conn.execute('PRAGMA journal_mode=DELETE')
+                conn.close()
+            ops, writes, locked, p50, p99 = run(path, optimize, single_writer, args)
+            print('{:<16}{:>10.0f}{:>10.0f}{:>10}{:>12.2f}{:>12.2f}'.format(label, ops, writes, locked, p50, p99))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
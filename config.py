@@ -10,27 +10,157 @@ class Config(object):
     # prefer secret keys set at the environment level, providing an alternative if that doesn't exist
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
 
+    # werkzeug hash method, cost included ('pbkdf2:sha256:260000'); stored hashes made with anything else are
+    #   upgraded when their owner next logs in
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+    # processes that hash and check passwords, which caps the CPU a burst of logins can use.  0, the default, hashes
+    #   inline; the pool is worth it for web servers with many threads per process, not for CLI commands or tests
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0)
+
     # use the environment's db url; if missing, use this sqlite path
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
 
     # should SQLAlchemy send a notification to the app every time an object changes?
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # connection pool for database servers (sqlite keeps the pool Flask-SQLAlchemy picks for it)
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)  # extra connections under load
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT') or 30)  # seconds to wait for a connection
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)  # seconds before reconnecting
+    DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_NO_PRE_PING') is None  # check connections before use
+
+    # comma-separated read replica urls; read-only views read from these, except for users who've just written
+    DATABASE_REPLICA_URLS = [url for url in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
+    SQLALCHEMY_BINDS = {'replica{}'.format(i): url for i, url in enumerate(DATABASE_REPLICA_URLS)}
+    DATABASE_READ_YOUR_WRITES = int(os.environ.get('DATABASE_READ_YOUR_WRITES') or 5)  # seconds
+
+    # sqlite tuned for several workers at once: WAL journaling, relaxed syncing, a bigger cache, memory-mapped reads,
+    #   pooled connections and a busy timeout.  SQLITE_SINGLE_WRITER also queues writers up behind a lock so they
+    #   never collide inside sqlite at all
+    SQLITE_OPTIMIZE = os.environ.get('SQLITE_OPTIMIZE') is not None
+    SQLITE_SINGLE_WRITER = os.environ.get('SQLITE_SINGLE_WRITER') is not None
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)  # milliseconds
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or 64000)  # KiB per connection
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)  # bytes
+
     # email server config.  For virtual server: python -m smtpd -n -c DebuggingServer localhost:8025
     MAIL_SERVER = os.environ.get('MAIL_SERVER')  # or 'smtp.gmail.com'
 
-    MAIL_PORT = int(os.environ.get('MAIL_PORT')) or 25  # default port for non-SSL email
+    MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)  # default port for non-SSL email
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = [os.environ.get('ADMINS')]
 
     if MAIL_SERVER != 'smtp.gmail.com':
-        MAIL_PORT = int(os.environ.get('MAIL_PORT')) or 25  # default port for non-SSL email
+        MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)  # default port for non-SSL email
         MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
 
+    # outgoing mail is queued in the database and sent by a fixed pool of worker threads, batched per connection
+    MAIL_QUEUE_WORKERS = int(os.environ.get('MAIL_QUEUE_WORKERS') or 2)
+    MAIL_QUEUE_BATCH_SIZE = int(os.environ.get('MAIL_QUEUE_BATCH_SIZE') or 20)  # messages per smtp connection
+    MAIL_QUEUE_POLL_INTERVAL = float(os.environ.get('MAIL_QUEUE_POLL_INTERVAL') or 5)  # seconds
+    MAIL_QUEUE_MAX_ATTEMPTS = int(os.environ.get('MAIL_QUEUE_MAX_ATTEMPTS') or 5)
+    MAIL_QUEUE_BACKOFF = float(os.environ.get('MAIL_QUEUE_BACKOFF') or 30)  # seconds before the first retry, then x2
+    MAIL_QUEUE_CLAIM_TIMEOUT = int(os.environ.get('MAIL_QUEUE_CLAIM_TIMEOUT') or 300)  # seconds
+
+    # write a user's last_seen at most this often (in seconds), instead of committing on every request
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or 60)
+    # collect last_seen times in memory and flush them all in one bulk UPDATE every LAST_SEEN_FLUSH_INTERVAL
+    LAST_SEEN_BUFFERED = os.environ.get('LAST_SEEN_BUFFERED') is not None
+    LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+
     POSTS_PER_PAGE = 10
+    # 'keyset' pages through timelines with opaque cursors; 'offset' uses the old ?page=N numbering
+    POSTS_PAGINATION = os.environ.get('POSTS_PAGINATION') or 'keyset'
+
+    # who's logged in, so authenticated requests skip the user lookup: 'memory', 'sqlite:///path/to/cache.db' or
+    #   'redis://...'; empty looks the user up on every request
+    USER_CACHE = os.environ.get('USER_CACHE', 'memory')
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)  # entries, for 'memory'
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)  # seconds
+    # live home timelines (/stream): 'memory' for a single process, or 'redis://...' to share new posts between
+    #   processes and machines
+    PUBSUB_BROKER = os.environ.get('PUBSUB_BROKER') or 'memory'
+    # live updates on the home page, off by default: only turn them on when /stream is served by asgi.py or by
+    #   async (gevent) workers, since each open page holds its stream for SSE_MAX_AGE and would tie up a sync worker
+    SSE_ENABLED = os.environ.get('SSE_ENABLED') is not None
+    SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT') or 15)  # seconds between keepalives on an idle stream
+    SSE_MAX_AGE = float(os.environ.get('SSE_MAX_AGE') or 300)  # seconds before a stream closes and reconnects
+    SSE_RETRY = int(os.environ.get('SSE_RETRY') or 3000)  # milliseconds browsers wait before reconnecting
+    SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE') or 100)  # undelivered posts before a stream resets
+
+    # the json api under /api: how long tokens from POST /api/tokens last, and how many posts a page holds
+    API_TOKEN_EXPIRES = int(os.environ.get('API_TOKEN_EXPIRES') or 86400)  # seconds
+    API_POSTS_PER_PAGE = int(os.environ.get('API_POSTS_PER_PAGE') or 20)
+    API_MAX_POSTS_PER_PAGE = int(os.environ.get('API_MAX_POSTS_PER_PAGE') or 100)  # the most ?limit= can ask for
+
+    # rendered /explore and /user/<username> pages: 'memory', 'sqlite:///path/to/cache.db' or 'redis://...'; empty
+    #   turns the cache (and its ETag/Last-Modified headers) off
+    PAGE_CACHE = os.environ.get('PAGE_CACHE', 'memory')
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE') or 1024)  # entries, for 'memory'
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL') or 300)  # seconds
+    # where the page cache keeps track of which pages a write has made stale: 'database', or 'cache' (alongside the
+    #   pages).  it has to be somewhere every process sees, so the default is the cache when that's shared and the
+    #   database (one lookup per cached page view) when it's 'memory'; 'cache' with 'memory' is for a single process
+    PAGE_CACHE_GENERATIONS = os.environ.get('PAGE_CACHE_GENERATIONS') or None
+    # each post's rendered _post.html, per locale, shared by every page the post appears on
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'memory')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)  # entries, for 'memory'
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 3600)  # seconds
+
+    # precompute home timelines when posts are written instead of building them on every page load
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT') is not None
+    # authors with more followers than this aren't pushed to; their posts get merged in when timelines are read
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
     LANGUAGES = ['en', 'es']
 
+    # serve avatars from our own domain, fetching each one from gravatar once and keeping it on disk
+    AVATAR_PROXY = os.environ.get('AVATAR_PROXY') is not None
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or os.path.join(basedir, 'avatars')
+    AVATAR_MAX_AGE = int(os.environ.get('AVATAR_MAX_AGE') or 86400)  # seconds browsers may keep them
+    AVATAR_CACHE_MAX_FILES = int(os.environ.get('AVATAR_CACHE_MAX_FILES') or 10000)  # oldest are dropped past this
+
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY') or None
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or 'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_TIMEOUT = float(os.environ.get('MS_TRANSLATOR_TIMEOUT') or 10)  # seconds
+    MS_TRANSLATOR_POOL_SIZE = int(os.environ.get('MS_TRANSLATOR_POOL_SIZE') or 10)  # keep-alive connections
+    # the async translation path (asgi.py): upstream calls open at once, and when to stop calling a failing API
+    ASYNC_TRANSLATOR_CONCURRENCY = int(os.environ.get('ASYNC_TRANSLATOR_CONCURRENCY') or 100)
+    MS_TRANSLATOR_BREAKER_THRESHOLD = int(os.environ.get('MS_TRANSLATOR_BREAKER_THRESHOLD') or 5)  # failures in a row
+    MS_TRANSLATOR_BREAKER_RESET = int(os.environ.get('MS_TRANSLATOR_BREAKER_RESET') or 30)  # seconds
+    # 'memory', 'sqlite:///path/to/cache.db' or 'redis://host:port/db'; empty turns caching off
+    TRANSLATION_CACHE = os.environ.get('TRANSLATION_CACHE', 'memory')
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 4096)  # entries, for 'memory'
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 7 * 86400)  # seconds
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL') or None
+    # 'elasticsearch', 'database' (sqlite FTS5 / postgres tsvector), 'none', or a 'package.module:Class' path
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or ('elasticsearch' if ELASTICSEARCH_URL else 'database')
+    # cache of (index, query, page) -> ranked ids; index writes invalidate it.  a size of 0 turns it off.
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)  # seconds
+
+    # new posts get their language detected in a background thread after they're committed; set
+    #   LANGUAGE_DETECTION_SYNC to detect inline (still after the commit) instead
+    LANGUAGE_DETECTION_ASYNC = os.environ.get('LANGUAGE_DETECTION_SYNC') is None
+    LANGUAGE_DETECTION_BATCH_SIZE = int(os.environ.get('LANGUAGE_DETECTION_BATCH_SIZE') or 100)
+    LANGUAGE_DETECTION_INTERVAL = float(os.environ.get('LANGUAGE_DETECTION_INTERVAL') or 0.5)  # seconds
+
+    # request instrumentation: Server-Timing headers (app, sql, templates, elasticsearch, translator) on every
+    #   response, and Prometheus metrics at /metrics for scrapers that send METRICS_TOKEN as a bearer token (no
+    #   token, no /metrics)
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION') is not None
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+    # profile this share of requests, keeping a cProfile dump in PROFILE_DIR for those slower than
+    #   PROFILE_SLOW_REQUESTS seconds (0 turns profiling off); open them with snakeviz or pstats
+    PROFILE_SLOW_REQUESTS = float(os.environ.get('PROFILE_SLOW_REQUESTS') or 0)
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0.1)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+
+    # search index writes are batched up and sent from a background thread; set SEARCH_INDEX_SYNC to send them inline
+    SEARCH_INDEX_ASYNC = os.environ.get('SEARCH_INDEX_SYNC') is None
+    SEARCH_INDEX_BATCH_SIZE = int(os.environ.get('SEARCH_INDEX_BATCH_SIZE') or 500)
+    SEARCH_INDEX_INTERVAL = float(os.environ.get('SEARCH_INDEX_INTERVAL') or 1.0)  # seconds to wait for a batch
+    SEARCH_INDEX_MAX_RETRIES = int(os.environ.get('SEARCH_INDEX_MAX_RETRIES') or 5)
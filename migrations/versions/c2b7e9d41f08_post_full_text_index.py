@@ -0,0 +1,34 @@
+"""full-text index on post for the database search backend
+
+Revision ID: c2b7e9d41f08
+Revises: 8f3a61c4d2e7
+Create Date: 2026-10-18 14:03:27.906215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2b7e9d41f08'
+down_revision = '8f3a61c4d2e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+        op.execute('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute("CREATE INDEX IF NOT EXISTS ix_post_fts ON post USING gin "
+                   "(to_tsvector('simple', coalesce(body, '')))")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS post_fts')
+    elif dialect == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_post_fts')
@@ -0,0 +1,51 @@
+"""primary key and reverse index on followers, post (user_id, timestamp) index
+
+Revision ID: e7a93f215bd6
+Revises: d41b6a0e7c53
+Create Date: 2026-10-18 16:48:09.631702
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a93f215bd6'
+down_revision = 'd41b6a0e7c53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a primary key can't be added to an existing sqlite table, and any duplicate edges would violate it anyway,
+    #   so copy the distinct rows into a new table and swap it in
+    op.create_table('_followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO _followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('_followers_new', 'followers')
+    op.create_index('ix_followers_followed_follower', 'followers', ['followed_id', 'follower_id'], unique=False)
+
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+
+    op.drop_index('ix_followers_followed_follower', table_name='followers')
+    op.create_table('_followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO _followers_old (follower_id, followed_id) SELECT follower_id, followed_id FROM followers')
+    op.drop_table('followers')
+    op.rename_table('_followers_old', 'followers')
@@ -1,13 +1,46 @@
 from datetime import datetime, timedelta
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import asyncio
+import base64
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import pickle
+import socketserver
+import sqlite3
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from elasticsearch import Connection, Transport
+from flask import template_rendered
+from flask_babel import lazy_gettext as _l
+from app import create_app, db, search
+from app.activity import create_last_seen_buffer
+from app.asgi import AsyncTranslator, StreamApp, TranslationApp, TranslationError
+from app.cache import LRUCache, create_cache
+from app.database import TimedQueuePool
+from app.email import send_email
+from app.language import detect_language, detect_languages
+from app.main.caching import DatabaseGenerations, PageCache
+from app.main.routes import prune_avatars
+from app.metrics import metrics
+from app.models import User, Post, OutboundEmail, load_user, rebuild_timelines, recount_users
+from app.pagination import PREV, encode_cursor, paginate_keyset
+from app.passwords import PasswordHasher
+from app.pubsub import Hub, author_channel
+from app.translate import translate, translate_many
+from app.worker import CoalescingWorker
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    LANGUAGE_DETECTION_ASYNC = False
+    PASSWORD_HASH_WORKERS = 0
 
 
 class UserModelCase(unittest.TestCase):
@@ -29,10 +62,78 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertFalse(u.password_needs_rehash())
+
+        # a higher cost makes the old hash outdated; logging in upgrades it
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:200000'
+        self.app.password_hasher = PasswordHasher(self.app)
+        self.assertTrue(u.password_needs_rehash())
+        self.app.test_client().post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        db.session.expire_all()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:200000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_method_validation(self):
+        # sha512 hashes are longer than the old 128-character column; they have to fit the current one
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha512:150000'
+        self.assertEqual(len(PasswordHasher(self.app).hash('cat')), 158)
+        for method in ('plain', 'pbkdf2:nope:1000', 'pbkdf2:sha256:lots'):
+            self.app.config['PASSWORD_HASH_METHOD'] = method
+            with self.assertRaises(ValueError):
+                PasswordHasher(self.app)
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha512:150000'
+        self.app.config['PASSWORD_SALT_LENGTH'] = 200
+        with self.assertRaises(ValueError):
+            PasswordHasher(self.app)
+
+    def test_password_pool(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        hasher = PasswordHasher(self.app)
+        try:
+            pwhash = hasher.hash('cat')
+            self.assertTrue(hasher.verify(pwhash, 'cat'))
+            self.assertFalse(hasher.verify(pwhash, 'dog'))
+        finally:
+            hasher.shutdown()
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), 'https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=identicon&s=128')
 
+        # the digest follows email changes
+        u.email = 'John@Example.com'
+        self.assertEqual(u.email_digest, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertNotIn('d4c74594d841139328695756648b6bd6', u.avatar(128))
+
+        self.app.config['AVATAR_PROXY'] = True
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(70), '/avatar/{}/70'.format(u.email_digest))
+            self.assertTrue(u.avatar(128).startswith('https://www.gravatar.com/'))  # not a size the pages use
+
+        # the proxy is only there for logged-in users, and only fetches the sizes the pages use
+        client = self.app.test_client()
+        self.assertEqual(client.get('/avatar/{}/70'.format(u.email_digest)).status_code, 302)
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertEqual(client.get('/avatar/{}/2048'.format(u.email_digest)).status_code, 404)
+
+    def test_prune_avatars(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for i in range(5):
+                path = os.path.join(cache_dir, '{}-70'.format(i))
+                open(path, 'wb').close()
+                os.utime(path, (i, i))
+            prune_avatars(cache_dir, 3)
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['2-70', '3-70', '4-70'])
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -54,6 +155,35 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        u1.follow(u2)
+        u1.follow(u3)
+        u3.follow(u2)
+        p = Post(body='post from susan', author=u2)
+        db.session.add_all([p, Post(body='another post from susan', author=u2)])
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.followed_count, u1.posts_count), (0, 2, 0))
+        self.assertEqual((u2.followers_count, u2.followed_count, u2.posts_count), (2, 0, 2))
+
+        u1.unfollow(u2)
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual((u2.followers_count, u2.posts_count), (1, 1))
+        self.assertEqual(u1.followed_count, 1)
+
+        # drift gets repaired in bulk
+        u3.followers_count = 40
+        db.session.commit()
+        self.assertEqual(recount_users(), 1)
+        self.assertEqual(recount_users(), 0)
+        self.assertEqual(u3.followers_count, 1)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -92,6 +222,1249 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+
+        # pairs of posts share a timestamp, so the id has to break the tie
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u1 if i % 3 else u2,
+                      timestamp=now + timedelta(seconds=i // 2)) for i in range(25)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+        key = (Post.timestamp, Post.id)
+
+        # walk forwards through every page, then back again
+        pages, cursor = [], None
+        while True:
+            page = paginate_keyset(Post.query, key, cursor, 10)
+            pages.append(page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual([len(items) for items in pages], [10, 10, 5])
+        self.assertEqual([p for items in pages for p in items], newest_first)
+
+        page = paginate_keyset(Post.query, key, page.prev_cursor, 10)
+        self.assertEqual(page.items, pages[1])
+        page = paginate_keyset(Post.query, key, page.prev_cursor, 10)
+        self.assertEqual(page.items, pages[0])
+        self.assertFalse(page.has_prev)
+
+        # a new post doesn't shift the page behind an existing cursor
+        db.session.add(Post(body='late post', author=u2, timestamp=now + timedelta(seconds=60)))
+        db.session.commit()
+        self.assertEqual(paginate_keyset(Post.query, key, cursor, 10).items, pages[2])
+
+        # the home timeline's UNION query pages the same way
+        page = paginate_keyset(u1.followed_posts(), key, None, 10)
+        self.assertEqual(page.items[0].body, 'late post')
+        self.assertEqual(paginate_keyset(u1.followed_posts(), key, page.next_cursor, 10).items,
+                         newest_first[9:19])
+
+        # a prev cursor with nothing newer than it starts over from the first page
+        late = Post.query.filter_by(body='late post').first()
+        page = paginate_keyset(Post.query, key, encode_cursor(PREV, late.timestamp, late.id), 10)
+        self.assertEqual([p.body for p in page.items[:2]], ['late post', newest_first[0].body])
+
+        # a garbage cursor falls back to the first page
+        self.assertEqual(paginate_keyset(Post.query, key, 'not-a-cursor', 10).items[0].body, 'late post')
+
+    def test_fan_out_timeline(self):
+        self.app.config['TIMELINE_FANOUT'] = True
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1, timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        p1.fan_out()
+        db.session.commit()
+
+        # following backfills what's already been posted
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u2.home_timeline()[0].all(), [p1])
+
+        # new posts get pushed to followers, until there are too many followers to push to
+        p2 = Post(body="post from susan", author=u2, timestamp=now + timedelta(seconds=2))
+        db.session.add(p2)
+        p2.fan_out()
+        u3.follow(u1)
+        db.session.commit()
+        p3 = Post(body="another post from john", author=u1, timestamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        p3.fan_out()
+        db.session.commit()
+        self.assertTrue(u1.fan_out_on_read)
+        self.assertEqual(u2.home_timeline()[0].all(), [p3, p2, p1])
+        self.assertEqual(u3.home_timeline()[0].all(), [p3, p1])
+
+        # unfollowing prunes the timeline back down
+        u2.unfollow(u1)
+        db.session.commit()
+        self.assertEqual(u2.home_timeline()[0].all(), [p2])
+
+        # a full rebuild matches the fan-out-on-read query for everybody
+        rebuild_timelines()
+        for u in [u1, u2, u3]:
+            self.assertEqual(u.home_timeline()[0].all(), u.followed_posts().all())
+
+    def test_database_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a quick fox and a quick dog', author=u)
+        p3 = Post(body='nothing to see here', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search('quick', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts), {p1, p2})
+        self.assertEqual(Post.search('"unbalanced quick', 1, 10)[1], 0)
+
+        # the index follows edits and deletes, and rolled-back changes never make it in
+        p3.body = 'a quick look'
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(set(Post.search('quick', 1, 10)[0]), {p2, p3})
+        p2.body = 'changed my mind'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(set(Post.search('quick', 1, 10)[0]), {p2, p3})
+
+    def test_search_result_cache(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post number {}'.format(i), author=u) for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+
+        first, total = Post.search('post', 1, 3)
+        self.assertEqual((len(first), total), (3, 5))
+        self.assertEqual(len(Post.search('post', 2, 3)[0]), 2)
+        self.assertEqual(Post.search('post', 1, 3)[0], first)  # same ranking order every time
+        self.assertEqual(len(self.app.search_cache), 2)
+
+        # writing to the index orphans the cached results
+        db.session.add(Post(body='one more post', author=u))
+        db.session.commit()
+        self.assertEqual(Post.search('post', 1, 3)[1], 6)
+
+
+class ViewQueryCase(unittest.TestCase):
+    # rendering a page of posts should take a fixed number of queries, no matter how many authors are on it
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(10)]
+        for u in users:
+            u.set_password('cat')
+        now = datetime.utcnow()
+        posts = [Post(body='post {} from {}'.format(i, u.username), author=u, timestamp=now + timedelta(seconds=i))
+                 for i, u in enumerate(users * 2)]
+        db.session.add_all(users + posts)
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.commit()
+
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        # start from an empty session, the way a real request would
+        db.session.remove()
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertLessEqual(len(statements), limit, '{} queries:\n{}'.format(
+            len(statements), '\n'.join(statements)))
+
+    def test_post_lists(self):
+        # explore and profiles include looking up (and starting) the page cache's generation for the page
+        for url, limit in [('/index', 5), ('/explore', 4), ('/user/user3', 6), ('/search?q=post', 5)]:
+            with self.assertMaxQueries(limit):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'post', response.data)
+
+    def test_page_cache(self):
+        first = self.client.get('/explore')
+        etag = first.headers['ETag']
+        self.assertIn('Last-Modified', first.headers)
+
+        # a repeat view doesn't touch the posts at all, and a browser that has the page gets a 304
+        with self.assertMaxQueries(1):
+            second = self.client.get('/explore')
+        self.assertEqual(second.data, first.data)
+        conditional = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual((conditional.status_code, conditional.data), (304, b''))
+        conditional = self.client.get('/explore', headers={'If-Modified-Since': first.headers['Last-Modified']})
+        self.assertEqual(conditional.status_code, 304)
+
+        # a new post invalidates explore and the author's page
+        self.client.get('/user/user0')
+        user = User.query.filter_by(username='user0').first()
+        db.session.add(Post(body='brand new post', author=user, timestamp=datetime.utcnow() + timedelta(hours=1)))
+        db.session.commit()
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(b'brand new post', response.data)
+        self.assertIn(b'brand new post', self.client.get('/user/user0').data)
+
+    def test_page_cache_across_processes(self):
+        # a write handled by another worker, with its own in-memory page cache, still makes this one's pages stale
+        first = self.client.get('/explore')
+        other_worker = PageCache(LRUCache(), DatabaseGenerations())
+        other_worker.invalidate('explore')
+        response = self.client.get('/explore', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], first.headers['ETag'])
+
+    def test_page_cache_follow(self):
+        self.assertIn(b'Unfollow', self.client.get('/user/user3').data)
+        self.client.get('/unfollow/user3')  # redirects to the profile with a flash, which isn't cached
+        self.assertIn(b'>Follow<', self.client.get('/user/user3').data)
+
+    def test_post_fragments(self):
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+
+        self.client.get('/index')
+        with template_rendered.connected_to(record, self.app):
+            self.client.get('/index')
+        self.assertNotIn('_post.html', rendered)  # every post came out of the fragment cache
+
+        # edits and renames show up straight away
+        post = Post.query.filter_by(body='post 19 from user9').first()
+        post.body = 'edited post'
+        User.query.filter_by(username='user8').first().username = 'renamed'
+        db.session.commit()
+        data = self.client.get('/index').data
+        self.assertIn(b'edited post', data)
+        self.assertIn(b'>renamed</a>', data)
+        self.assertNotIn(b'>user8</a>', data)
+
+    def test_user_cache(self):
+        # once the user and the page are cached, a repeat view only checks the page is still current
+        self.client.get('/explore')
+        with self.assertMaxQueries(1):
+            self.assertEqual(self.client.get('/explore').status_code, 200)
+
+        # the password hash isn't cached, but a cached user still loads it when asked
+        id = User.query.filter_by(username='user0').first().id
+        self.assertNotIn('password_hash', self.app.user_cache.get(('user', id)))
+        db.session.remove()
+        self.assertTrue(load_user(id).check_password('cat'))
+
+        # a profile edit drops the cached user, so the rename shows up in the navbar straight away
+        self.client.post('/edit_profile', data={'username': 'renamed', 'about_me': 'hi'})
+        self.assertIn(b'/user/renamed', self.client.get('/explore').data)
+
+    def test_last_seen_throttle(self):
+        user = User.query.filter_by(username='user0').first()
+        user.last_seen = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+        id = user.id
+
+        # only the first of several requests inside LAST_SEEN_INTERVAL writes anything
+        with self.assertMaxQueries(100) as statements:
+            for _ in range(3):
+                db.session.remove()
+                self.client.get('/explore')
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE user SET last_seen')]), 1)
+        self.assertGreater(User.query.get(id).last_seen, datetime.utcnow() - timedelta(minutes=1))
+
+    def test_last_seen_buffered(self):
+        self.app.config['LAST_SEEN_BUFFERED'] = True
+        self.app.last_seen_buffer = create_last_seen_buffer(self.app)
+        db.session.execute(User.__table__.update().values(last_seen=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+
+        # requests don't write at all; the buffer does it later in one go
+        with self.assertMaxQueries(100) as statements:
+            self.client.get('/explore')
+        self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+        self.assertTrue(self.app.last_seen_buffer.flush(timeout=5))
+        db.session.remove()
+        self.assertGreater(User.query.filter_by(username='user0').first().last_seen,
+                           datetime.utcnow() - timedelta(minutes=1))
+
+
+class FakeElasticsearch(object):
+    # just enough of an elasticsearch client for the indexer and rebuild_index: indices, aliases and bulk writes.
+    #   ids in `fail_once` are refused the first time they're written
+    def __init__(self):
+        self.docs = {}
+        self.aliases = {}
+        self.alias_updates = []
+        self.fail_once = set()
+        self.indices = self
+        self.transport = Transport([{}], connection_class=Connection)
+
+    def resolve(self, name):
+        return next(iter(self.aliases[name])) if name in self.aliases else name
+
+    def exists(self, index):
+        return index in self.docs or index in self.aliases
+
+    def create(self, index):
+        self.docs[index] = {}
+
+    def delete(self, index):
+        del self.docs[index]
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {index: {'aliases': {name: {}}} for index in self.aliases[name]}
+
+    def update_aliases(self, body):
+        self.alias_updates.append(body['actions'])
+        for action in body['actions']:
+            (op, args), = action.items()
+            if op == 'add':
+                self.aliases.setdefault(args['alias'], set()).add(args['index'])
+            elif op == 'remove':
+                self.aliases[args['alias']].discard(args['index'])
+                if not self.aliases[args['alias']]:
+                    del self.aliases[args['alias']]
+            elif op == 'remove_index':
+                del self.docs[args['index']]
+
+    def bulk(self, body, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        while lines:
+            (op, meta), = lines.pop(0).items()
+            index, id = self.resolve(meta['_index']), int(meta['_id'])
+            source = lines.pop(0) if op == 'index' else None
+            status = 200
+            if id in self.fail_once:
+                self.fail_once.discard(id)
+                status = 503
+            elif op == 'index':
+                self.docs[index][id] = source
+            else:
+                status = 200 if self.docs[index].pop(id, None) else 404
+            items.append({op: dict(meta, _index=index, status=status)})
+        return {'errors': any(item[op]['status'] >= 300 for item in items), 'items': items}
+
+
+class ElasticsearchRebuildCase(unittest.TestCase):
+    def setUp(self):
+        class ElasticsearchConfig(TestConfig):
+            SEARCH_BACKEND = 'elasticsearch'
+            SEARCH_INDEX_ASYNC = False
+            SEARCH_CACHE_SIZE = 0
+
+        self.app = create_app(ElasticsearchConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.es = self.app.elasticsearch = FakeElasticsearch()
+        self.es.create('post')  # a plain index, from before aliases were used
+        self.check_interval, search.REBUILD_CHECK_INTERVAL = search.REBUILD_CHECK_INTERVAL, 0
+
+    def tearDown(self):
+        search.REBUILD_CHECK_INTERVAL = self.check_interval
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_rebuild(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post {}'.format(i), author=u) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(sorted(self.es.docs['post']), [1, 2, 3, 4])
+
+        # writes made during a rebuild go to the new index too
+        self.es.create('post-new')
+        self.es.update_aliases({'actions': [{'add': {'index': 'post-new', 'alias': 'post-rebuilding'}}]})
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertEqual(sorted(self.es.docs['post']), [2, 3, 4])
+
+        # a document that fails is retried, and the checkpoint doesn't move past it until it's in
+        self.es.fail_once = {3}
+        self.assertEqual(Post.reindex(into='post-new', chunk_size=2, threads=1), ('post-new', 4))
+        self.assertEqual(sorted(self.es.docs['post-new']), [2, 3, 4])
+
+        # the old index is dropped and the alias added in the same update, and the marker goes with it
+        self.assertEqual([list(action) for action in self.es.alias_updates[-1]],
+                         [['remove_index'], ['remove'], ['add']])
+        self.assertEqual(self.es.aliases, {'post': {'post-new'}})
+
+    def test_result_cache_generation(self):
+        # cached results only go stale once the queued write has reached elasticsearch, or a search made in
+        #   between would cache the old results under the new generation
+        self.app.search_cache = search.ResultCache(16, 60)
+        backend = self.app.search
+        backend.indexer = CoalescingWorker('test-indexer', backend.send_bulk, interval=10)
+        db.session.add(Post(body='hello', author=User(username='john', email='john@example.com')))
+        db.session.commit()
+        self.assertEqual(self.app.search_cache.generations, {})
+        self.assertTrue(search.flush_index(timeout=5))
+        self.assertEqual(self.app.search_cache.generations, {'post': 1})
+
+
+class SharedCacheCase(unittest.TestCase):
+    def test_signed_values(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = 'sqlite:///' + os.path.join(tmp, 'cache.db')
+            cache = create_cache(url, secret='key')
+            cache.set('a', {'n': 1})
+            self.assertEqual(cache.get('a'), {'n': 1})
+
+            # whatever somebody else wrote into the file, or signed with another key, is just a miss
+            self.assertIsNone(create_cache(url, secret='other key').get('a'))
+            with sqlite3.connect(os.path.join(tmp, 'cache.db')) as conn:
+                conn.execute('UPDATE cache SET value = ?', (b'\0' * 32 + pickle.dumps({'n': 2}),))
+            self.assertEqual(cache.get('a', 'missing'), 'missing')
+            self.assertRaises(ValueError, create_cache, url)
+
+
+class CoalescingWorkerCase(unittest.TestCase):
+    def test_batches_and_retries(self):
+        batches = []
+        failures = [2]  # the first two attempts blow up
+        release = threading.Event()
+
+        def handler(batch):
+            release.wait(5)
+            if failures[0]:
+                failures[0] -= 1
+                raise IOError('search cluster is down')
+            batches.append(sorted(batch))
+
+        worker = CoalescingWorker('test-worker', handler, interval=0.01, backoff=0.01)
+        worker.put('a', 1)
+        worker.put('b', 1)
+        worker.put('a', 2)  # replaces the first write to 'a'
+        worker.put('c', None)
+        release.set()
+
+        self.assertTrue(worker.flush(timeout=5))
+        self.assertEqual(len(worker), 0)
+        self.assertEqual(sorted(item for batch in batches for item in batch), [('a', 2), ('b', 1), ('c', None)])
+
+
+class FakeTranslator(object):
+    # a local stand-in for the Azure translation API: "translates" by upper-casing and counts the calls it gets.
+    #   set `content` to answer with that instead
+    def __init__(self):
+        self.requests = []
+        self.content = None
+        translator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real thing
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                translator.requests.append((self.path, body))
+                to = self.path.split('to=')[-1]
+                content = translator.content or json.dumps([{'translations': [{'text': item['Text'].upper(), 'to': to}]}
+                                                            for item in body]).encode('utf-8-sig')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.translator = FakeTranslator()
+
+        class TranslateConfig(TestConfig):
+            MS_TRANSLATOR_KEY = 'test-key'
+            MS_TRANSLATOR_URL = self.translator.url
+
+        self.app = create_app(TranslateConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.translator.close()
+
+    def test_cache(self):
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(len(self.translator.requests), 1)
+
+        # a different language pair is a different entry
+        self.assertEqual(translate('hola', 'es', 'fr'), 'HOLA')
+        self.assertEqual(len(self.translator.requests), 2)
+
+    def test_batch(self):
+        translate('uno', 'es', 'en')
+        self.translator.requests.clear()
+
+        # only the uncached texts go upstream, in one call, and duplicates are sent once
+        self.assertEqual(translate_many(['uno', 'dos', 'tres', 'dos'], 'es', 'en'), ['UNO', 'DOS', 'TRES', 'DOS'])
+        self.assertEqual(len(self.translator.requests), 1)
+        self.assertEqual(self.translator.requests[0][1], [{'Text': 'dos'}, {'Text': 'tres'}])
+
+    def test_bad_response(self):
+        # a 200 that isn't json, or that's short of a translation, is an error for every text (and isn't cached)
+        error = 'Error: Translation service failed.'
+        with self.app.test_request_context():
+            self.translator.content = b'<html>oops</html>'
+            self.assertEqual(translate_many(['uno', 'dos'], 'es', 'en'), [error, error])
+            self.translator.content = json.dumps([{'translations': [{'text': 'ONE', 'to': 'en'}]}]).encode('utf-8')
+            self.assertEqual(translate_many(['uno', 'dos'], 'es', 'en'), [error, error])
+        self.translator.content = None
+        self.assertEqual(translate_many(['uno', 'dos'], 'es', 'en'), ['UNO', 'DOS'])
+
+    def test_batch_endpoint(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+
+        response = client.post('/translate_batch', json={'dest_language': 'en', 'items': [
+            {'id': 1, 'text': 'hola', 'source_language': 'es'},
+            {'id': 2, 'text': 'adios', 'source_language': 'es'},
+            {'id': 3, 'text': 'bonjour', 'source_language': 'fr'}]})
+        self.assertEqual(response.get_json(), {'translations': {'1': 'HOLA', '2': 'ADIOS', '3': 'BONJOUR'}})
+        self.assertEqual(len(self.translator.requests), 2)  # one per source language
+
+
+class AsyncTranslateCase(unittest.TestCase):
+    def setUp(self):
+        class TranslateConfig(TestConfig):
+            MS_TRANSLATOR_KEY = 'test-key'
+            ASYNC_TRANSLATOR_CONCURRENCY = 5
+            MS_TRANSLATOR_BREAKER_THRESHOLD = 3
+
+        self.app = create_app(TranslateConfig)
+        self.calls = []
+        self.open = 0
+        self.most_open = 0
+        self.fail = False
+
+    async def fetch(self, url, params, headers, body):
+        # stands in for the translation API: slow enough that calls pile up, and keeps track of how many overlap
+        self.calls.append(body)
+        self.open += 1
+        self.most_open = max(self.most_open, self.open)
+        try:
+            await asyncio.sleep(0.01)
+            if self.fail:
+                raise IOError('connection reset')
+            content = json.dumps([{'translations': [{'text': item['Text'].upper(), 'to': params['to']}]}
+                                  for item in body]).encode('utf-8-sig')
+            return 200, content
+        finally:
+            self.open -= 1
+
+    def test_dedupe_and_concurrency(self):
+        translator = AsyncTranslator(self.app, fetch=self.fetch)
+
+        async def run():
+            same = [translator.translate('hola', 'es', 'en') for _ in range(200)]
+            different = [translator.translate('post {}'.format(i), 'es', 'en') for i in range(50)]
+            return await asyncio.gather(*(same + different))
+
+        results = asyncio.run(run())
+        self.assertEqual(results[:200], ['HOLA'] * 200)
+        self.assertEqual(results[200:], ['POST {}'.format(i) for i in range(50)])
+        self.assertEqual(len(self.calls), 51)  # 'hola' only went upstream once
+        self.assertLessEqual(self.most_open, 5)
+
+        # and it's cached for next time
+        self.assertEqual(asyncio.run(translator.translate('hola', 'es', 'en')), 'HOLA')
+        self.assertEqual(len(self.calls), 51)
+
+    def test_circuit_breaker(self):
+        translator = AsyncTranslator(self.app, fetch=self.fetch)
+        self.fail = True
+
+        async def run():
+            return [await translator.translate('text {}'.format(i), 'es', 'en') for i in range(10)]
+
+        results = asyncio.run(run())
+        self.assertEqual(len(self.calls), 3)  # the breaker opened after three failures in a row
+        self.assertEqual(translator.breaker.state, 'open')
+        self.assertIn('unavailable', results[-1])
+
+        # once the reset timeout has passed, a single good call closes it again
+        self.fail = False
+        translator.breaker.opened_at -= self.app.config['MS_TRANSLATOR_BREAKER_RESET']
+        self.assertEqual(asyncio.run(translator.translate('hola', 'es', 'en')), 'HOLA')
+        self.assertEqual(translator.breaker.state, 'closed')
+
+    def test_circuit_breaker_cancelled_trial(self):
+        translator = AsyncTranslator(self.app, fetch=self.fetch)
+        breaker = translator.breaker
+        breaker.failures, breaker.opened_at = 3, time.monotonic() - self.app.config['MS_TRANSLATOR_BREAKER_RESET']
+
+        async def cancel_trial():
+            task = asyncio.ensure_future(translator.translate('hola', 'es', 'en'))
+            await asyncio.sleep(0.005)  # mid-fetch
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        # a trial that's cancelled counts as failed, rather than holding the breaker open for good
+        asyncio.run(cancel_trial())
+        self.assertEqual(breaker.state, 'open')
+        breaker.opened_at -= self.app.config['MS_TRANSLATOR_BREAKER_RESET']
+        self.assertEqual(asyncio.run(translator.translate('hola', 'es', 'en')), 'HOLA')
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_errors(self):
+        # a response that doesn't parse is an error message, not an exception
+        async def garbled(url, params, headers, body):
+            return 200, b'<html>'
+
+        translator = AsyncTranslator(self.app, fetch=garbled)
+        self.assertEqual(asyncio.run(translator.translate('hola', 'es', 'en')), 'Error: Translation service failed.')
+
+        # error messages are put into the caller's language on the way out
+        self.assertEqual(translator.localize(['hola', TranslationError(_l('Home'), '!')], 'es-ES,es;q=0.9'),
+                         ['hola', 'Inicio!'])
+
+    def asgi_post(self, app, path, body, content_type, cookie=None):
+        sent = []
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        headers = [(b'content-type', content_type.encode('ascii'))]
+        if cookie:
+            headers.append((b'cookie', cookie.encode('ascii')))
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(app({'type': 'http', 'method': 'POST', 'path': path, 'headers': headers}, receive, send))
+        return sent[0]['status'], json.loads(sent[1]['body'].decode('utf-8'))
+
+    def test_asgi_app(self):
+        app = TranslationApp(self.app, translator=AsyncTranslator(self.app, fetch=self.fetch))
+        form = b'text=hola&source_language=es&dest_language=en'
+        self.assertEqual(self.asgi_post(app, '/translate', form, 'application/x-www-form-urlencoded')[0], 401)
+
+        # logged in with the same session cookie the Flask app hands out
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        cookie = '{}={}'.format(self.app.session_cookie_name, serializer.dumps({'user_id': '1'}))
+        self.assertEqual(self.asgi_post(app, '/translate', form, 'application/x-www-form-urlencoded', cookie),
+                         (200, {'text': 'HOLA'}))
+
+        batch = json.dumps({'dest_language': 'en', 'items': [
+            {'id': 1, 'text': 'hola', 'source_language': 'es'},
+            {'id': 2, 'text': 'bonjour', 'source_language': 'fr'}]}).encode('utf-8')
+        self.assertEqual(self.asgi_post(app, '/translate_batch', batch, 'application/json', cookie),
+                         (200, {'translations': {'1': 'HOLA', '2': 'BONJOUR'}}))
+
+
+class FakeSMTPServer(object):
+    # just enough of an smtp server to accept mail, counting connections and messages; rejects any recipient
+    #   that starts with 'bounce'
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+        smtp = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                smtp.connections += 1
+                self.reply('220 localhost fake smtp')
+                while True:
+                    line = self.rfile.readline().decode('utf-8').strip()
+                    command = line[:4].upper()
+                    if not line or command == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    if command == 'RCPT' and '<bounce' in line:
+                        self.reply('550 no such user')
+                    elif command == 'DATA':
+                        self.reply('354 go ahead')
+                        data = []
+                        for data_line in iter(self.rfile.readline, b'.\r\n'):
+                            data.append(data_line)
+                        smtp.messages.append(b''.join(data))
+                        self.reply('250 ok')
+                    else:
+                        self.reply('250 ok')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = FakeSMTPServer()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.port
+            MAIL_SUPPRESS_SEND = False
+            MAIL_QUEUE_WORKERS = 0  # the tests run the queue by hand
+            MAIL_QUEUE_MAX_ATTEMPTS = 2
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        metrics.reset()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.smtp.close()
+
+    def test_batched_delivery(self):
+        for i in range(5):
+            send_email('hello {}'.format(i), 'admin@example.com', ['user{}@example.com'.format(i)], 'hi', '<p>hi</p>')
+        db.session.commit()
+        self.assertEqual(OutboundEmail.query.filter_by(status=OutboundEmail.QUEUED).count(), 5)
+        self.assertEqual(self.smtp.messages, [])
+
+        self.assertEqual(self.app.mail_queue.process(), 5)
+        self.assertEqual(self.app.mail_queue.process(), 0)
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertEqual(self.smtp.connections, 1)  # all five went over one connection
+        self.assertEqual(OutboundEmail.query.filter_by(status=OutboundEmail.SENT).count(), 5)
+        self.assertEqual(metrics.count('mail.sent'), 5)
+
+    def test_callers_transaction(self):
+        # queueing an email doesn't commit anything by itself: it goes (or doesn't) with the caller's transaction
+        send_email('hello', 'admin@example.com', ['susan@example.com'], 'hi', '<p>hi</p>')
+        db.session.rollback()
+        self.assertEqual(OutboundEmail.query.count(), 0)
+
+        send_email('hello', 'admin@example.com', ['susan@example.com'], 'hi', '<p>hi</p>')
+        db.session.commit()
+        self.assertEqual(metrics.count('mail.queued'), 1)
+        self.assertEqual(self.app.mail_queue.process(), 1)
+
+    def test_retries(self):
+        send_email('hello', 'admin@example.com', ['susan@example.com'], 'hi', '<p>hi</p>')
+        send_email('hello', 'admin@example.com', ['bounce@example.com'], 'hi', '<p>hi</p>')
+        db.session.commit()
+        self.app.mail_queue.process()
+
+        # the rejected message doesn't hold up the other one, and waits before trying again
+        bounced = OutboundEmail.query.filter_by(status=OutboundEmail.QUEUED).one()
+        self.assertEqual(bounced.attempts, 1)
+        self.assertGreater(bounced.next_attempt_at, datetime.utcnow())
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertEqual(self.app.mail_queue.process(), 0)
+
+        OutboundEmail.query.filter_by(status=OutboundEmail.QUEUED).update({'next_attempt_at': datetime.utcnow()})
+        db.session.commit()
+        self.app.mail_queue.process()
+        self.assertEqual(OutboundEmail.query.filter_by(status=OutboundEmail.FAILED).count(), 1)
+        self.assertEqual(metrics.count('mail.failed'), 1)
+
+    def test_server_down(self):
+        send_email('hello', 'admin@example.com', ['susan@example.com'], 'hi', '<p>hi</p>')
+        db.session.commit()
+        self.smtp.close()
+        self.app.mail_queue.process()
+
+        # nothing is lost; it's still queued for later
+        email = OutboundEmail.query.one()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.QUEUED, 1))
+        self.assertIn('Error', email.last_error)
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    def setUp(self):
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_BINDS = {'replica0': 'sqlite://'}  # a second, separate in-memory database
+            PAGE_CACHE = ''
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replica = db.get_engine(self.app, 'replica0')
+        db.Model.metadata.create_all(self.replica)
+
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        # the replica has the user, but is lagging behind on posts
+        self.replica.execute(User.__table__.insert().values(id=u.id, username='susan', email='susan@example.com'))
+        self.replica.execute(Post.__table__.insert().values(body='seen on the replica', user_id=u.id,
+                                                            timestamp=datetime.utcnow()))
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_routing(self):
+        self.app.config['DATABASE_READ_YOUR_WRITES'] = 0
+        self.assertIn(b'seen on the replica', self.client.get('/explore').data)
+
+        # right after writing something, the author reads from the primary and sees it
+        self.app.config['DATABASE_READ_YOUR_WRITES'] = 60
+        self.client.post('/index', data={'post': 'written to the primary'})
+        data = self.client.get('/explore').data
+        self.assertIn(b'written to the primary', data)
+        self.assertNotIn(b'seen on the replica', data)
+
+        # pages that aren't marked read-only never touch the replica
+        self.app.config['DATABASE_READ_YOUR_WRITES'] = 0
+        self.assertIn(b'susan', self.client.get('/edit_profile').data)
+
+        # api clients don't carry the session cookie, so they get no Set-Cookie, and read their writes from the
+        #   primary.  (a fresh app context first: requests share this one, and with it g.read_replica)
+        db.session.remove()
+        self.app_context.pop()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        api = self.app.test_client(use_cookies=False)
+        token = api.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b'susan:cat').decode('ascii')}).get_json()['token']
+        headers = {'Authorization': 'Bearer ' + token}
+        r = api.post('/api/posts', json={'body': 'written over the api'}, headers=headers)
+        self.assertEqual(r.status_code, 201)
+        self.assertNotIn('Set-Cookie', r.headers)
+        bodies = [post['body'] for post in api.get('/api/explore', headers=headers).get_json()['items']]
+        self.assertIn('written over the api', bodies)
+
+    def test_checkout_wait_metrics(self):
+        metrics.reset()
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.connect()
+        with self.assertRaises(Exception):
+            pool.connect()
+        connection.close()
+        pool.connect().close()
+        self.assertEqual(metrics.count('db.pool.timeouts', pool='primary'), 1)
+        self.assertEqual(metrics.timings[metrics.key('db.pool.checkout_wait_seconds', {'pool': 'primary'})][0], 3)
+
+
+class SQLiteModeCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+        class SQLiteConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.dir.name, 'app.db')
+            SQLITE_OPTIMIZE = True
+            SQLITE_SINGLE_WRITER = True
+
+        self.app = create_app(SQLiteConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        self.dir.cleanup()
+
+    def test_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), 5000)
+
+    def test_single_writer(self):
+        metrics.reset()
+        errors = []
+
+        def write(n):
+            with self.app.app_context():
+                try:
+                    for i in range(20):
+                        db.session.add(User(username='user{}-{}'.format(n, i)))
+                        db.session.flush()
+                        time.sleep(0.001)  # hold the write transaction open for a moment
+                        db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(User.query.count(), 80)
+        self.assertEqual(metrics.timings[metrics.key('db.sqlite.write_lock_wait_seconds', {})][0], 80)
+
+
+class LanguageDetectionCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_detect_language(self):
+        self.assertEqual(detect_language('hi there'), '')  # too short to tell
+        self.assertEqual(detect_language('The quick brown fox jumps over the lazy dog'), 'en')
+        self.assertEqual(detect_language('Привет, как у тебя дела сегодня?'), 'ru')
+        self.assertEqual(detect_language('こんにちは'), 'ja')
+
+    def test_new_post(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        client.post('/index', data={'post': 'El rápido zorro marrón salta sobre el perro perezoso'})
+        self.assertEqual(Post.query.one().language, 'es')
+
+    def test_backfill(self):
+        db.session.execute(Post.__table__.insert(), [
+            {'body': 'The quick brown fox jumps over the lazy dog', 'user_id': 1, 'language': None},
+            {'body': 'Le renard brun rapide saute par-dessus le chien paresseux', 'user_id': 1, 'language': 'xx'}])
+        db.session.commit()
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(detect_languages(executor, chunk_size=1), 1)
+            self.assertEqual([p.language for p in Post.query.order_by(Post.id)], ['en', 'xx'])
+            self.assertEqual(detect_languages(executor, redo=True), 2)
+        db.session.expire_all()
+        self.assertEqual([p.language for p in Post.query.order_by(Post.id)], ['en', 'fr'])
+
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+        class InstrumentedConfig(TestConfig):
+            INSTRUMENTATION = True
+            METRICS_TOKEN = 'secret'
+            PROFILE_DIR = self.dir.name
+            PAGE_CACHE = ''
+
+        self.app = create_app(InstrumentedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add_all([u, Post(body='hello', author=u, timestamp=datetime.utcnow())])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        metrics.reset()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.dir.cleanup()
+
+    def test_server_timing(self):
+        timing = self.client.get('/explore').headers['Server-Timing']
+        self.assertTrue(timing.startswith('app;dur='))
+        self.assertIn('sql;desc="SQL (', timing)
+        self.assertIn('tpl;desc="Templates (1)"', timing)  # just the page, not every template it includes
+        self.assertEqual(metrics.count('http.requests', endpoint='main.explore', method='GET', status='200'), 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/explore')
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        r = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        text = r.get_data(as_text=True)
+        self.assertIn('# TYPE microblog_http_requests_total counter', text)
+        self.assertIn('microblog_http_requests_total{endpoint="main.explore",method="GET",status="200"} 1.0', text)
+        self.assertIn('microblog_http_request_seconds_count{endpoint="main.explore"} 1', text)
+        self.assertIn('microblog_db_query_seconds_sum', text)
+
+        # without a token to protect them, the metrics aren't served at all
+        class NoTokenConfig(TestConfig):
+            INSTRUMENTATION = True
+
+        self.assertEqual(create_app(NoTokenConfig).test_client().get('/metrics').status_code, 404)
+
+    def test_slow_request_profile(self):
+        self.app.config['PROFILE_SLOW_REQUESTS'] = 0.000001
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.client.get('/explore')
+        profiles = os.listdir(self.dir.name)
+        self.assertEqual(len(profiles), 1)
+        self.assertIn('main.explore', profiles[0])
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.susan = User(username='susan', email='susan@example.com')
+        self.john = User(username='john', email='john@example.com')
+        self.susan.set_password('cat')
+        now = datetime.utcnow()
+        db.session.add_all([self.susan, self.john] + [
+            Post(body='post {}'.format(i), author=self.john, language='en', timestamp=now + timedelta(seconds=i))
+            for i in range(5)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        r = self.client.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b'susan:cat').decode('ascii')})
+        self.headers = {'Authorization': 'Bearer ' + r.get_json()['token']}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_auth(self):
+        self.assertEqual(self.client.get('/api/explore').status_code, 401)
+        self.assertEqual(self.client.get('/api/explore', headers={'Authorization': 'Bearer nope'}).status_code, 401)
+        bad = self.client.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b'susan:dog').decode('ascii')})
+        self.assertEqual(bad.status_code, 401)
+
+        # changing the password revokes every token issued before
+        self.assertEqual(self.client.get('/api/explore', headers=self.headers).status_code, 200)
+        User.query.filter_by(username='susan').first().set_password('dog')
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/explore', headers=self.headers).status_code, 401)
+
+        # including when another process changes it, and this one still has susan cached
+        r = self.client.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b'susan:dog').decode('ascii')})
+        headers = {'Authorization': 'Bearer ' + r.get_json()['token']}
+        self.assertEqual(self.client.get('/api/explore', headers=headers).status_code, 200)
+        db.session.execute(User.__table__.update().values(password_hash='changed elsewhere'))
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/explore', headers=headers).status_code, 401)
+
+    def test_pagination_and_fields(self):
+        r = self.client.get('/api/explore?limit=2&fields=id,body', headers=self.headers).get_json()
+        self.assertEqual(r['items'], [{'id': 5, 'body': 'post 4'}, {'id': 4, 'body': 'post 3'}])
+        self.assertIsNone(r['prev'])
+        r = self.client.get('/api/explore?limit=2&fields=id&cursor=' + r['next'], headers=self.headers).get_json()
+        self.assertEqual(r['items'], [{'id': 3}, {'id': 2}])
+
+        post = self.client.get('/api/users/{}/posts?limit=1'.format(self.john.id), headers=self.headers).get_json()
+        self.assertEqual(post['items'][0]['author']['username'], 'john')
+        self.assertEqual(self.client.get('/api/explore?fields=password_hash', headers=self.headers).status_code, 400)
+        missing = self.client.get('/api/users/999', headers=self.headers)
+        self.assertEqual((missing.status_code, missing.get_json()['error']), (404, 'Not Found'))
+        page = self.client.get('/no-such-page', headers={'Accept': 'application/json'})
+        self.assertEqual((page.status_code, page.mimetype), (404, 'text/html'))
+        not_allowed = self.client.put('/api/explore', headers=self.headers)
+        self.assertEqual((not_allowed.status_code, not_allowed.get_json()['error']), (405, 'Method Not Allowed'))
+        self.assertEqual(self.client.put('/explore').mimetype, 'text/html')
+
+    def test_follow_and_post(self):
+        self.assertEqual(self.client.get('/api/timeline', headers=self.headers).get_json()['items'], [])
+        r = self.client.post('/api/users/{}/follow'.format(self.john.id), headers=self.headers)
+        self.assertEqual(r.get_json(), {'id': self.john.id, 'following': True})
+        self.assertEqual(len(self.client.get('/api/timeline', headers=self.headers).get_json()['items']), 5)
+
+        r = self.client.post('/api/posts?fields=id,body', json={'body': 'hello from the api'}, headers=self.headers)
+        self.assertEqual(r.status_code, 201)
+        self.assertEqual(r.get_json()['body'], 'hello from the api')
+        self.assertEqual(self.client.post('/api/posts', json={'body': ''}, headers=self.headers).status_code, 400)
+        # a refused post isn't saved, so the client can fix the request and send it again
+        count = Post.query.count()
+        r = self.client.post('/api/posts?fields=bogus', json={'body': 'twice?'}, headers=self.headers)
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(Post.query.count(), count)
+
+        r = self.client.delete('/api/users/{}/follow'.format(self.john.id), headers=self.headers)
+        self.assertEqual(r.get_json(), {'id': self.john.id, 'following': False})
+        items = self.client.get('/api/timeline?fields=body', headers=self.headers).get_json()['items']
+        self.assertEqual(items, [{'body': 'hello from the api'}])
+
+
+class StreamCase(unittest.TestCase):
+    def setUp(self):
+        # a database file rather than in-memory, so the ASGI stream's worker thread sees the same data
+        self.dir = tempfile.TemporaryDirectory()
+
+        class StreamConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.dir.name, 'app.db')
+            SSE_ENABLED = True
+            SSE_HEARTBEAT = 0.05
+            SSE_MAX_AGE = 0.5
+
+        self.app = create_app(StreamConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        susan = User(username='susan', email='susan@example.com')
+        john = User(username='john', email='john@example.com')
+        david = User(username='david', email='david@example.com')
+        susan.set_password('cat')
+        post = Post(body='hello', author=john, language='en')
+        db.session.add_all([susan, john, david, post])
+        susan.follow(john)
+        db.session.commit()
+        self.susan_id, self.john_id, self.david_id, self.post_id = susan.id, john.id, david.id, post.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        self.dir.cleanup()
+
+    def add_post(self, user_id, body):
+        post = Post(body=body, user_id=user_id, language='en')
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+    def test_hub(self):
+        hub = Hub(queue_size=2)
+        subscription = hub.subscribe(['a', 'b'])
+        hub.publish('a', 1)
+        hub.publish('c', 2)
+        hub.publish('b', 3)
+        self.assertEqual([subscription.get(0), subscription.get(0), subscription.get(0)], [1, 3, None])
+
+        # a listener that falls behind is told so, instead of holding up the publisher
+        for i in range(3):
+            hub.publish('a', i)
+        self.assertTrue(subscription.overflowed)
+        hub.unsubscribe(subscription)
+        self.assertEqual(len(hub), 0)
+
+    def test_stream(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/stream').status_code, 302)
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+
+        # a reconnecting client gets what it missed since Last-Event-ID first
+        r = client.get('/stream', headers={'Last-Event-ID': str(self.post_id - 1)}, buffered=False)
+        self.assertEqual(r.mimetype, 'text/event-stream')
+        events = iter(r.response)
+        self.assertEqual(next(events), b'retry: 3000\n\n')
+        self.assertIn('id: {}\n'.format(self.post_id).encode('ascii'), next(events))
+
+        self.add_post(self.david_id, 'not followed')
+        new_id = self.add_post(self.john_id, 'followed')
+        self.assertEqual(next(events), 'event: post\nid: {0}\ndata: {{"id":{0},"author":{1}}}\n\n'.format(
+            new_id, self.john_id).encode('ascii'))
+        self.assertEqual(next(events), b': keepalive\n\n')
+        r.close()
+        self.assertEqual(len(self.app.pubsub), 0)
+
+        fragments = client.get('/fragments?ids={},{}'.format(self.post_id, new_id)).get_json()['posts']
+        self.assertEqual([post['id'] for post in fragments], [new_id, self.post_id])
+        self.assertIn('followed', fragments[0]['html'])
+        self.assertIn(b'new EventSource', client.get('/index').data)
+        spanish = client.get('/index', headers={'Accept-Language': 'es'}).get_data(as_text=True)
+        self.assertIn('1 artículo nuevo', spanish)
+        self.assertIn('Traducir todo', spanish)
+
+    def test_stream_disabled(self):
+        # off by default: no stream for the home page to open, so sync workers aren't tied up holding them
+        self.app.config['SSE_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        self.assertNotIn(b'EventSource', client.get('/index').data)
+        self.assertEqual(create_app(TestConfig).test_client().get('/stream').status_code, 404)
+
+    def test_asgi_stream(self):
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        cookie = '{}={}'.format(self.app.session_cookie_name, serializer.dumps({'user_id': str(self.susan_id)}))
+        headers = [(b'cookie', cookie.encode('ascii')), (b'last-event-id', str(self.post_id - 1).encode('ascii'))]
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(10)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message.get('body', b'').startswith(b'retry'):
+                # published from the loop's own thread, like the redis listener would from another one
+                self.app.pubsub.publish(author_channel(self.john_id), {'id': 99, 'author': self.john_id})
+
+        # the subscription's asyncio queue is made on the loop's thread; before python 3.10 a worker thread has no
+        #   loop to make it with
+        subscribed_on = []
+        hub_subscribe = self.app.pubsub.subscribe
+
+        def subscribe(*args, **kwargs):
+            subscribed_on.append(threading.current_thread())
+            return hub_subscribe(*args, **kwargs)
+        self.app.pubsub.subscribe = subscribe
+
+        app = StreamApp(self.app)
+        asyncio.run(app({'type': 'http', 'method': 'GET', 'path': '/stream', 'headers': headers}, receive, send))
+        self.assertEqual(subscribed_on, [threading.main_thread()])
+        self.assertEqual(sent[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in sent[1:])
+        self.assertIn('id: {}\n'.format(self.post_id).encode('ascii'), body)
+        self.assertIn(b'id: 99\n', body)
+        self.assertIn(b': keepalive', body)
+        self.assertFalse(sent[-1].get('more_body'))  # ended after SSE_MAX_AGE, for the browser to reconnect
+        self.assertEqual(len(self.app.pubsub), 0)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)